@@ -1,15 +1,11 @@
-# Let's use my own conversion logic for convenience
+# Rates and conversions live in accounts.fx; these remain as the stub feed's defaults.
 from decimal import Decimal
 
 USD_TO_THB_RATE = 30
-THB_TO_USD_RATE = 0.033
+THB_TO_USD_RATE = Decimal(1) / USD_TO_THB_RATE
 
 
 def convert(currency: str, target_currency: str, amount: Decimal) -> Decimal:
-    if currency == 'USD' and target_currency == 'THB':
-        return amount * USD_TO_THB_RATE
+    from .fx import rate_cache
 
-    if currency == 'THB' and target_currency == 'USD':
-        return amount * Decimal(THB_TO_USD_RATE)
-
-    return amount
+    return rate_cache.convert(currency, target_currency, amount)
@@ -0,0 +1,190 @@
+import functools
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+BUCKET_CACHE_KEY = 'accounts:bucket:{}'
+# In-process buckets kept before full ones are pruned
+MAX_LOCAL_BUCKETS = 10000
+# Longest Retry-After sent, for buckets that never refill
+MAX_RETRY_AFTER = 24 * 60 * 60
+
+
+def _setting(name, default=None):
+    return getattr(settings, name, default)
+
+
+def _refill(state, rate, burst, now):
+    """`(tokens, stamp)` of a bucket at `now`, starting full."""
+    if state is None:
+        return burst, now
+    tokens, stamp = state
+    return min(burst, tokens + max(now - stamp, 0) * rate), now
+
+
+def _until(tokens, wanted, rate):
+    """Seconds until a bucket holding `tokens` has `wanted`; forever when it does not refill."""
+    if tokens >= wanted:
+        return 0
+    return (wanted - tokens) / rate if rate else math.inf
+
+
+def _take(states, limits, now):
+    """
+    Take a token from every bucket in `limits` (`{key: (rate, burst)}`) or from none.
+
+    Returns the buckets' new states and the seconds until the emptiest one has
+    a token (0 when the tokens were taken).
+    """
+    states = {key: _refill(states.get(key), rate, burst, now) for key, (rate, burst) in limits.items()}
+    wait = max(_until(tokens, 1, limits[key][0]) for key, (tokens, _) in states.items())
+    if wait > 0:
+        return states, wait
+    return {key: (tokens - 1, stamp) for key, (tokens, stamp) in states.items()}, 0
+
+
+class LocalBuckets:
+    """Token buckets in this process's memory; each worker process limits on its own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, limits):
+        now = time.monotonic()
+        with self._lock:
+            current = {key: self._buckets[key][0] for key in limits if key in self._buckets}
+            states, wait = _take(current, limits, now)
+            for key, (tokens, stamp) in states.items():
+                rate, burst = limits[key]
+                # Kept alongside: when the bucket will be full again, after which it can be dropped.
+                self._buckets[key] = ((tokens, stamp), stamp + _until(tokens, burst, rate))
+            if len(self._buckets) > MAX_LOCAL_BUCKETS:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        for key in [key for key, (_, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBuckets:
+    """
+    Token buckets in a shared cache, so every worker draws on the same ones.
+
+    The read and write of the buckets are not atomic; racing requests can each
+    take the same token, so under contention the limit is approximate.
+    """
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def take(self, limits):
+        keys = {key: BUCKET_CACHE_KEY.format(key) for key in limits}
+        found = self.cache.get_many(keys.values())
+        current = {key: found[cache_key] for key, cache_key in keys.items() if cache_key in found}
+        states, wait = _take(current, limits, time.time())
+        for key, (tokens, stamp) in states.items():
+            rate, burst = limits[key]
+            # Gone once it would be full again, which is the same as a fresh bucket.
+            full_in = _until(tokens, burst, rate)
+            self.cache.set(keys[key], (tokens, stamp), timeout=None if full_in == math.inf else math.ceil(full_in) + 1)
+        return wait
+
+
+class ConcurrencyLimiter:
+    """Counts the requests inside a section; those over the limit wait a little for a slot, then give up."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.active = 0
+
+    def acquire(self, limit, timeout):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.active < limit, timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+local_buckets = LocalBuckets()
+write_slots = ConcurrencyLimiter()
+
+
+def buckets():
+    alias = _setting('RATE_LIMIT_CACHE')
+    return local_buckets if alias is None else CacheBuckets(alias)
+
+
+def retry_after(seconds):
+    return str(max(1, math.ceil(min(seconds, MAX_RETRY_AFTER))))
+
+
+def check_rate(user_id, account_id=None):
+    """
+    Take a token from the user's bucket and, when given, the account's, or
+    from neither.
+
+    Returns the seconds until both have a token, or 0 when the request is
+    admitted. Limits whose rate is None are off, and a rate of 0 never refills,
+    admitting only the burst; a burst of None defaults to one second's worth
+    of requests.
+    """
+    limits = {}
+    for kind, key in (('user', user_id), ('account', account_id)):
+        rate = _setting(f'RATE_LIMIT_{kind.upper()}_RATE')
+        if key is not None and rate is not None:
+            limits[f'{kind}:{key}'] = (rate, _setting(f'RATE_LIMIT_{kind.upper()}_BURST') or max(rate, 1))
+    if not limits:
+        return 0
+    return buckets().take(limits)
+
+
+def admit(user_id, account_id, handler):
+    """
+    Run `handler()` (which returns a DRF `Response`) unless the request is shed.
+
+    A client over its per-user or per-account rate (see `check_rate`) gets a
+    429 at once. When `MAX_CONCURRENT_WRITES` requests are already running in
+    this process, another waits at most `WRITE_QUEUE_TIMEOUT` seconds for one
+    to finish, then gets a 503. Both carry `Retry-After`, and neither touches
+    the database, so shed requests cost almost nothing.
+    """
+    wait = check_rate(user_id, account_id)
+    if wait:
+        return Response({'status': 'rate limit exceeded'}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': retry_after(wait)})
+
+    limit = _setting('MAX_CONCURRENT_WRITES')
+    if limit is None:
+        return handler()
+    if not write_slots.acquire(limit, _setting('WRITE_QUEUE_TIMEOUT', 0.05)):
+        return Response({'status': 'server busy, retry shortly'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': retry_after(0)})
+    try:
+        return handler()
+    finally:
+        write_slots.release()
+
+
+def admitted(view_method):
+    """Admission control (see `admit`) for a money-movement viewset action, keyed on its `pk` when it has one."""
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        return admit(request.user.id, kwargs.get('pk'), lambda: view_method(self, request, *args, **kwargs))
+
+    return wrapper
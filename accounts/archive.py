@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import ArchivedTransaction, Transaction
+
+ARCHIVED_FIELDS = (
+    'id', 'account_id', 'to_account_id', 'amount', 'currency', 'real_amount', 'real_currency', 'to_amount',
+    'transaction_type', 'created_at',
+)
+
+
+def horizon():
+    """Age past which transactions are archived (a timedelta), or None when archiving is off."""
+    return getattr(settings, 'TRANSACTION_ARCHIVE_AFTER', None)
+
+
+def cutoff():
+    return timezone.now() - horizon()
+
+
+def archived_through():
+    """
+    `created_at` of the newest archived transaction, or None when there is none
+    or archiving is off. One index lookup; history at or before it may be archived.
+    """
+    if horizon() is None:
+        return None
+    return ArchivedTransaction.objects.aggregate(latest=Max('created_at'))['latest']
+
+
+async def aarchived_through():
+    if horizon() is None:
+        return None
+    return (await ArchivedTransaction.objects.aaggregate(latest=Max('created_at')))['latest']
+
+
+def reaches(since, through):
+    """Whether history from `since` on (None: from the beginning) can include archived transactions."""
+    return through is not None and (since is None or since <= through)
+
+
+def history_models(since=None):
+    """The models holding history from `since` on: the hot table, then the archive when it is needed."""
+    if reaches(since, archived_through()):
+        return (Transaction, ArchivedTransaction)
+    return (Transaction,)
+
+
+def last_transaction_id():
+    """Id of the latest transaction, archived or not (None if there are none)."""
+    ids = [model.objects.aggregate(last=Max('id'))['last'] for model in history_models()]
+    return max((pk for pk in ids if pk is not None), default=None)
+
+
+def archive_batch(before, batch_size):
+    """
+    Move up to `batch_size` of the oldest transactions created before `before`
+    into the archive; returns how many moved.
+
+    Copy and delete share one database transaction, so a transaction is never
+    in both tables or in neither. Ledger entries keep pointing at its id.
+    """
+    with transaction.atomic():
+        rows = list(Transaction.objects.filter(created_at__lt=before).order_by('created_at', 'id')
+                    .values(*ARCHIVED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ArchivedTransaction.objects.bulk_create([ArchivedTransaction(**row) for row in rows])
+        Transaction.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+    return len(rows)
@@ -0,0 +1,221 @@
+# ASGI-native versions of the money-movement and transaction-list endpoints.
+# Authentication, request parsing and reads stay on the event loop, so a worker
+# holds slow clients without a thread each. Postings still need
+# `transaction.atomic`, which the async ORM lacks, so only that short locked
+# section hops onto a thread.
+import functools
+import json
+import math
+from decimal import Decimal, InvalidOperation
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from . import admission, archive, db, events, idempotency, ledger
+from .authentication import CachedJWTAuthentication
+from .models import Account, ArchivedTransaction, Transaction
+from .pagination import KeysetCursorPagination
+from .serializers import TransactionSerializer
+from .views import filter_transactions
+
+authentication = CachedJWTAuthentication()
+
+
+def _json(response):
+    headers = {name: value for name, value in response.items() if name != 'Content-Type'}
+    return JsonResponse(response.data, status=response.status_code, headers=headers, safe=False)
+
+
+def async_api_view(methods):
+    """
+    Async counterpart of DRF's `@api_view` for these endpoints: allowed methods,
+    JWT authentication (`request.user`) and DRF-style error bodies.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                                    status=status.HTTP_405_METHOD_NOT_ALLOWED, headers={'Allow': ', '.join(methods)})
+            try:
+                user_auth = await authentication.aauthenticate(request)
+                if user_auth is None:
+                    return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                                        status=status.HTTP_401_UNAUTHORIZED,
+                                        headers={'WWW-Authenticate': authentication.authenticate_header(request)})
+                request.user, request.auth = user_auth
+                return await view(request, *args, **kwargs)
+            except APIException as e:
+                headers = {}
+                if e.status_code == status.HTTP_401_UNAUTHORIZED:
+                    headers['WWW-Authenticate'] = authentication.authenticate_header(request)
+                return JsonResponse(e.detail if isinstance(e.detail, dict) else {'detail': e.detail},
+                                    status=e.status_code, headers=headers)
+
+        # JWT auth is not cookie based; same as DRF's views.
+        wrapper.csrf_exempt = True
+        return wrapper
+
+    return decorator
+
+
+MOVEMENTS = {
+    'deposit': (ledger.deposit, 'deposit successful'),
+    'withdraw': (ledger.withdraw, 'withdraw successful'),
+    'transfer': (ledger.transfer, 'transfer successful'),
+}
+
+
+def _post(operation, request, data, pk, *args):
+    """
+    Run a ledger operation, admitted (see `admission.admit`) and behind `Idempotency-Key`
+    when given, and build the sync view's response.
+    """
+    posting, success = MOVEMENTS[operation]
+
+    def handler():
+        try:
+            posting(pk, *args)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.LedgerError as e:
+            return Response({'status': e.message}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'status': success})
+
+    def admitted_handler():
+        key = request.headers.get(idempotency.IDEMPOTENCY_HEADER)
+        if not key:
+            return handler()
+        return idempotency.execute(request.user, key, request.method, request.path, data, handler)
+
+    return admission.admit(request.user.id, pk, admitted_handler)
+
+
+def _post_in_thread(*args):
+    """
+    `_post` on a thread of the default executor, not the one thread shared by
+    every thread-sensitive call, so postings to different accounts overlap
+    (their row locks still queue postings to the same one). Each of those
+    threads keeps its own connection, which the request signals never see, so
+    stale ones are closed here.
+    """
+    close_old_connections()
+    try:
+        return _post(*args)
+    finally:
+        close_old_connections()
+
+
+_apost = sync_to_async(_post_in_thread, thread_sensitive=False)
+
+
+def _parse_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+        return data, Decimal(str(data.get('amount'))), data.get('currency', 'THB')
+    except (ValueError, AttributeError, InvalidOperation):
+        return None, None, None
+
+
+def _invalid_body():
+    return JsonResponse({'status': 'a JSON body with a numeric amount is required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+
+@async_api_view(['POST'])
+async def deposit(request, pk):
+    data, amount, currency = _parse_body(request)
+    if data is None:
+        return _invalid_body()
+    return _json(await _apost('deposit', request, data, pk, amount, currency))
+
+
+@async_api_view(['POST'])
+async def withdraw(request, pk):
+    data, amount, currency = _parse_body(request)
+    if data is None:
+        return _invalid_body()
+    return _json(await _apost('withdraw', request, data, pk, amount, currency))
+
+
+@async_api_view(['POST'])
+async def transfer(request, pk):
+    data, amount, currency = _parse_body(request)
+    if data is None:
+        return _invalid_body()
+    return _json(await _apost('transfer', request, data, pk, data.get('to_account_id'), amount, currency))
+
+
+@async_api_view(['GET'])
+async def transaction_list(request):
+    # A DRF request wrapper gives the paginator and serializer `query_params`; nothing here reads its body.
+    drf_request = Request(request)
+    columns = set(TransactionSerializer.source_attributes(drf_request)) | {'created_at', 'id'}
+    querysets = [filter_transactions(model.objects.all(), drf_request.query_params).values(*columns)
+                 for model in (Transaction, ArchivedTransaction)]
+
+    paginator = KeysetCursorPagination()
+    with db.reading_from(db.read_only_database()):
+        if not archive.reaches(paginator.lower_bound(drf_request), await archive.aarchived_through()):
+            querysets.pop()
+        page = await paginator.apaginate_querysets(querysets, drf_request)
+    serializer = TransactionSerializer(page, many=True, context={'request': drf_request})
+    return _json(paginator.get_paginated_response(serializer.data))
+
+
+def _position(request):
+    # EventSource sends the header when it reconnects; long-poll clients pass it as a query parameter.
+    value = request.headers.get(events.LAST_EVENT_ID_HEADER) or request.GET.get('last_event_id')
+    if value is None:
+        return None
+    return events.parse_position(value) or False
+
+
+def _timeout(request):
+    # Seconds a long poll waits, capped at EVENTS_LONG_POLL_TIMEOUT; None unless a finite number >= 0.
+    try:
+        timeout = float(request.GET.get('timeout', events.long_poll_timeout()))
+    except ValueError:
+        return None
+    if not math.isfinite(timeout) or timeout < 0:
+        return None
+    return min(timeout, events.long_poll_timeout())
+
+
+@async_api_view(['GET'])
+async def account_events(request, pk):
+    """
+    Change feed of an account's ledger entries; each event's id is the feed position after it.
+
+    `Accept: text/event-stream` gets server-sent events when served over ASGI;
+    anything else (or WSGI, which would hold a thread per stream) a long poll
+    that answers as soon as there is an entry, or after `timeout` seconds with
+    none. Both resume after `Last-Event-ID` (or `?last_event_id=`) and
+    otherwise start from the next entry.
+    """
+    position = _position(request)
+    if position is False:
+        return JsonResponse({'status': 'invalid last event id'}, status=status.HTTP_400_BAD_REQUEST)
+    if not await Account.objects.filter(pk=pk).aexists():
+        return JsonResponse({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+    if position is None:
+        position = await events.latest_position(pk)
+
+    if isinstance(request, ASGIRequest) and 'text/event-stream' in request.headers.get('Accept', ''):
+        response = StreamingHttpResponse(events.stream(pk, position), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Proxies such as nginx would otherwise hold events back in their buffers.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    timeout = _timeout(request)
+    if timeout is None:
+        return JsonResponse({'status': 'invalid timeout'}, status=status.HTTP_400_BAD_REQUEST)
+    found = await events.wait_for_events(pk, position, timeout)
+    return JsonResponse({'events': found, 'last_event_id': events.format_position(events.advance(position, found))})
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from . import profiling
+from .models import User
+
+UserStatus = namedtuple('UserStatus', ['is_active', 'is_staff', 'is_superuser', 'username'])
+STATUS_FIELDS = UserStatus._fields
+
+
+class AsyncJWTAuthentication(JWTAuthentication):
+    """
+    `JWTAuthentication` with an `aauthenticate` for async views: token checks
+    are pure CPU work, and the user is loaded with the async ORM.
+    """
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        try:
+            user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        return user
+
+
+class UserStatusCache:
+    """
+    In-process LRU of `UserStatus` by user id; entries expire after a TTL.
+
+    Saving or deleting a `User` drops its entry (see `signals`), so a
+    deactivation takes effect at once in this process and within the TTL in
+    every other one.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def max_size(self):
+        return self._max_size if self._max_size is not None else getattr(settings, 'JWT_USER_CACHE_SIZE', 10000)
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else getattr(settings, 'JWT_USER_CACHE_TTL', 30)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            user_status, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return user_status
+
+    def set(self, user_id, user_status):
+        with self._lock:
+            self._entries[user_id] = (user_status, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+user_status_cache = UserStatusCache()
+
+
+class CachedTokenUser(TokenUser):
+    """`TokenUser` whose flags come from the cached `UserStatus` rather than the token's claims."""
+
+    def __init__(self, token, user_status):
+        super().__init__(token)
+        self.is_active = user_status.is_active
+        self.is_staff = user_status.is_staff
+        self.is_superuser = user_status.is_superuser
+        self.username = user_status.username
+
+
+class CachedJWTAuthentication(AsyncJWTAuthentication):
+    """
+    JWT authentication that skips the per-request `User` query.
+
+    `request.user` is a `CachedTokenUser` built from the token's user id and the
+    cached active/staff flags, so only a cache miss touches the database.
+    Anything that needs the full row should load it by `request.user.id`.
+    """
+
+    def authenticate(self, request):
+        with profiling.timed('auth'):
+            return super().authenticate(request)
+
+    async def aauthenticate(self, request):
+        with profiling.timed('auth'):
+            return await super().aauthenticate(request)
+
+    def get_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            # Revocation compares the password hash, which is not cached.
+            return super().get_user(validated_token)
+        user_id = self._user_id(validated_token)
+        user_status = user_status_cache.get(user_id)
+        if user_status is None:
+            row = User.objects.filter(pk=user_id).values_list(*STATUS_FIELDS).first()
+            user_status = self._remember(user_id, row)
+        return self._token_user(validated_token, user_status)
+
+    async def aget_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            return await super().aget_user(validated_token)
+        user_id = self._user_id(validated_token)
+        user_status = user_status_cache.get(user_id)
+        if user_status is None:
+            row = await User.objects.filter(pk=user_id).values_list(*STATUS_FIELDS).afirst()
+            user_status = self._remember(user_id, row)
+        return self._token_user(validated_token, user_status)
+
+    def _user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+    def _remember(self, user_id, row):
+        if row is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        user_status = UserStatus(*row)
+        # Inactive users are cached too, so their tokens are turned away without a query.
+        user_status_cache.set(user_id, user_status)
+        return user_status
+
+    def _token_user(self, validated_token, user_status):
+        if not user_status.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return CachedTokenUser(validated_token, user_status)
+
+
+@profiling.timed('auth')
+def token_user_id(request):
+    """User id of the request's valid bearer token, or None; touches neither the database nor the cache."""
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return None
+    try:
+        raw_token = authentication.get_raw_token(header)
+        if raw_token is None:
+            return None
+        return authentication._user_id(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None
@@ -0,0 +1,237 @@
+import json
+import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import Account, Transaction, User
+
+SEED_BATCH_SIZE = 1000
+PERCENTILES = (50, 95, 99)
+
+
+def seed(users=100, accounts_per_user=2, transactions=10000, batch_size=SEED_BATCH_SIZE, prefix='bench'):
+    """
+    Bulk-insert benchmark fixtures and return `[(user, [account ids])]`.
+
+    Rows bypass the ledger (and so snapshots and rollups): they only give the
+    read endpoints realistic table sizes to work against.
+    """
+    password = make_password(None)
+    User.objects.bulk_create([
+        User(username=f'{prefix}-{i}', password=password) for i in range(users)
+    ], batch_size=batch_size)
+    created_users = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+
+    Account.objects.bulk_create([
+        Account(user=user, balance=Decimal('1000000.00'), currency='THB')
+        for user in created_users for _ in range(accounts_per_user)
+    ], batch_size=batch_size)
+    owned = {}
+    for account_id, user_id in Account.objects.filter(user__in=created_users).values_list('id', 'user_id'):
+        owned.setdefault(user_id, []).append(account_id)
+    account_ids = [account_id for ids in owned.values() for account_id in ids]
+
+    rng = random.Random(0)
+    now = timezone.now()
+    for start in range(0, transactions, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, transactions)):
+            account_id, to_account_id = rng.sample(account_ids, 2) if len(account_ids) > 1 else (account_ids[0], None)
+            batch.append(Transaction(
+                account_id=account_id, to_account_id=to_account_id, amount=Decimal('1.00'), currency='THB',
+                real_amount=Decimal('1.00'), real_currency='THB', to_amount=Decimal('1.00') if to_account_id else None,
+                transaction_type='transfer' if to_account_id else 'deposit',
+                created_at=now - timedelta(seconds=transactions - i)
+            ))
+        Transaction.objects.bulk_create(batch)
+
+    return [(user, owned[user.id]) for user in created_users]
+
+
+def _transfer(fixture, rng):
+    (_, account_ids), (_, to_account_ids) = rng.sample(fixture, 2)
+    return 'post', f'/api/accounts/{account_ids[0]}/transfer/', {
+        'to_account_id': to_account_ids[0], 'amount': '1.00', 'currency': 'THB'
+    }
+
+
+def _deposit(fixture, rng):
+    _, account_ids = rng.choice(fixture)
+    return 'post', f'/api/accounts/{rng.choice(account_ids)}/deposit/', {'amount': '1.00', 'currency': 'THB'}
+
+
+def _transaction_list(fixture, rng):
+    _, account_ids = rng.choice(fixture)
+    return 'get', '/api/transactions/', {'account_id': rng.choice(account_ids)}
+
+
+def _account_list(fixture, rng):
+    return 'get', '/api/accounts/', None
+
+
+# Each scenario builds `(method, path, data)` for one request by a random fixture user.
+SCENARIOS = {
+    'transfer': _transfer,
+    'deposit': _deposit,
+    'transaction_list': _transaction_list,
+    'account_list': _account_list,
+}
+
+
+def percentile(sorted_values, pct):
+    """Linearly interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * pct / 100
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def summarize(latencies, queries, errors, elapsed):
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'ops_per_sec': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_ms': {f'p{pct}': round(percentile(latencies, pct) * 1000, 3) for pct in PERCENTILES},
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+    }
+    result['latency_ms']['max'] = round(latencies[-1] * 1000, 3) if latencies else None
+    return result
+
+
+class _Worker(threading.local):
+    def __init__(self):
+        # Server errors (e.g. lock timeouts under contention) are counted, not raised.
+        self.client = Client(raise_request_exception=False)
+
+
+def run_scenario(name, fixture, requests=500, concurrency=8, warmup=10, seed=0):
+    """
+    Drive one scenario through the real URLconf and views with `concurrency`
+    threads, each with its own test client and database connection.
+    """
+    build = SCENARIOS[name]
+    tokens = {user.id: f'Bearer {RefreshToken.for_user(user).access_token}' for user, _ in fixture}
+    rng = random.Random(seed)
+    # Requests are built up front so the timed section only measures the server side.
+    plan = [(tokens[rng.choice(fixture)[0].id],) + build(fixture, rng) for _ in range(warmup + requests)]
+    worker = _Worker()
+
+    def send(item):
+        token, method, path, data = item
+        client = worker.client
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with ExitStack() as stack:
+            # Every alias, so reads routed to the read-only connection are counted too.
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(count))
+            start = time.perf_counter()
+            if method == 'get':
+                response = client.get(path, data, HTTP_AUTHORIZATION=token)
+            else:
+                response = client.post(path, data, content_type='application/json', HTTP_AUTHORIZATION=token)
+            latency = time.perf_counter() - start
+        return latency, queries[0], response.status_code >= 400
+
+    def run(items):
+        if concurrency <= 1:
+            return [send(item) for item in items]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(send, items))
+            # One close per worker thread: the barrier keeps each thread from taking two.
+            barrier = threading.Barrier(concurrency)
+            list(pool.map(lambda _: (barrier.wait(), connections.close_all()), range(concurrency)))
+        return results
+
+    run(plan[:warmup])
+    start = time.perf_counter()
+    results = run(plan[warmup:])
+    elapsed = time.perf_counter() - start
+
+    # Failed requests often stop early, so only successful ones count towards queries per request.
+    return summarize(
+        [latency for latency, _, _ in results],
+        [queries for _, queries, failed in results if not failed],
+        sum(1 for _, _, failed in results if failed),
+        elapsed,
+    )
+
+
+def run(scenarios=None, users=100, accounts_per_user=2, transactions=10000, requests=500, concurrency=8, warmup=10):
+    fixture = seed(users, accounts_per_user, transactions)
+    report = {
+        'meta': {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'users': users,
+            'accounts_per_user': accounts_per_user,
+            'transactions': transactions,
+            'requests': requests,
+            'concurrency': concurrency,
+        },
+        'scenarios': {},
+    }
+    # The test client sends `Host: testserver`.
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for name in scenarios or SCENARIOS:
+            report['scenarios'][name] = run_scenario(name, fixture, requests, concurrency, warmup)
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Regressions of `report` against `baseline`, as human-readable strings.
+
+    p95 latency and throughput may drift by `tolerance` (a fraction) before they
+    count; queries per request are deterministic, so any increase counts.
+    """
+    regressions = []
+    for name, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        p95, previous_p95 = current['latency_ms']['p95'], previous['latency_ms']['p95']
+        if p95 is not None and previous_p95 and p95 > previous_p95 * (1 + tolerance):
+            regressions.append(f'{name}: p95 latency {p95}ms vs baseline {previous_p95}ms')
+        ops, previous_ops = current['ops_per_sec'], previous['ops_per_sec']
+        if ops is not None and previous_ops and ops < previous_ops * (1 - tolerance):
+            regressions.append(f'{name}: {ops} ops/sec vs baseline {previous_ops} ops/sec')
+        queries, previous_queries = current['queries_per_request'], previous['queries_per_request']
+        if queries is not None and previous_queries is not None and queries > previous_queries:
+            regressions.append(f'{name}: {queries} queries/request vs baseline {previous_queries}')
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def dump(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
@@ -0,0 +1,303 @@
+import csv
+import json
+import os
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+from functools import partial
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import entries, response_cache, rollups, verification
+from .models import CURRENCY_CHOICES, Account, BalanceSnapshot, ImportedWithoutBalance, Transaction, User
+from .shards import shard_totals
+
+# Load order: each kind refers to the ids of the one before it.
+KINDS = ('users', 'accounts', 'transactions')
+FORMATS = ('csv', 'ndjson')
+CURRENCIES = {code for code, _ in CURRENCY_CHOICES}
+TRANSACTION_TYPES = ('deposit', 'withdraw', 'transfer')
+# Passwords per task sent to a hashing worker; each PBKDF2 hash takes a good fraction of a second
+HASH_CHUNK_SIZE = 8
+
+
+class RowError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return 'ndjson' if extension in ('ndjson', 'jsonl') else 'csv'
+
+
+def read_rows(path, format=None):
+    """Yield `(line number, row dict)` from a CSV file with a header row or an NDJSON file."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if (format or file_format(path)) == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    raise RowError(line_number, f'invalid JSON ({e})')
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _value(line, row, name, required=False):
+    value = row.get(name)
+    if value in (None, ''):
+        if required:
+            raise RowError(line, f'{name} is required')
+        return None
+    return value
+
+
+def _int(line, row, name, required=False):
+    value = _value(line, row, name, required)
+    try:
+        return None if value is None else int(value)
+    except (TypeError, ValueError):
+        raise RowError(line, f'{name} is not an integer: {value!r}')
+
+
+def _decimal(line, row, name, required=False):
+    value = _value(line, row, name, required)
+    try:
+        return None if value is None else Decimal(str(value)).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise RowError(line, f'{name} is not a number: {value!r}')
+
+
+def _datetime(line, row, name):
+    value = _value(line, row, name)
+    if value is None:
+        return timezone.now()
+    parsed = parse_datetime(str(value))
+    if parsed is None:
+        raise RowError(line, f'{name} is not an ISO 8601 timestamp: {value!r}')
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+def _currency(line, row, name, default=None):
+    value = _value(line, row, name) or default
+    if value not in CURRENCIES:
+        raise RowError(line, f'unsupported {name}: {value!r}')
+    return value
+
+
+def _flag(row, name, default):
+    value = row.get(name)
+    if value in (None, ''):
+        return default
+    return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+
+
+def _password(line, row):
+    """`(stored hash, None)` for a pre-hashed `password_hash`, `(None, plaintext)` for a `password` to hash."""
+    password_hash = _value(line, row, 'password_hash')
+    if password_hash is not None:
+        try:
+            identify_hasher(password_hash)
+        except ValueError:
+            raise RowError(line, 'password_hash is not in a format Django knows')
+        return password_hash, None
+    # No password at all gets an unusable one, like `create_user(password=None)`.
+    return None, _value(line, row, 'password')
+
+
+def hash_passwords(plaintexts, executor=None):
+    """`make_password` over `plaintexts`, spread across `executor`'s processes when given."""
+    if executor is None:
+        return [make_password(plaintext) for plaintext in plaintexts]
+    return list(executor.map(make_password, plaintexts, chunksize=HASH_CHUNK_SIZE))
+
+
+def build_users(rows, executor=None):
+    users, plaintexts = [], []
+    for line, row in rows:
+        password_hash, plaintext = _password(line, row)
+        users.append(User(
+            id=_int(line, row, 'id', required=True), username=_value(line, row, 'username', required=True),
+            email=row.get('email') or '', first_name=row.get('first_name') or '',
+            last_name=row.get('last_name') or '', is_active=_flag(row, 'is_active', True),
+            date_joined=_datetime(line, row, 'date_joined'), password=password_hash,
+        ))
+        plaintexts.append(plaintext)
+    missing = [i for i, user in enumerate(users) if user.password is None]
+    for i, password_hash in zip(missing, hash_passwords([plaintexts[i] for i in missing], executor)):
+        users[i].password = password_hash
+    return users
+
+
+def build_accounts(rows, executor=None):
+    return [Account(
+        id=_int(line, row, 'id', required=True), user_id=_int(line, row, 'user', required=True),
+        balance=_decimal(line, row, 'balance'), currency=_currency(line, row, 'currency', 'THB'),
+        created_at=_datetime(line, row, 'created_at'),
+    ) for line, row in rows]
+
+
+def build_transactions(rows, executor=None):
+    transactions = []
+    for line, row in rows:
+        transaction_type = _value(line, row, 'transaction_type', required=True)
+        if transaction_type not in TRANSACTION_TYPES:
+            raise RowError(line, f'unsupported transaction_type: {transaction_type!r}')
+        amount = _decimal(line, row, 'amount', required=True)
+        currency = _currency(line, row, 'currency', 'THB')
+        to_account_id = _int(line, row, 'to_account')
+        if (transaction_type == 'transfer') != (to_account_id is not None):
+            raise RowError(line, 'to_account is required for transfers and only for transfers')
+        real_amount = _decimal(line, row, 'real_amount')
+        transactions.append(Transaction(
+            id=_int(line, row, 'id', required=True), account_id=_int(line, row, 'account', required=True),
+            to_account_id=to_account_id, amount=amount, currency=currency,
+            real_amount=amount if real_amount is None else real_amount,
+            real_currency=_currency(line, row, 'real_currency', currency),
+            to_amount=_decimal(line, row, 'to_amount'), transaction_type=transaction_type,
+            created_at=_datetime(line, row, 'created_at'),
+        ))
+    return transactions
+
+
+BUILDERS = {'users': build_users, 'accounts': build_accounts, 'transactions': build_transactions}
+MODELS = {'users': User, 'accounts': Account, 'transactions': Transaction}
+
+
+@contextmanager
+def keeping_created_at():
+    """
+    Let `bulk_create` store the legacy `created_at` of accounts and transactions,
+    which `auto_now_add` would otherwise overwrite. Only for one-off commands:
+    it changes the fields for the whole process.
+    """
+    fields = [model._meta.get_field('created_at') for model in (Account, Transaction)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def load_chunk(kind, rows, executor=None):
+    """
+    Insert one chunk of rows in a single transaction; returns `(inserted, skipped)`.
+
+    Rows keep their legacy ids. Ids already in the table are skipped, so a
+    chunk replayed after a crash (committed, but not yet checkpointed) is harmless.
+    Accounts without a balance start at zero and are marked for `finish_chunk`.
+    """
+    model = MODELS[kind]
+    objects = BUILDERS[kind](rows, executor)
+    with transaction.atomic():
+        existing = set(model.objects.filter(pk__in=[obj.id for obj in objects]).values_list('pk', flat=True))
+        new = [obj for obj in objects if obj.id not in existing]
+        without_balance = [obj for obj in new if kind == 'accounts' and obj.balance is None]
+        for account in without_balance:
+            account.balance = Decimal('0.00')
+        model.objects.bulk_create(new)
+        ImportedWithoutBalance.objects.bulk_create([ImportedWithoutBalance(account_id=account.id)
+                                                    for account in without_balance])
+    return len(new), len(objects) - len(new)
+
+
+def reset_sequences():
+    """Move the id sequences past the imported ids (a no-op on SQLite, which uses the max id)."""
+    statements = connection.ops.sequence_reset_sql(no_style(), list(MODELS.values()))
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def finish_chunk(bounds):
+    """
+    Finish the imported accounts with ids in the inclusive `bounds` range; returns how many there were.
+
+    Imported accounts are the ones without an opening snapshot. A supplied
+    balance wins: the opening balance is that balance less the net of the
+    imported history. An account imported without one opens at zero instead,
+    and its balance becomes the net of its history. They also get their ledger
+    entries and rollups. The accounts stay locked throughout, and a finished
+    account gets its snapshot, so a rerun skips it.
+    """
+    low, high = bounds
+    with transaction.atomic():
+        accounts = list(Account.objects.select_for_update().filter(pk__gte=low, pk__lte=high)
+                        .only('id', 'balance', 'currency', 'shard_count', 'created_at').order_by('pk'))
+        ids = [account.id for account in accounts]
+        opened = set(BalanceSnapshot.objects.filter(account_id__in=ids, last_transaction_id__isnull=True)
+                     .values_list('account_id', flat=True))
+        pending = [account for account in accounts if account.id not in opened]
+        if not pending:
+            return 0
+
+        pending_ids = [account.id for account in pending]
+        changes = verification.net_changes({'in': pending_ids})
+        derived = set(ImportedWithoutBalance.objects.filter(account_id__in=pending_ids)
+                      .values_list('account_id', flat=True))
+        for account in pending:
+            if account.id in derived:
+                account.balance = changes.get(account.id, Decimal(0))
+        totals = shard_totals([account.id for account in pending if account.shard_count], lock=True)
+        balances = {account.id: account.balance + totals.get(account.id, 0) for account in pending}
+        _, sequences = entries.rebuild(pending, balances)
+        for account in pending:
+            account.entry_count = sequences[account.id]
+        Account.objects.bulk_update(pending, ['balance', 'entry_count'])
+        ImportedWithoutBalance.objects.filter(account_id__in=derived).delete()
+        rollups.rebuild(account_ids=pending_ids)
+
+        BalanceSnapshot.objects.bulk_create([
+            BalanceSnapshot(account_id=account.id, as_of=account.created_at, last_transaction_id=None,
+                            balance=balances[account.id] - changes.get(account.id, 0))
+            for account in pending
+        ])
+        transaction.on_commit(partial(response_cache.bump, pending_ids))
+    return len(pending)
+
+
+class Progress:
+    """
+    Input rows already loaded per kind, kept in a JSON file so an interrupted
+    import resumes after them. Each write replaces the file atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.rows = json.load(f)
+
+    def done(self, kind):
+        return self.rows.get(kind, 0)
+
+    def record(self, kind, rows):
+        self.rows[kind] = rows
+        if not self.path:
+            return
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.rows, f)
+        os.replace(temporary, self.path)
@@ -0,0 +1,83 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_read_database = contextvars.ContextVar('read_database', default=None)
+_pinned_to_primary = contextvars.ContextVar('pinned_to_primary', default=False)
+
+
+def read_only_database():
+    """Alias of the read-only connection, or None when it is not configured."""
+    alias = getattr(settings, 'READ_ONLY_DATABASE', None)
+    return alias if alias in connections.settings else None
+
+
+def is_read_only(alias):
+    return alias is not None and alias == read_only_database()
+
+
+@contextmanager
+def reading_from(alias):
+    """Route reads made in this context (thread or task) to `alias`; see `ReadOnlyRouter`."""
+    token = _read_database.set(alias)
+    try:
+        yield
+    finally:
+        _read_database.reset(token)
+
+
+@contextmanager
+def pinned_to_primary():
+    """Keep every read in this context on the default database, whatever `reading_from` asks for."""
+    token = _pinned_to_primary.set(True)
+    try:
+        yield
+    finally:
+        _pinned_to_primary.reset(token)
+
+
+def is_pinned_to_primary():
+    return _pinned_to_primary.get()
+
+
+class ReadOnlyRouter:
+    """
+    Sends reads made inside `reading_from(alias)` to `alias`; everything else,
+    and every write, stays on the default database.
+
+    Reads made while the default connection is inside a transaction stay there
+    too, so a transaction always sees its own uncommitted writes, and so do
+    reads under `pinned_to_primary()` (see `middleware.ReadYourWritesMiddleware`).
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = _read_database.get()
+        if alias is None or is_pinned_to_primary() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return not is_read_only(db)
+
+
+def configure_sqlite(connection):
+    """Apply `SQLITE_PRAGMAS` to a new SQLite connection (run from `connection_created`)."""
+    if connection.vendor != 'sqlite':
+        return
+    read_only = is_read_only(connection.alias)
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            if read_only and pragma == 'journal_mode':
+                # Changing the journal mode is a write; the primary connection sets it for the file.
+                continue
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
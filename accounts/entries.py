@@ -0,0 +1,76 @@
+from decimal import Decimal
+
+from django.db.models import Q
+
+from . import archive, convert
+from .models import BalanceShard, LedgerEntry
+
+
+def entry(txn, account, amount, shard=0, sequence=None):
+    """
+    Unsaved entry for `account`'s side of `txn`, written by the ledger under the account's lock,
+    or for a credit to balance shard `shard` under that shard's lock, with the shard's `sequence`.
+
+    `account.balance` and `account.entry_count` must already include the entry;
+    sharded accounts get no running balance.
+    """
+    if shard:
+        return LedgerEntry(transaction_id=txn.id, account_id=account.id, amount=amount, shard=shard,
+                           sequence=sequence, created_at=txn.created_at)
+    return LedgerEntry(transaction_id=txn.id, account_id=account.id, amount=amount, sequence=account.entry_count,
+                       balance=None if account.shard_count else account.balance, created_at=txn.created_at)
+
+
+def sides(txn, currencies):
+    """`(account id, signed amount)` for each side of a stored transaction, in its account's currency."""
+    if txn.transaction_type == 'deposit':
+        return [(txn.account_id, txn.amount)]
+    if txn.transaction_type == 'withdraw':
+        return [(txn.account_id, -txn.amount)]
+    to_amount = txn.to_amount
+    if to_amount is None and txn.to_account_id in currencies:
+        # Transfers written before `to_amount` was recorded are converted at today's rate.
+        to_amount = convert(txn.real_currency, currencies[txn.to_account_id], txn.real_amount).quantize(Decimal('0.01'))
+    credited = [(txn.to_account_id, to_amount)] if txn.to_account_id is not None else []
+    return [(txn.account_id, -txn.amount)] + credited
+
+
+def rebuild(accounts, balances):
+    """
+    Rewrite the ledger entries of locked `accounts` from their transaction history, archived transactions included.
+
+    `balances` holds each account's current total balance; the opening balance
+    the running balances start from is whatever the history does not explain.
+    Every entry is numbered on the account row, so the balance shards' counters
+    start over. Returns the number of entries written and each account's last sequence.
+    """
+    ids = {account.id for account in accounts}
+    LedgerEntry.objects.filter(account_id__in=ids).delete()
+    BalanceShard.objects.filter(account_id__in=ids).update(entry_count=0)
+    currencies = {account.id: account.currency for account in accounts}
+    history = sorted((txn for model in archive.history_models()
+                      for txn in model.objects.filter(Q(account_id__in=ids) | Q(to_account_id__in=ids))
+                      .select_related('to_account')), key=lambda txn: (txn.created_at, txn.id))
+    for txn in history:
+        # A counterparty that is gone (deleted after the row was written) is never one of `ids`.
+        if txn.to_account is not None:
+            currencies.setdefault(txn.to_account_id, txn.to_account.currency)
+
+    changes = [(txn, account_id, amount) for txn in history for account_id, amount in sides(txn, currencies)
+               if account_id in ids]
+    running = dict(balances)
+    for _, account_id, amount in changes:
+        running[account_id] -= amount
+
+    sharded = {account.id for account in accounts if account.shard_count}
+    sequences = dict.fromkeys(ids, 0)
+    entries = []
+    for txn, account_id, amount in changes:
+        running[account_id] += amount
+        sequences[account_id] += 1
+        entries.append(LedgerEntry(transaction_id=txn.id, account_id=account_id, amount=amount,
+                                   sequence=sequences[account_id],
+                                   balance=None if account_id in sharded else running[account_id],
+                                   created_at=txn.created_at))
+    LedgerEntry.objects.bulk_create(entries, batch_size=500)
+    return len(entries), sequences
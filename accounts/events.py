@@ -0,0 +1,158 @@
+import asyncio
+import json
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Max, Q
+
+from .models import LedgerEntry
+from .serializers import LedgerEntrySerializer
+
+LAST_EVENT_ID_HEADER = 'Last-Event-ID'
+# Entries read per query; a listener that is further behind reads again straight away
+EVENTS_PAGE_SIZE = 100
+
+
+def keepalive_interval():
+    return getattr(settings, 'EVENTS_KEEPALIVE', 15)
+
+
+def long_poll_timeout():
+    return getattr(settings, 'EVENTS_LONG_POLL_TIMEOUT', 25)
+
+
+class Broker:
+    """
+    In-process pub/sub of account activity. Postings publish their accounts
+    once they commit (see `ledger`), which wakes every listener of those
+    accounts; a listener costs an idle `asyncio.Event` until then.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    @contextmanager
+    def listening(self, account_id):
+        """An `asyncio.Event` of the running loop, set whenever `account_id` has new activity."""
+        listener = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._listeners.setdefault(account_id, set()).add(listener)
+        try:
+            yield listener[1]
+        finally:
+            with self._lock:
+                listeners = self._listeners[account_id]
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[account_id]
+
+    def publish(self, account_ids):
+        # Called from writer threads: each listener's loop sets its own event.
+        with self._lock:
+            listeners = [listener for account_id in account_ids for listener in self._listeners.get(account_id, ())]
+        for loop, event in listeners:
+            loop.call_soon_threadsafe(event.set)
+
+    def listener_count(self, account_id):
+        with self._lock:
+            return len(self._listeners.get(account_id, ()))
+
+
+broker = Broker()
+
+
+def parse_position(value):
+    """
+    A feed position from a `Last-Event-ID`: `shard:sequence` pairs joined by
+    commas, e.g. `0:12,3:7`. None if it is malformed.
+    """
+    position = {}
+    for pair in value.split(','):
+        shard, _, sequence = pair.partition(':')
+        if not (shard.isdigit() and sequence.isdigit()):
+            return None
+        position[int(shard)] = int(sequence)
+    return position
+
+
+def format_position(position):
+    return ','.join(f'{shard}:{sequence}' for shard, sequence in sorted(position.items()))
+
+
+def advance(position, events):
+    """`position` moved past `events`."""
+    position = dict(position)
+    for event in events:
+        position[event['shard']] = event['sequence']
+    return position
+
+
+async def latest_position(account_id):
+    rows = LedgerEntry.objects.filter(account_id=account_id).values('shard').annotate(
+        last=Max('sequence')).values_list('shard', 'last')
+    return {0: 0, **{shard: last async for shard, last in rows}}
+
+
+async def events_after(account_id, position):
+    """
+    The account's ledger entries past `position`, serialized, in id order.
+
+    Ids are not commit order: a credit to one balance shard can take an id
+    before one to another shard and commit after it. Each lock an account
+    posts under (its row, or one of its balance shards) does number its
+    entries in commit order, though, so a position holds the last sequence seen
+    for each (see `LedgerEntry.shard`). Under one lock ids follow the
+    sequence, so cutting a page short never skips an entry.
+    """
+    unseen = ~Q(shard__in=list(position))
+    for shard, sequence in position.items():
+        unseen |= Q(shard=shard, sequence__gt=sequence)
+    rows = LedgerEntry.objects.filter(unseen, account_id=account_id).order_by('id').values(
+        *LedgerEntrySerializer.source_attributes())[:EVENTS_PAGE_SIZE]
+    return LedgerEntrySerializer([row async for row in rows], many=True).data
+
+
+async def wait_for_events(account_id, position, timeout):
+    """Entries past `position`, waiting up to `timeout` seconds for the first; empty if none came."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    with broker.listening(account_id) as woken:
+        while True:
+            # Cleared before reading, so a posting committed during the read still wakes the wait.
+            woken.clear()
+            events = await events_after(account_id, position)
+            remaining = deadline - loop.time()
+            if events or remaining <= 0:
+                return events
+            try:
+                await asyncio.wait_for(woken.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+def format_event(event, position):
+    return f'id: {format_position(position)}\nevent: entry\ndata: {json.dumps(event)}\n\n'
+
+
+async def stream(account_id, position):
+    """
+    Server-sent events for the account's entries past `position`, until the client goes away.
+
+    Each event's id is the position after it. Between events the stream sends
+    a comment every `EVENTS_KEEPALIVE` seconds and reads once more, which also
+    picks up postings committed by other worker processes, whose publishes
+    never reach this one.
+    """
+    yield f'retry: {keepalive_interval() * 1000}\n\n'
+    while True:
+        events = await wait_for_events(account_id, position, keepalive_interval())
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        chunk = []
+        for event in events:
+            position = advance(position, [event])
+            chunk.append(format_event(event, position))
+        yield ''.join(chunk)
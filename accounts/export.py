@@ -0,0 +1,73 @@
+import csv
+import json
+from datetime import datetime
+
+from rest_framework.renderers import BaseRenderer
+
+from .serializers import format_datetime
+
+# Column names follow TransactionSerializer so exports line up with the list endpoint.
+EXPORT_COLUMNS = (
+    'id', 'account', 'to_account', 'amount', 'currency', 'real_amount', 'real_currency', 'to_amount',
+    'transaction_type', 'created_at',
+)
+EXPORT_FIELDS = (
+    'id', 'account_id', 'to_account_id', 'amount', 'currency', 'real_amount', 'real_currency', 'to_amount',
+    'transaction_type', 'created_at',
+)
+EXPORT_CHUNK_SIZE = 2000
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only reached for error responses; exports stream their own rows.
+        return json.dumps(data).encode(self.charset) + b'\n'
+
+
+class CSVRenderer(NDJSONRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+def _format_value(value):
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    return str(value)
+
+
+def _format_row(row):
+    return [_format_value(value) for value in row]
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, _format_row(row)))) + '\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(_format_row(row))
+
+
+STREAMERS = {
+    'ndjson': stream_ndjson,
+    'csv': stream_csv,
+}
+
+
+def export_rows(queryset):
+    """Walk the queryset with a server-side iterator, yielding value tuples in `EXPORT_FIELDS` order."""
+    return queryset.order_by('created_at', 'id').values_list(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
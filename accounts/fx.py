@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import USD_TO_THB_RATE, profiling
+
+RATES_VERSION_CACHE_KEY = 'accounts:fx-rates-version'
+
+# Local stub feed used when no other provider knows a currency. Units per 1 USD.
+STUB_RATES = {
+    'USD': Decimal('1'),
+    'THB': Decimal(USD_TO_THB_RATE),
+    'EUR': Decimal('0.92'),
+    'GBP': Decimal('0.79'),
+    'JPY': Decimal('150'),
+    'CNY': Decimal('7.2'),
+    'SGD': Decimal('1.35'),
+    'HKD': Decimal('7.8'),
+    'AUD': Decimal('1.5'),
+}
+STUB_BASE_CURRENCY = 'USD'
+
+
+class UnknownCurrency(ValueError):
+    pass
+
+
+def base_currency():
+    return getattr(settings, 'FX_BASE_CURRENCY', 'USD')
+
+
+def rebase(rates, from_base, to_base):
+    """Re-express a `{currency: units per from_base}` table in units per `to_base`."""
+    if from_base == to_base:
+        return dict(rates)
+    if to_base not in rates:
+        raise UnknownCurrency(to_base)
+    pivot = rates[to_base]
+    return {currency: rate / pivot for currency, rate in rates.items()}
+
+
+class RateProvider:
+    """
+    Source of FX rates. `get_rates()` returns `(rates, valid_until)` where `rates`
+    maps currency codes to units per one unit of the base currency and
+    `valid_until` is when the table is next known to change (or None).
+    """
+
+    def get_rates(self):
+        raise NotImplementedError
+
+
+class StaticRateProvider(RateProvider):
+    def __init__(self, rates=None, base=STUB_BASE_CURRENCY):
+        self.rates = STUB_RATES if rates is None else rates
+        self.base = base
+
+    def get_rates(self):
+        return rebase(self.rates, self.base, base_currency()), None
+
+
+class FileRateProvider(RateProvider):
+    """Reads `{"base": "USD", "rates": {"THB": "30", ...}}` from `settings.FX_RATE_FILE`."""
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'FX_RATE_FILE', None)
+
+    def get_rates(self):
+        if not self.path:
+            return {}, None
+        with open(self.path) as f:
+            data = json.load(f)
+        base = data.get('base', STUB_BASE_CURRENCY)
+        rates = {currency: Decimal(str(rate)) for currency, rate in data['rates'].items()}
+        rates.setdefault(base, Decimal('1'))
+        return rebase(rates, base, base_currency()), None
+
+
+class DatabaseRateProvider(RateProvider):
+    """Latest `FxRate` per currency that is already effective."""
+
+    def get_rates(self):
+        from .models import FxRate
+
+        now = timezone.now()
+        rates = {}
+        for currency, rate in (FxRate.objects.filter(effective_at__lte=now)
+                               .order_by('currency', '-effective_at', '-id')
+                               .values_list('currency', 'rate')):
+            rates.setdefault(currency, rate)
+        if rates:
+            rates.setdefault(base_currency(), Decimal('1'))
+        valid_until = FxRate.objects.filter(effective_at__gt=now).aggregate(next_change=Min('effective_at'))['next_change']
+        return rates, valid_until
+
+
+class RateCache:
+    """
+    In-process rate table shared by every conversion.
+
+    Lookups are a dict access. The table is reloaded from the providers when the
+    TTL has passed and the shared version (bumped by `invalidate()` whenever an
+    `FxRate` changes) moved, or when a scheduled rate becomes effective; neither
+    check touches the database.
+    """
+
+    def __init__(self, providers=None, ttl=None):
+        self._providers = providers
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._rates = None
+        self._version = None
+        self._expires_at = 0.0
+        self._valid_until = None
+
+    @property
+    def providers(self):
+        if self._providers is None:
+            paths = getattr(settings, 'FX_RATE_PROVIDERS', ['accounts.fx.StaticRateProvider'])
+            self._providers = [import_string(path)() for path in paths]
+        return self._providers
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else getattr(settings, 'FX_RATE_CACHE_TTL', 60)
+
+    def rates(self):
+        if self._rates is not None and time.monotonic() < self._expires_at:
+            return self._rates
+        with self._lock:
+            now = time.monotonic()
+            if self._rates is None or now >= self._expires_at:
+                version = cache.get_or_set(RATES_VERSION_CACHE_KEY, 1, timeout=None)
+                scheduled_change = self._valid_until is not None and timezone.now() >= self._valid_until
+                if self._rates is None or version != self._version or scheduled_change:
+                    self._load(version)
+                self._expires_at = now + self.ttl
+        return self._rates
+
+    def _load(self, version):
+        rates = {}
+        valid_until = None
+        # Earlier providers win; later ones only fill in missing currencies.
+        for provider in self.providers:
+            provider_rates, provider_valid_until = provider.get_rates()
+            for currency, rate in provider_rates.items():
+                rates.setdefault(currency, rate)
+            if provider_valid_until is not None and (valid_until is None or provider_valid_until < valid_until):
+                valid_until = provider_valid_until
+        self._rates = rates
+        self._version = version
+        self._valid_until = valid_until
+
+    def invalidate(self):
+        try:
+            cache.incr(RATES_VERSION_CACHE_KEY)
+        except ValueError:
+            cache.set(RATES_VERSION_CACHE_KEY, 1, timeout=None)
+        with self._lock:
+            self._rates = None
+            self._expires_at = 0.0
+
+    def rate(self, currency, target_currency):
+        rates = self.rates()
+        try:
+            return rates[target_currency] / rates[currency]
+        except KeyError as e:
+            raise UnknownCurrency(e.args[0])
+
+    def convert(self, currency, target_currency, amount: Decimal) -> Decimal:
+        if currency == target_currency:
+            return amount
+        with profiling.timed('fx'):
+            rates = self.rates()
+            try:
+                # Multiply before dividing so A -> B -> A round-trips exactly.
+                return amount * rates[target_currency] / rates[currency]
+            except KeyError as e:
+                raise UnknownCurrency(e.args[0])
+
+
+rate_cache = RateCache()
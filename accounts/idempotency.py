@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import journal
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+POLL_INTERVAL = 0.05
+
+# Requests being processed by this process, so local duplicates can block on an
+# Event instead of polling the database.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _request_hash(method, path, data):
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{method} {path}\n{payload}'.encode()).hexdigest()
+
+
+def purge_expired(now=None):
+    """Delete keys older than `IDEMPOTENCY_KEY_TTL`; returns the number removed."""
+    now = now or timezone.now()
+    cutoff = now - _setting('IDEMPOTENCY_KEY_TTL', timedelta(hours=24))
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
+
+
+def _is_stale(record, now):
+    if now - record.created_at > _setting('IDEMPOTENCY_KEY_TTL', timedelta(hours=24)):
+        return True
+    # A request that never finished (e.g. the worker died) gives up its claim.
+    return not record.is_complete and now - record.created_at > _setting('IDEMPOTENCY_LOCK_TIMEOUT',
+                                                                         timedelta(seconds=30))
+
+
+def _claim(user, key, request_path, request_hash):
+    """Return `(record, created)`; `created` means this request owns the key."""
+    while True:
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    user_id=user.id, key=key, request_path=request_path, request_hash=request_hash
+                ), True
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(user_id=user.id, key=key).first()
+        if record is None:
+            continue
+        if _is_stale(record, timezone.now()):
+            IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at).delete()
+            continue
+        return record, False
+
+
+def _wait_for(record):
+    deadline = time.monotonic() + _setting('IDEMPOTENCY_WAIT_TIMEOUT', timedelta(seconds=10)).total_seconds()
+    while not record.is_complete:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return record
+        event = _in_flight.get((record.user_id, record.key))
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(min(POLL_INTERVAL, remaining))
+        refreshed = IdempotencyKey.objects.filter(pk=record.pk).first()
+        if refreshed is None:
+            # The original request failed and released the key.
+            return None
+        record = refreshed
+    return record
+
+
+def _replay(record):
+    if record is None:
+        return Response({'status': 'original request failed, retry with the same key'},
+                        status=status.HTTP_409_CONFLICT)
+    if not record.is_complete:
+        return Response({'status': 'a request with this idempotency key is still in progress'},
+                        status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+    return Response(record.response_body, status=record.response_status, headers={'Idempotent-Replayed': 'true'})
+
+
+def _store(record, response):
+    if response.status_code < 500:
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            response_status=response.status_code, response_body=response.data
+        )
+
+
+def execute(user, key, method, path, data, handler):
+    """
+    Run `handler()` (which returns a DRF `Response`) at most once per `(user, key)`.
+
+    The first request with a key claims it and its response is stored in the
+    same transaction as the posting (with `LEDGER_JOURNAL`, just after it
+    commits); repeats get the stored response without touching any account,
+    and duplicates arriving while the first is still running wait for it to
+    finish.
+    """
+    if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        return Response({'status': 'idempotency key is too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+    request_hash = _request_hash(method, path, data)
+    record, created = _claim(user, key, path, request_hash)
+    if not created:
+        if record.request_hash != request_hash:
+            return Response({'status': 'idempotency key already used for a different request'},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        return _replay(_wait_for(record))
+
+    event = threading.Event()
+    with _in_flight_lock:
+        _in_flight[(record.user_id, key)] = event
+    try:
+        if journal.enabled():
+            # The journal writer commits the posting from its own thread and needs SQLite's write lock,
+            # which a transaction open here would hold; the response is stored once the posting is in.
+            response = handler()
+            _store(record, response)
+        else:
+            with transaction.atomic():
+                response = handler()
+                _store(record, response)
+        if response.status_code >= 500:
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+    except Exception:
+        IdempotencyKey.objects.filter(pk=record.pk).delete()
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop((record.user_id, key), None)
+        event.set()
+    return response
+
+
+def idempotent(view_method):
+    """
+    Make a viewset action safe to retry with an `Idempotency-Key` header (see
+    `execute`). Requests without the header are unaffected.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        return execute(request.user, key, request.method, request.path, request.data,
+                       lambda: view_method(self, request, *args, **kwargs))
+
+    return wrapper
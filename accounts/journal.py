@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from . import ledger
+
+
+def enabled():
+    return getattr(settings, 'LEDGER_JOURNAL', False)
+
+
+class _Entry:
+    __slots__ = ('posting', 'result', 'done')
+
+    def __init__(self, posting):
+        self.posting = posting
+        self.result = None
+        self.done = threading.Event()
+
+
+class Journal:
+    """
+    Write-behind queue for single postings with group commit.
+
+    Callers block in `submit()` while a background writer drains the queue every
+    `LEDGER_JOURNAL_MAX_DELAY` seconds or `LEDGER_JOURNAL_MAX_BATCH` postings,
+    whichever comes first, and applies the whole group with `ledger.post_many`
+    in one transaction. Each caller is released once that transaction has
+    committed, so a returned posting is as durable as an individually committed
+    one but the commit (and its fsync) is shared by the group.
+    """
+
+    def __init__(self, max_batch=None, max_delay=None):
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+
+    @property
+    def max_batch(self):
+        return self._max_batch if self._max_batch is not None else getattr(settings, 'LEDGER_JOURNAL_MAX_BATCH', 500)
+
+    @property
+    def max_delay(self):
+        return self._max_delay if self._max_delay is not None else getattr(settings, 'LEDGER_JOURNAL_MAX_DELAY', 0.005)
+
+    def submit(self, transaction_type, account_id, to_account_id, amount, currency):
+        """Queue one posting and wait for its group to commit; returns the `Transaction` or raises."""
+        # Bad ids fail here, in the caller, rather than failing the whole group.
+        to_account_id = int(to_account_id) if to_account_id is not None else None
+        entry = _Entry((transaction_type, int(account_id), to_account_id, amount, currency))
+        self._start()
+        self._queue.put(entry)
+        entry.done.wait()
+        if isinstance(entry.result, Exception):
+            raise entry.result
+        return entry.result
+
+    def _start(self):
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._run, name='ledger-journal', daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(group) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(group)
+
+    def _flush(self, group):
+        try:
+            results = ledger.post_many([entry.posting for entry in group])
+        except Exception as e:
+            # Nothing in the group was written (e.g. the connection dropped); start the next one afresh.
+            results = [e] * len(group)
+            connection.close()
+        for entry, result in zip(group, results):
+            entry.result = result
+            entry.done.set()
+
+
+journal = Journal()
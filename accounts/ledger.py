@@ -0,0 +1,510 @@
+import random
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import partial
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+
+from . import convert, entries, events, response_cache, rollups, shards, snapshots
+from .fx import UnknownCurrency
+from .models import CURRENCY_CHOICES, Account, BalanceShard, BalanceSnapshot, LedgerEntry, Transaction
+
+CENT = Decimal('0.01')
+
+
+class LedgerError(Exception):
+    message = 'ledger error'
+
+    def __init__(self, message=None):
+        super().__init__(message or self.message)
+        self.message = message or self.message
+
+
+class InsufficientFunds(LedgerError):
+    message = 'insufficient funds'
+
+
+class SameAccountTransfer(LedgerError):
+    message = 'cannot transfer to the same account'
+
+
+class UnsupportedCurrency(LedgerError):
+    message = 'unsupported currency'
+
+
+class InvalidAmount(LedgerError):
+    message = 'amount must be positive'
+
+
+class InvalidAccount(LedgerError):
+    message = 'to_account_id must be an account id'
+
+
+CURRENCIES = {code for code, _ in CURRENCY_CHOICES}
+# Account columns every posting reads from the locked rows
+POSTING_FIELDS = ('id', 'currency', 'balance', 'postings_since_snapshot', 'shard_count', 'entry_count')
+
+
+def to_cents(amount: Decimal) -> Decimal:
+    return amount.quantize(CENT, rounding=ROUND_HALF_EVEN)
+
+
+def parse_amount(value) -> Decimal:
+    """A posting amount from client input: a finite number above zero, in cents. Raises `InvalidAmount`."""
+    try:
+        amount = Decimal(str(value))
+    except ArithmeticError:
+        raise InvalidAmount()
+    if not amount.is_finite() or amount <= 0:
+        raise InvalidAmount()
+    amount = to_cents(amount)
+    # Fractions of a cent round away to nothing
+    if amount <= 0:
+        raise InvalidAmount()
+    return amount
+
+
+def parse_account_id(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidAccount()
+
+
+def convert_to(currency: str, target_currency: str, amount: Decimal) -> Decimal:
+    if currency not in CURRENCIES:
+        raise UnsupportedCurrency()
+    if currency == target_currency:
+        return to_cents(amount)
+    try:
+        return to_cents(convert(currency, target_currency, amount))
+    except UnknownCurrency:
+        raise UnsupportedCurrency()
+
+
+def lock_accounts(*account_ids, credit_only=()):
+    """
+    Lock the given accounts in ascending id order and return them keyed by id.
+
+    Every posting takes its row locks through here, so two transfers touching the
+    same pair of accounts always queue in the same order and cannot deadlock.
+    Accounts in `credit_only` are read without a lock when they are sharded:
+    their credits only lock a balance shard (see `_credit`).
+    Raises `Account.DoesNotExist` if any id is unknown.
+    """
+    ids = sorted({int(account_id) for account_id in account_ids})
+    credit_ids = sorted({int(account_id) for account_id in credit_only} - set(ids))
+    queryset = Account.objects.only(*POSTING_FIELDS).order_by('pk')
+    locked = Q(pk__in=ids) | Q(pk__in=credit_ids, shard_count=0) if credit_ids else Q(pk__in=ids)
+    accounts = {account.id: account for account in queryset.select_for_update().filter(locked)}
+    unlocked = [account_id for account_id in credit_ids if account_id not in accounts]
+    if unlocked:
+        accounts.update((account.id, account) for account in queryset.filter(pk__in=unlocked))
+    if len(accounts) != len(ids) + len(credit_ids):
+        raise Account.DoesNotExist('Account matching query does not exist.')
+    return accounts
+
+
+def _post(account, delta, debit=False):
+    """
+    Apply `delta` to a locked account's balance and posting counters in one UPDATE.
+
+    Returns True when the posting should end in a balance snapshot; the locked
+    instance's balance and entry sequence are advanced so the snapshot and the
+    ledger entry can be written without a read.
+    Once the posting commits, the account's response-cache generation moves on
+    and its event listeners wake (see `_on_commit`).
+    """
+    due = snapshots.snapshot_due(account)
+    queryset = Account.objects.filter(pk=account.id)
+    if debit:
+        # The balance check and the update are one statement, so even backends
+        # without row locks (SQLite) can never overdraw or lose an update.
+        queryset = queryset.filter(balance__gte=-delta)
+    updated = queryset.update(
+        balance=F('balance') + delta,
+        postings_since_snapshot=0 if due else F('postings_since_snapshot') + 1,
+        entry_count=F('entry_count') + 1,
+    )
+    if not updated:
+        raise InsufficientFunds()
+    account.balance += delta
+    account.entry_count += 1
+    _on_commit([account.id])
+    return due
+
+
+def _on_commit(account_ids):
+    """Once the posting commits, move the accounts' response-cache generations on and wake their event listeners."""
+    transaction.on_commit(partial(response_cache.bump, account_ids))
+    transaction.on_commit(partial(events.broker.publish, account_ids))
+
+
+def _credit(account, amount):
+    """
+    Credit an account from `lock_accounts`; returns `(snapshot due, shard, shard's entry sequence)`.
+
+    A sharded account gets the amount on one balance shard picked at random, so
+    concurrent credits only queue when they pick the same shard. The shard
+    numbers its own entries, under its own lock (shard 0 is the account row).
+    """
+    if account.shard_count:
+        shard = random.randint(1, account.shard_count)
+        shard_queryset = BalanceShard.objects.filter(account_id=account.id, shard=shard)
+        if shard_queryset.update(balance=F('balance') + amount, entry_count=F('entry_count') + 1):
+            _on_commit([account.id])
+            return False, shard, shard_queryset.values_list('entry_count', flat=True).get()
+        # Resharded since it was read: credit the account row under its lock instead.
+        locked = lock_accounts(account.id)[account.id]
+        for field in POSTING_FIELDS:
+            setattr(account, field, getattr(locked, field))
+    return _post(account, amount), 0, None
+
+
+def _debit(account, amount):
+    """
+    Debit a locked account; returns True when the posting should end in a snapshot.
+
+    A sharded account spends its own row's balance first, then locks its balance
+    shards one at a time, in order, until the amount is covered.
+    """
+    if not account.shard_count:
+        return _post(account, -amount, debit=True)
+
+    needed = amount - account.balance
+    for shard in range(1, account.shard_count + 1):
+        if needed <= 0:
+            break
+        shard_queryset = BalanceShard.objects.filter(account_id=account.id, shard=shard)
+        balance = next(iter(shard_queryset.select_for_update().values_list('balance', flat=True)), Decimal(0))
+        taken = min(balance, needed)
+        if taken > 0:
+            shard_queryset.update(balance=F('balance') - taken)
+            needed -= taken
+    if needed > 0:
+        raise InsufficientFunds()
+
+    account.balance = max(account.balance - amount, Decimal(0))
+    Account.objects.filter(pk=account.id).update(balance=account.balance, entry_count=F('entry_count') + 1,
+                                                 postings_since_snapshot=F('postings_since_snapshot') + 1)
+    account.entry_count += 1
+    _on_commit([account.id])
+    return False
+
+
+def _journal():
+    # Imported lazily: the journal module imports this one.
+    from . import journal
+    return journal.journal if journal.enabled() else None
+
+
+def deposit(account_id, amount: Decimal, currency: str = 'THB') -> Transaction:
+    amount = parse_amount(amount)
+    journal = _journal()
+    if journal is not None:
+        return journal.submit('deposit', account_id, None, amount, currency)
+
+    with transaction.atomic():
+        account = lock_accounts(credit_only=[account_id])[int(account_id)]
+        converted_amount = convert_to(currency, account.currency, amount)
+        snapshot_due, shard, sequence = _credit(account, converted_amount)
+
+        # Save transaction as incoming currency
+        txn = Transaction.objects.create(
+            account=account,
+            amount=converted_amount,
+            currency=account.currency,
+            real_amount=amount,
+            real_currency=currency,
+            transaction_type='deposit'
+        )
+        entries.entry(txn, account, converted_amount, shard, sequence).save()
+        if snapshot_due:
+            snapshots.record_snapshot(account, account.balance, txn)
+        rollups.record([txn], {account.id: shard})
+        return txn
+
+
+def withdraw(account_id, amount: Decimal, currency: str = 'THB') -> Transaction:
+    amount = parse_amount(amount)
+    journal = _journal()
+    if journal is not None:
+        return journal.submit('withdraw', account_id, None, amount, currency)
+
+    with transaction.atomic():
+        account = lock_accounts(account_id)[int(account_id)]
+        converted_amount = convert_to(currency, account.currency, amount)
+        snapshot_due = _debit(account, converted_amount)
+
+        txn = Transaction.objects.create(
+            account=account,
+            amount=converted_amount,
+            currency=account.currency,
+            real_amount=amount,
+            real_currency=currency,
+            transaction_type='withdraw'
+        )
+        entries.entry(txn, account, -converted_amount).save()
+        if snapshot_due:
+            snapshots.record_snapshot(account, account.balance, txn)
+        rollups.record([txn])
+        return txn
+
+
+def transfer(from_account_id, to_account_id, amount: Decimal, currency: str = 'THB') -> Transaction:
+    amount = parse_amount(amount)
+    to_account_id = parse_account_id(to_account_id)
+    if int(from_account_id) == to_account_id:
+        raise SameAccountTransfer()
+
+    journal = _journal()
+    if journal is not None:
+        return journal.submit('transfer', from_account_id, to_account_id, amount, currency)
+
+    with transaction.atomic():
+        accounts = lock_accounts(from_account_id, credit_only=[to_account_id])
+        from_account = accounts[int(from_account_id)]
+        to_account = accounts[int(to_account_id)]
+
+        amount_in_from_currency = convert_to(currency, from_account.currency, amount)
+        amount_in_to_currency = convert_to(currency, to_account.currency, amount)
+
+        # Balance shards are locked in account id order too, after every account row.
+        if to_account.id < from_account.id:
+            to_snapshot_due, shard, sequence = _credit(to_account, amount_in_to_currency)
+            from_snapshot_due = _debit(from_account, amount_in_from_currency)
+        else:
+            from_snapshot_due = _debit(from_account, amount_in_from_currency)
+            to_snapshot_due, shard, sequence = _credit(to_account, amount_in_to_currency)
+
+        txn = Transaction.objects.create(
+            account=from_account,
+            to_account=to_account,
+            amount=amount_in_from_currency,
+            currency=from_account.currency,
+            real_amount=amount,
+            real_currency=currency,
+            to_amount=amount_in_to_currency,
+            transaction_type='transfer'
+        )
+        LedgerEntry.objects.bulk_create([entries.entry(txn, from_account, -amount_in_from_currency),
+                                         entries.entry(txn, to_account, amount_in_to_currency, shard, sequence)])
+        if from_snapshot_due:
+            snapshots.record_snapshot(from_account, from_account.balance, txn)
+        if to_snapshot_due:
+            snapshots.record_snapshot(to_account, to_account.balance, txn)
+        rollups.record([txn], {to_account.id: shard})
+        return txn
+
+
+BATCH_TRANSFER_MAX_ITEMS = 10000
+# Keeps every IN (...) list under SQLite's bound-parameter limit.
+LOCK_CHUNK_SIZE = 500
+
+
+def _parse_batch_item(item):
+    try:
+        from_id = int(item['from'])
+        to_id = int(item['to'])
+        amount = item['amount']
+    except (KeyError, TypeError, ValueError):
+        raise LedgerError('invalid item')
+    currency = item.get('currency', 'THB')
+    if currency not in CURRENCIES:
+        raise UnsupportedCurrency()
+    amount = parse_amount(amount)
+    if from_id == to_id:
+        raise SameAccountTransfer()
+    return from_id, to_id, amount, currency
+
+
+def _lock_balances(account_ids):
+    ids = sorted(account_ids)
+    accounts = {}
+    for start in range(0, len(ids), LOCK_CHUNK_SIZE):
+        chunk = ids[start:start + LOCK_CHUNK_SIZE]
+        queryset = Account.objects.select_for_update().filter(pk__in=chunk).only(*POSTING_FIELDS)
+        accounts.update((account.id, account) for account in queryset.order_by('pk'))
+    return accounts
+
+
+def _available_balances(accounts):
+    # Shards of sharded accounts are read without locks: concurrent credits only
+    # add to them, so a debit checked against this total can never overdraw.
+    balances = {account.id: account.balance for account in accounts.values()}
+    sharded = [account.id for account in accounts.values() if account.shard_count]
+    for start in range(0, len(sharded), LOCK_CHUNK_SIZE):
+        for account_id, total in shards.shard_totals(sharded[start:start + LOCK_CHUNK_SIZE]).items():
+            balances[account_id] += total
+    return balances
+
+
+def _apply_deltas(deltas, counters, entry_counts):
+    # One prepared UPDATE executed per account: unlike bulk_update's CASE/WHEN
+    # statement its cost does not grow with compiling thousands of branches.
+    table = connection.ops.quote_name(Account._meta.db_table)
+    balance, counter, entry_count = (connection.ops.quote_name(Account._meta.get_field(name).column)
+                                     for name in ('balance', 'postings_since_snapshot', 'entry_count'))
+    pk = connection.ops.quote_name(Account._meta.pk.column)
+    params = [(deltas[account_id], counters[account_id], entry_counts[account_id], account_id)
+              for account_id in sorted(deltas)]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'UPDATE {table} SET {balance} = {balance} + %s, {counter} = %s, {entry_count} = %s '
+                           f'WHERE {pk} = %s', params)
+
+
+def post_many(postings, all_or_nothing=False, failed=False):
+    """
+    Apply many deposits, withdrawals and transfers in one database transaction.
+
+    `postings` are `(transaction_type, account_id, to_account_id, amount, currency)`
+    tuples. Every referenced account is locked once, in ascending id order,
+    balances are tracked in memory while the postings are applied in order, and
+    the net per-account deltas, the transaction rows and their ledger entries
+    are then written with one batched UPDATE and `bulk_create`.
+
+    Returns one entry per posting: the created `Transaction`, the exception that
+    rejected it, or None when `all_or_nothing` rolled it back because another
+    posting (or, with `failed`, an item the caller already rejected) failed.
+    """
+    results = [None] * len(postings)
+
+    with transaction.atomic():
+        accounts = _lock_balances({account_id for _, account_id, to_account_id, _, _ in postings
+                                   for account_id in (account_id, to_account_id) if account_id is not None})
+        balances = _available_balances(accounts)
+        opening_balances = dict(balances)
+        deltas = {}
+        postings_per_account = {}
+        last_posting = {}
+        pending = []
+
+        for index, (transaction_type, account_id, to_account_id, amount, currency) in enumerate(postings):
+            try:
+                txn, changes = _plan_posting(accounts, balances, transaction_type, account_id, to_account_id,
+                                             amount, currency)
+            except (LedgerError, Account.DoesNotExist) as e:
+                results[index] = e
+                continue
+
+            for changed_id, change in changes:
+                balances[changed_id] += change
+                deltas[changed_id] = deltas.get(changed_id, Decimal(0)) + change
+                postings_per_account[changed_id] = postings_per_account.get(changed_id, 0) + 1
+                last_posting[changed_id] = len(pending)
+            pending.append((index, txn, changes))
+
+        if all_or_nothing and (failed or any(result is not None for result in results)):
+            return results
+
+        created = [txn for _, txn, _ in pending]
+        if connection.features.can_return_rows_from_bulk_insert:
+            created = Transaction.objects.bulk_create(created, batch_size=LOCK_CHUNK_SIZE)
+        else:
+            # The ledger entries need the transaction ids.
+            for txn in created:
+                txn.save()
+        ledger_entries = []
+        for (index, _, changes), txn in zip(pending, created):
+            results[index] = txn
+            for changed_id, change in changes:
+                account = accounts[changed_id]
+                opening_balances[changed_id] += change
+                account.balance = opening_balances[changed_id]
+                account.entry_count += 1
+                ledger_entries.append(entries.entry(txn, account, change))
+        LedgerEntry.objects.bulk_create(ledger_entries, batch_size=LOCK_CHUNK_SIZE)
+
+        # Accounts crossing the snapshot interval get one snapshot at their last posting in the batch.
+        counters = {}
+        due_snapshots = []
+        for account_id, count in postings_per_account.items():
+            account = accounts[account_id]
+            txn = created[last_posting[account_id]]
+            if snapshots.snapshot_due(account, count):
+                counters[account_id] = 0
+                due_snapshots.append(BalanceSnapshot(
+                    account_id=account_id, as_of=txn.created_at, balance=balances[account_id],
+                    last_transaction_id=txn.pk
+                ))
+            else:
+                counters[account_id] = account.postings_since_snapshot + count
+        _apply_deltas(deltas, counters, {account_id: accounts[account_id].entry_count for account_id in deltas})
+        _on_commit(list(deltas))
+        BalanceSnapshot.objects.bulk_create(due_snapshots, batch_size=LOCK_CHUNK_SIZE)
+        rollups.record(created)
+
+    return results
+
+
+def _plan_posting(accounts, balances, transaction_type, account_id, to_account_id, amount, currency):
+    """The unsaved `Transaction` for one posting and its `(account id, balance change)` pairs."""
+    account = accounts.get(int(account_id))
+    if account is None:
+        raise Account.DoesNotExist('Account matching query does not exist.')
+    converted_amount = convert_to(currency, account.currency, amount)
+
+    to_account = None
+    if transaction_type == 'transfer':
+        if int(account_id) == int(to_account_id):
+            raise SameAccountTransfer()
+        to_account = accounts.get(int(to_account_id))
+        if to_account is None:
+            raise Account.DoesNotExist('Account matching query does not exist.')
+    if transaction_type != 'deposit' and balances[account.id] < converted_amount:
+        raise InsufficientFunds()
+
+    if to_account is None:
+        change = converted_amount if transaction_type == 'deposit' else -converted_amount
+        return Transaction(
+            account_id=account.id,
+            amount=converted_amount,
+            currency=account.currency,
+            real_amount=amount,
+            real_currency=currency,
+            transaction_type=transaction_type
+        ), [(account.id, change)]
+
+    to_amount = convert_to(currency, to_account.currency, amount)
+    return Transaction(
+        account_id=account.id,
+        to_account_id=to_account.id,
+        amount=converted_amount,
+        currency=account.currency,
+        real_amount=amount,
+        real_currency=currency,
+        to_amount=to_amount,
+        transaction_type='transfer'
+    ), [(account.id, -converted_amount), (to_account.id, to_amount)]
+
+
+def batch_transfer(items, all_or_nothing=False):
+    """
+    Apply many transfers in one database transaction (see `post_many`).
+
+    Returns one result dict per item; with `all_or_nothing` any failure rolls
+    back the whole batch.
+    """
+    results = [None] * len(items)
+    indexes = []
+    postings = []
+    for index, item in enumerate(items):
+        try:
+            from_id, to_id, amount, currency = _parse_batch_item(item)
+        except LedgerError as e:
+            results[index] = {'index': index, 'status': 'failed', 'error': e.message}
+            continue
+        indexes.append(index)
+        postings.append(('transfer', from_id, to_id, amount, currency))
+
+    outcomes = post_many(postings, all_or_nothing, failed=any(result is not None for result in results))
+    for index, outcome in zip(indexes, outcomes):
+        if outcome is None:
+            results[index] = {'index': index, 'status': 'skipped'}
+        elif isinstance(outcome, Transaction):
+            results[index] = {'index': index, 'status': 'ok', 'transaction_id': outcome.pk}
+        elif isinstance(outcome, LedgerError):
+            results[index] = {'index': index, 'status': 'failed', 'error': outcome.message}
+        else:
+            results[index] = {'index': index, 'status': 'failed', 'error': 'account not found'}
+    return results
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import archive
+
+
+class Command(BaseCommand):
+    help = ('Move transactions older than TRANSACTION_ARCHIVE_AFTER into the archive table in small batches, '
+            'e.g. from a nightly job. History reads include the archive, so nothing visible changes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Transactions moved per database transaction')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches, leaving room for live traffic')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (default: until done)')
+
+    def handle(self, *args, **options):
+        if archive.horizon() is None:
+            raise CommandError('Archiving is off: set TRANSACTION_ARCHIVE_AFTER')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        # One cutoff for the whole run, so it ends even while new transactions age past the horizon.
+        before = archive.cutoff()
+        moved = batches = 0
+        started = time.perf_counter()
+        while options['max_batches'] is None or batches < options['max_batches']:
+            count = archive.archive_batch(before, options['batch_size'])
+            if not count:
+                break
+            moved += count
+            batches += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Archived {moved} transactions')
+            if options['pause']:
+                time.sleep(options['pause'])
+        elapsed = time.perf_counter() - started
+        rate = moved / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} transactions created before {before.isoformat()} '
+                                             f'in {elapsed:.1f}s ({rate:.0f} rows/sec)'))
@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from accounts import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Seed benchmark fixtures and measure latency percentiles, throughput and queries per request of the '
+            'banking endpoints, optionally against a stored baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=sorted(benchmark.SCENARIOS),
+                            help='Scenario to run (repeatable, default: all)')
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--accounts-per-user', type=int, default=2)
+        parser.add_argument('--transactions', type=int, default=10000, help='Transactions to seed')
+        parser.add_argument('--requests', type=int, default=500, help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='Client threads')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='JSON report to compare against; regressions exit non-zero')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95/throughput drift from the baseline, as a fraction')
+        parser.add_argument('--in-place', action='store_true',
+                            help='Seed and run against the configured database instead of a throwaway test database')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2 or options['accounts_per_user'] < 1 or options['requests'] < 1:
+            raise CommandError('Need at least 2 users, 1 account per user and 1 request')
+        baseline = benchmark.load(options['baseline']) if options['baseline'] else None
+
+        if options['in_place']:
+            report = self._run(options)
+        else:
+            report = self._run_in_test_database(options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            benchmark.dump(report, options['output'])
+            self.stdout.write(f'Wrote {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+        for name, result in report['scenarios'].items():
+            latency = result['latency_ms']
+            self.stdout.write(
+                f'{name}: p50 {latency["p50"]}ms p95 {latency["p95"]}ms p99 {latency["p99"]}ms, '
+                f'{result["ops_per_sec"]} ops/sec, {result["queries_per_request"]} queries/request, '
+                f'{result["errors"]} errors'
+            )
+
+        if baseline is not None:
+            regressions = benchmark.compare(report, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressed against baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    def _run(self, options):
+        return benchmark.run(
+            options['scenario'], options['users'], options['accounts_per_user'], options['transactions'],
+            options['requests'], options['concurrency'], options['warmup']
+        )
+
+    def _run_in_test_database(self, options):
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        original_test_name = test_settings.get('NAME')
+        if connection.vendor == 'sqlite':
+            # Shared-cache in-memory databases fail concurrent writers outright; use a file so they wait instead.
+            test_settings['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        mirrors = {}
+        for alias in connections:
+            if connections[alias].settings_dict.get('TEST', {}).get('MIRROR') == connection.alias:
+                mirrors[alias] = connections[alias].settings_dict['NAME']
+                connections[alias].close()
+                connections[alias].creation.set_as_test_mirror(connection.settings_dict)
+        try:
+            return self._run(options)
+        finally:
+            for alias, name in mirrors.items():
+                connections[alias].close()
+                connections[alias].settings_dict['NAME'] = name
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = original_test_name
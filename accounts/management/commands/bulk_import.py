@@ -0,0 +1,100 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections
+from django.db.models import Max, Min
+
+from accounts import bulk_import
+from accounts.models import Account
+from accounts.verification import chunks
+
+
+class Command(BaseCommand):
+    help = ('Bulk-load users, accounts and transaction history (CSV with a header row, or NDJSON) keeping their '
+            'legacy ids, then derive each imported account\'s opening balance, ledger entries and rollups.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', help='id, username, password or password_hash, email, first_name, last_name, '
+                                            'is_active, date_joined')
+        parser.add_argument('--accounts', help='id, user, balance (default: the net of the imported history), '
+                                               'currency, created_at')
+        parser.add_argument('--transactions', help='Columns of the transaction export: id, account, to_account, '
+                                                   'amount, currency, real_amount, real_currency, to_amount, '
+                                                   'transaction_type, created_at')
+        parser.add_argument('--format', choices=bulk_import.FORMATS,
+                            help='Input format (default: from the file extension, .ndjson/.jsonl or CSV)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per insert transaction')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Password hashing processes (1 hashes in this process)')
+        parser.add_argument('--checkpoint', help='JSON file recording loaded rows; rerun with it to resume')
+        parser.add_argument('--no-finish', action='store_true',
+                            help='Leave imported accounts unfinished, because more of their history follows in '
+                                 'a later run (finished accounts are not revisited)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+        files = [(kind, options[kind]) for kind in bulk_import.KINDS if options[kind]]
+        if not files:
+            raise CommandError('Nothing to import: pass --users, --accounts and/or --transactions')
+        progress = bulk_import.Progress(options['checkpoint'])
+
+        executor = None
+        if options['users'] and options['workers'] > 1:
+            # Forked workers must open their own connections rather than share ours.
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup)
+        try:
+            with bulk_import.keeping_created_at():
+                for kind, path in files:
+                    self._load(kind, path, progress, executor, options)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        bulk_import.reset_sequences()
+
+        if not options['no_finish'] and (options['accounts'] or options['transactions']):
+            self._finish(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Import complete'))
+
+    def _load(self, kind, path, progress, executor, options):
+        done = progress.done(kind)
+        if done:
+            self.stdout.write(f'Resuming {kind} after {done} rows')
+        rows = islice(bulk_import.read_rows(path, options['format']), done, None)
+        inserted = skipped = 0
+        started = time.perf_counter()
+        try:
+            for chunk in bulk_import.chunked(rows, options['batch_size']):
+                try:
+                    chunk_inserted, chunk_skipped = bulk_import.load_chunk(kind, chunk, executor)
+                except IntegrityError as e:
+                    raise CommandError(f'{kind} lines {chunk[0][0]}-{chunk[-1][0]}: {e}')
+                inserted += chunk_inserted
+                skipped += chunk_skipped
+                done += len(chunk)
+                progress.record(kind, done)
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{kind}: {done} rows')
+        except bulk_import.RowError as e:
+            raise CommandError(f'{kind}: {e}')
+        elapsed = time.perf_counter() - started
+        rate = (inserted + skipped) / elapsed if elapsed else 0
+        self.stdout.write(f'Imported {inserted} {kind} ({skipped} already present) in {elapsed:.1f}s '
+                          f'({rate:.0f} rows/sec)')
+
+    def _finish(self, chunk_size):
+        bounds = Account.objects.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            return
+        finished = 0
+        started = time.perf_counter()
+        for chunk in chunks(bounds['low'], bounds['high'], chunk_size):
+            finished += bulk_import.finish_chunk(chunk)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Derived opening balances, ledger entries and rollups of {finished} accounts '
+                          f'in {elapsed:.1f}s')
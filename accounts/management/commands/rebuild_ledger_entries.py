@@ -0,0 +1,35 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from accounts import entries
+from accounts.models import Account
+from accounts.shards import shard_totals
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the double-entry ledger entries and running balances from the transaction history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Accounts per rebuild transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+        while True:
+            with transaction.atomic():
+                # Locking the chunk (and its shards) keeps postings for these accounts out while they are rebuilt.
+                accounts = list(Account.objects.select_for_update().filter(pk__gt=last_id)
+                                .only('id', 'balance', 'currency', 'shard_count').order_by('pk')[:chunk_size])
+                if not accounts:
+                    break
+                totals = shard_totals([account.id for account in accounts if account.shard_count], lock=True)
+                balances = {account.id: account.balance + totals.get(account.id, 0) for account in accounts}
+                written, sequences = entries.rebuild(accounts, balances)
+                for account in accounts:
+                    account.entry_count = sequences[account.id]
+                Account.objects.bulk_update(accounts, ['entry_count'], batch_size=chunk_size)
+            last_id = accounts[-1].id
+            total += written
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} ledger entries'))
@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand
+
+from accounts import rollups
+from accounts.models import Account, BalanceShard
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily and monthly transaction rollups from the transaction history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Accounts per rebuild transaction')
+        parser.add_argument('--account', type=int, help='Only rebuild this account')
+
+    def handle(self, *args, **options):
+        if options['account'] is not None:
+            low = high = options['account']
+        else:
+            bounds = Account.objects.aggregate(low=Min('id'), high=Max('id'))
+            low, high = bounds['low'], bounds['high']
+        if low is None:
+            self.stdout.write('No accounts to rebuild')
+            return
+
+        total = 0
+        chunk_size = options['chunk_size']
+        for start in range(low, high + 1, chunk_size):
+            end = min(start + chunk_size - 1, high)
+            with transaction.atomic():
+                # Hold postings for these accounts back while their rollups are replaced. Credits to sharded
+                # accounts only lock a balance shard, so those are locked too, after the rows as in the ledger.
+                list(Account.objects.select_for_update().filter(pk__range=(start, end)).values_list('id'))
+                list(BalanceShard.objects.select_for_update().filter(account_id__gte=start, account_id__lte=end)
+                     .order_by('account_id', 'shard').values_list('id'))
+                total += rollups.rebuild((start, end))
+            self.stdout.write(f'Rebuilt accounts {start}-{end}')
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} rollup rows'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import Account
+from accounts.shards import reshard
+
+
+class Command(BaseCommand):
+    help = ('Spread credits to hot accounts (e.g. merchants) over balance shards so concurrent deposits stop '
+            'queueing on one row; --shards 0 folds the shards back into the account.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='+', type=int)
+        parser.add_argument('--shards', type=int, required=True, help='Balance shards per account (0 to unshard)')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shards'] <= 1000:
+            raise CommandError('--shards must be between 0 and 1000')
+        for account_id in options['account_ids']:
+            try:
+                balance = reshard(account_id, options['shards'])
+            except Account.DoesNotExist:
+                raise CommandError(f'Account {account_id} does not exist')
+            self.stdout.write(f'Account {account_id}: {options["shards"]} shards, balance {balance}')
+        self.stdout.write(self.style.SUCCESS(f'Resharded {len(options["account_ids"])} accounts'))
@@ -0,0 +1,43 @@
+from django.db import transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from accounts import archive
+from accounts.models import Account, BalanceSnapshot
+from accounts.shards import shard_totals
+
+
+class Command(BaseCommand):
+    help = 'Record a balance snapshot for every account (e.g. from a nightly job or after a bulk load).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+        while True:
+            with transaction.atomic():
+                # Locking the chunk keeps postings for these accounts out until the snapshots are written.
+                accounts = list(Account.objects.select_for_update().filter(pk__gt=last_id)
+                                .only('id', 'balance', 'shard_count').order_by('pk')[:chunk_size])
+                last_transaction_id = archive.last_transaction_id()
+                # With no postings at all a snapshot would have no transaction, which marks an opening
+                # balance; every account's opening snapshot already holds its balance.
+                if not accounts or last_transaction_id is None:
+                    break
+                # Sharded accounts are only ever snapshotted here, with every shard locked as well.
+                totals = shard_totals([account.id for account in accounts if account.shard_count], lock=True)
+                as_of = timezone.now()
+                BalanceSnapshot.objects.bulk_create([
+                    BalanceSnapshot(account_id=account.id, as_of=as_of,
+                                    balance=account.balance + totals.get(account.id, 0),
+                                    last_transaction_id=last_transaction_id)
+                    for account in accounts
+                ])
+                Account.objects.filter(pk__in=[account.id for account in accounts]).update(postings_since_snapshot=0)
+            last_id = accounts[-1].id
+            total += len(accounts)
+
+        self.stdout.write(self.style.SUCCESS(f'Recorded {total} balance snapshots'))
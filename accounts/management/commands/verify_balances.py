@@ -0,0 +1,81 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+
+from accounts import verification
+from accounts.models import Account
+
+
+def _setup_worker():
+    # Spawned workers (macOS, Windows) start without Django; forked ones already have it.
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = ('Verify every account balance against its opening balance and transaction history, scanning id-range '
+            'chunks in parallel worker processes; mismatches exit non-zero.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Accounts per chunk')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Worker processes (1 verifies in this process)')
+        parser.add_argument('--checkpoint', help='JSON file recording finished chunks; rerun with it to resume')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-size and --workers must be positive')
+        try:
+            checkpoint = verification.Checkpoint(options['checkpoint'], options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        bounds = Account.objects.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            self.stdout.write('No accounts to verify')
+            return
+        pending = [chunk for chunk in verification.chunks(bounds['low'], bounds['high'], options['chunk_size'])
+                   if not checkpoint.done(chunk)]
+        if checkpoint.results:
+            self.stdout.write(f'Resuming: {len(checkpoint.results)} chunks already verified')
+
+        self.scanned = 0
+        started = time.perf_counter()
+        if options['workers'] == 1:
+            for chunk in pending:
+                self._record(checkpoint, verification.verify_chunk(chunk), options)
+        else:
+            # Forked workers must open their own connections rather than share ours.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_setup_worker) as executor:
+                futures = [executor.submit(verification.verify_chunk, chunk) for chunk in pending]
+                for future in as_completed(futures):
+                    self._record(checkpoint, future.result(), options)
+        elapsed = time.perf_counter() - started
+
+        results = checkpoint.results.values()
+        mismatches = sorted((mismatch for result in results for mismatch in result['mismatches']),
+                            key=lambda mismatch: mismatch['account'])
+        for mismatch in mismatches:
+            self.stdout.write(f'Account {mismatch["account"]}: balance {mismatch["balance"]}, expected '
+                              f'{mismatch["expected"]} (difference {mismatch["difference"]})')
+        checked = sum(result['checked'] for result in results)
+        unverified = sum(result['unverified'] for result in results)
+        rate = self.scanned / elapsed if elapsed else 0
+        self.stdout.write(f'Verified {checked} accounts ({unverified} without an opening balance); this run scanned '
+                          f'{self.scanned} in {elapsed:.1f}s ({rate:.0f} accounts/sec)')
+
+        if mismatches:
+            raise CommandError(f'{len(mismatches)} balance mismatches')
+        self.stdout.write(self.style.SUCCESS('All balances match their history'))
+
+    def _record(self, checkpoint, result, options):
+        checkpoint.record(result)
+        self.scanned += result['checked'] + result['unverified']
+        if options['verbosity'] > 1:
+            self.stdout.write(f'Verified accounts {result["start"]}-{result["end"]}: '
+                              f'{len(result["mismatches"])} mismatches')
@@ -0,0 +1,132 @@
+import cProfile
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import db, profiling
+from .authentication import token_user_id
+
+PRIMARY_PIN_COOKIE = 'primary_pin'
+PRIMARY_PIN_SALT = 'accounts.primary-pin'
+PRIMARY_PIN_CACHE_KEY = 'accounts:primary-pin:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def pin_seconds():
+    return getattr(settings, 'PRIMARY_PIN_SECONDS', 5)
+
+
+class ReadYourWritesMiddleware:
+    """
+    Keep a client on the primary database for `PRIMARY_PIN_SECONDS` after it writes.
+
+    A successful unsafe request sets a signed cookie and, for JWT clients that
+    drop cookies, a shared-cache entry keyed by the token's user id. While either
+    is live, every read the client makes runs under `db.pinned_to_primary()`, so
+    it sees its own postings even if the replica has not caught up.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        user_id = token_user_id(request)
+        pinned = self._has_pin_cookie(request) or (
+            user_id is not None and cache.get(PRIMARY_PIN_CACHE_KEY.format(user_id)) is not None
+        )
+        if pinned:
+            with db.pinned_to_primary():
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
+        if self._wrote(request, response):
+            cache.set(PRIMARY_PIN_CACHE_KEY.format(request.user.id), True, pin_seconds())
+            self._set_pin_cookie(response)
+        return response
+
+    async def __acall__(self, request):
+        user_id = token_user_id(request)
+        pinned = self._has_pin_cookie(request) or (
+            user_id is not None and await cache.aget(PRIMARY_PIN_CACHE_KEY.format(user_id)) is not None
+        )
+        if pinned:
+            with db.pinned_to_primary():
+                response = await self.get_response(request)
+        else:
+            response = await self.get_response(request)
+        if self._wrote(request, response):
+            await cache.aset(PRIMARY_PIN_CACHE_KEY.format(request.user.id), True, pin_seconds())
+            self._set_pin_cookie(response)
+        return response
+
+    def _has_pin_cookie(self, request):
+        return request.get_signed_cookie(PRIMARY_PIN_COOKIE, default=None, salt=PRIMARY_PIN_SALT,
+                                         max_age=pin_seconds()) is not None
+
+    def _wrote(self, request, response):
+        user = getattr(request, 'user', None)
+        return (request.method not in SAFE_METHODS and response.status_code < 400
+                and user is not None and user.is_authenticated)
+
+    def _set_pin_cookie(self, response):
+        response.set_signed_cookie(PRIMARY_PIN_COOKIE, '1', salt=PRIMARY_PIN_SALT, max_age=pin_seconds(),
+                                   httponly=True, samesite='Lax')
+
+
+class ProfilingMiddleware:
+    """
+    Per-request timing, switched on with `PROFILING = True`; list it first so it times everything else.
+
+    Each request reports its wall time, query count and time, and the time
+    spent in auth, serializers and FX conversion as a `Server-Timing` header
+    and in the `/metrics` histograms. A `PROFILING_SAMPLE_RATE` share of sync
+    requests also runs under cProfile, keeping the dumps of the slowest ones
+    (see `profiling.SlowestProfiles`). Async requests are never profiled,
+    since a profiler on the event loop would also catch every other task.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not profiling.enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Connections opened later are instrumented from `connection_created`.
+        for connection in connections.all():
+            profiling.instrument(connection)
+        profile = cProfile.Profile() if profiling.should_profile() else None
+        started = time.perf_counter()
+        with profiling.measuring() as timings:
+            if profile is None:
+                response = self.get_response(request)
+            else:
+                profile.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profile.disable()
+        profiling.finish(request, response, time.perf_counter() - started, timings, profile)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with profiling.measuring() as timings:
+            response = await self.get_response(request)
+        profiling.finish(request, response, time.perf_counter() - started, timings)
+        return response
@@ -1,6 +1,21 @@
 from django.db import models
+from django.db.models import Sum
+from django.utils.functional import cached_property
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import AbstractUser, Group, Permission
 
+CURRENCY_CHOICES = [
+    ('THB', 'Thai Baht'),
+    ('USD', 'US Dollar'),
+    ('EUR', 'Euro'),
+    ('GBP', 'Pound Sterling'),
+    ('JPY', 'Japanese Yen'),
+    ('CNY', 'Chinese Yuan'),
+    ('SGD', 'Singapore Dollar'),
+    ('HKD', 'Hong Kong Dollar'),
+    ('AUD', 'Australian Dollar'),
+]
+
 
 class User(AbstractUser):
     pass  # Extend as needed
@@ -13,17 +28,190 @@ class User(AbstractUser):
 class Account(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
-    currency = models.CharField(max_length=3, choices=[('THB', 'Thai Baht'), ('USD', 'US Dollar')], default='THB')
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='THB')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Postings since the last BalanceSnapshot; maintained by accounts.ledger
+    postings_since_snapshot = models.PositiveIntegerField(default=0, editable=False)
+    # BalanceShard rows credits are spread across (0: the whole balance lives in `balance`); see accounts.shards
+    shard_count = models.PositiveSmallIntegerField(default=0, editable=False)
+    # Sequence of this account's latest LedgerEntry posted under its row lock; maintained by accounts.ledger
+    entry_count = models.PositiveBigIntegerField(default=0, editable=False)
+
+    @cached_property
+    def total_balance(self):
+        """`balance` plus every balance shard; list and detail reads annotate it instead."""
+        if not self.shard_count:
+            return self.balance
+        return self.balance + (self.balance_shards.aggregate(total=Sum('balance'))['total'] or 0)
+
+
+class BalanceShard(models.Model):
+    # Part of a sharded account's balance; credits pick one shard at random so they never queue on the account row
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='balance_shards')
+    # 1..Account.shard_count
+    shard = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Sequence of the latest LedgerEntry credited to this shard
+    entry_count = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'shard'], name='unique_balance_shard'),
+        ]
 
 
 class Transaction(models.Model):
     account = models.ForeignKey(Account, on_delete=models.CASCADE)
     to_account = models.ForeignKey(Account, on_delete=models.SET_NULL, null=True, blank=True, related_name='incoming_transfers')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    currency = models.CharField(max_length=3, choices=[('THB', 'Thai Baht'), ('USD', 'US Dollar')], default='THB')
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='THB')
     real_amount = models.DecimalField(max_digits=10, decimal_places=2)
-    real_currency = models.CharField(max_length=3, choices=[('THB', 'Thai Baht'), ('USD', 'US Dollar')], default='THB')
+    real_currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='THB')
+    # Amount credited to `to_account`, in its currency (transfers only)
+    to_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     transaction_type = models.CharField(max_length=10, choices=[('deposit', 'Deposit'), ('withdraw', 'Withdraw'), ('transfer', 'Transfer')])
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Composite indexes backing keyset pagination on `(created_at, id)` for
+        # each filter TransactionViewSet supports.
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='txn_created_id_idx'),
+            models.Index(fields=['account', 'created_at', 'id'], name='txn_account_created_id_idx'),
+            models.Index(fields=['to_account', 'created_at', 'id'], name='txn_to_account_created_id_idx'),
+            models.Index(fields=['transaction_type', 'created_at', 'id'], name='txn_type_created_id_idx'),
+            models.Index(fields=['real_currency', 'created_at', 'id'], name='txn_currency_created_id_idx'),
+        ]
+
+
+class ArchivedTransaction(models.Model):
+    # A Transaction older than TRANSACTION_ARCHIVE_AFTER, moved here by accounts.archive with its id and
+    # columns unchanged, so the hot table and its indexes stay small. Accounts are not constrained in the
+    # database, but deleting one cascades and nulls here exactly as it does on Transaction.
+    id = models.BigIntegerField(primary_key=True)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, db_constraint=False, related_name='+')
+    to_account = models.ForeignKey(Account, on_delete=models.SET_NULL, db_constraint=False, null=True, blank=True,
+                                   related_name='+')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='THB')
+    real_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    real_currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='THB')
+    to_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    transaction_type = models.CharField(max_length=10, choices=[('deposit', 'Deposit'), ('withdraw', 'Withdraw'), ('transfer', 'Transfer')])
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='archive_created_id_idx'),
+            models.Index(fields=['account', 'created_at', 'id'], name='archive_account_created_id_idx'),
+            models.Index(fields=['to_account', 'created_at', 'id'], name='archive_to_account_created_idx'),
+        ]
+
+
+class LedgerEntry(models.Model):
+    # One side of a posting: a debit (negative `amount`) or credit of `account`, in the account's currency.
+    # A transfer has one of each; the other side of a deposit or withdrawal is outside the bank.
+    # No database constraint: the transaction may have moved to ArchivedTransaction (see accounts.archive)
+    transaction = models.ForeignKey(Transaction, on_delete=models.DO_NOTHING, db_constraint=False,
+                                    related_name='entries')
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='entries')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # The lock the entry was posted under: 0 for the account row, n for balance shard n (accounts.shards)
+    shard = models.PositiveSmallIntegerField(default=0)
+    # 1, 2, ... per account and shard, in commit order, and the account's balance after this
+    # entry. The balance is null for sharded accounts, whose credits never see the whole balance.
+    sequence = models.PositiveBigIntegerField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # The transaction's created_at
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'shard', 'sequence'], name='unique_ledger_entry_sequence'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'created_at', 'id'], name='entry_account_created_id_idx'),
+            # The change feed reads an account's new entries in id order (accounts.events)
+            models.Index(fields=['account', 'id'], name='entry_account_id_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    request_path = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at'], name='idempotency_created_idx'),
+        ]
+
+    @property
+    def is_complete(self):
+        return self.response_status is not None
+
+
+class FxRate(models.Model):
+    # Units of `currency` per one unit of settings.FX_BASE_CURRENCY
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES)
+    rate = models.DecimalField(max_digits=20, decimal_places=10)
+    effective_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['currency', 'effective_at'], name='fxrate_currency_effective_idx'),
+        ]
+
+
+class BalanceSnapshot(models.Model):
+    # Balance of `account` after every posting up to and including `last_transaction_id`,
+    # whose `created_at` is `as_of`. Snapshots without a transaction mark an opening balance.
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='balance_snapshots')
+    as_of = models.DateTimeField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+    last_transaction_id = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'as_of', 'last_transaction_id'], name='snapshot_account_as_of_idx'),
+        ]
+
+
+class TransactionRollup(models.Model):
+    # Per-account totals of the postings in one day or month, maintained by accounts.rollups
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='rollups')
+    # Lock the row is written under: 0 for the account row, n for BalanceShard n (credits to sharded accounts)
+    shard = models.PositiveSmallIntegerField(default=0)
+    granularity = models.CharField(max_length=5, choices=[('day', 'Day'), ('month', 'Month')])
+    period_start = models.DateField()
+    transaction_type = models.CharField(max_length=10, choices=[('deposit', 'Deposit'), ('withdraw', 'Withdraw'), ('transfer', 'Transfer')])
+    real_currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES)
+    direction = models.CharField(max_length=3, choices=[('in', 'Incoming'), ('out', 'Outgoing')])
+    count = models.PositiveIntegerField(default=0)
+    # In the account's currency
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # In `real_currency`
+    real_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['account', 'granularity', 'period_start', 'transaction_type', 'real_currency', 'direction',
+                        'shard'],
+                name='unique_transaction_rollup'
+            ),
+        ]
+
+
+class ImportedWithoutBalance(models.Model):
+    # An account bulk-imported without a balance; accounts.bulk_import derives it from the history, then drops the row
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, primary_key=True)
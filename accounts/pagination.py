@@ -0,0 +1,155 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination keyed on the unique `(created_at, id)` tuple, so every page
+    is a single index range scan with no offset, however deep the client pages.
+    """
+    ordering = ('created_at', 'id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self._set_page(list(queryset))
+
+    def paginate_querysets(self, querysets, request, view=None):
+        """
+        `paginate_queryset` over disjoint querysets of the same rows, such as
+        the hot and archived transactions: each is read one page deep and the
+        pages are merged in cursor order.
+        """
+        pages = [self._page_queryset(queryset, request, view) for queryset in querysets]
+        if pages[0] is None:
+            return None
+        return self._set_page(self._merge([list(page) for page in pages]))
+
+    async def apaginate_querysets(self, querysets, request, view=None):
+        """`paginate_querysets` for async views; the pages are read with async iteration."""
+        pages = [self._page_queryset(queryset, request, view) for queryset in querysets]
+        if pages[0] is None:
+            return None
+        return self._set_page(self._merge([[item async for item in page] for page in pages]))
+
+    def lower_bound(self, request):
+        """
+        Earliest `created_at` the requested page can reach, or None when it may
+        reach back to the beginning of the history.
+        """
+        cursor = self.decode_cursor(request)
+        if cursor is None or cursor.position is None or cursor.reverse or self.ordering[0].startswith('-'):
+            return None
+        return self._parse_position(cursor.position)[0]
+
+    def _merge(self, pages):
+        time_field, id_field = (field.lstrip('-') for field in self.ordering)
+
+        def key(item):
+            if isinstance(item, dict):
+                return item[time_field], item[id_field]
+            return getattr(item, time_field), getattr(item, id_field)
+
+        descending = self.ordering[0].startswith('-')
+        merged = sorted((item for page in pages for item in page), key=key, reverse=self._reverse != descending)
+        return merged[:self.page_size + 1]
+
+    def _page_queryset(self, queryset, request, view):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+
+        if self._reverse:
+            queryset = queryset.order_by(*self._reversed_ordering())
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if self._current_position is not None:
+            queryset = queryset.filter(self._keyset_filter(self._current_position, self._reverse))
+
+        # Always fetch one extra item to know whether there is another page.
+        return queryset[:self.page_size + 1]
+
+    def _set_page(self, results):
+        self.page = results[:self.page_size]
+        has_following_position = len(results) > len(self.page)
+
+        if self._reverse:
+            self.page.reverse()
+            self.has_next = self._current_position is not None
+            self.has_previous = has_following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = self._current_position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    @property
+    def _reverse(self):
+        return self.cursor is not None and self.cursor.reverse
+
+    @property
+    def _current_position(self):
+        return self.cursor.position if self.cursor is not None else None
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def get_schema_fields(self, view):
+        # Query parameters are documented on the view; coreapi is not installed.
+        return []
+
+    def _reversed_ordering(self):
+        return tuple(field[1:] if field.startswith('-') else '-' + field for field in self.ordering)
+
+    def _keyset_filter(self, position, reverse):
+        created_at, pk = self._parse_position(position)
+        time_field, id_field = (field.lstrip('-') for field in self.ordering)
+        descending = self.ordering[0].startswith('-')
+        lookup = 'lt' if reverse != descending else 'gt'
+        return (
+            Q(**{f'{time_field}__{lookup}': created_at}) |
+            Q(**{time_field: created_at, f'{id_field}__{lookup}': pk})
+        )
+
+    def _parse_position(self, position):
+        try:
+            created_at, pk = position.rsplit('|', 1)
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def _get_position_from_instance(self, instance, ordering):
+        time_field, id_field = (field.lstrip('-') for field in ordering)
+        if isinstance(instance, dict):
+            created_at, pk = instance[time_field], instance[id_field]
+        else:
+            created_at, pk = getattr(instance, time_field), getattr(instance, id_field)
+        return f'{created_at.isoformat()}|{pk}'
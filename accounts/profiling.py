@@ -0,0 +1,235 @@
+import contextvars
+import heapq
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PHASES = ('db', 'auth', 'serialize', 'fx')
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PROFILE_NAME = re.compile(r'^(\d+\.\d)ms-.*\.prof$')
+
+_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def enabled():
+    return getattr(settings, 'PROFILING', False)
+
+
+class Timings:
+    """Seconds spent and calls made per phase during one request; phases may overlap (auth runs queries)."""
+    __slots__ = ('seconds', 'calls')
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+
+    def add(self, phase, seconds):
+        self.seconds[phase] += seconds
+        self.calls[phase] += 1
+
+
+@contextmanager
+def measuring():
+    """Collect `timed` phases and queries made in this context (thread or task) into a fresh `Timings`."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to `phase` of the request being measured; free outside `measuring()`."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - started)
+
+
+def record_query(execute, sql, params, many, context):
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - started)
+
+
+def instrument(connection):
+    """Install `record_query` as a permanent execute wrapper of `connection` (once)."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def server_timing(duration, timings):
+    """`Server-Timing` header value: total wall time, then each phase that ran, in milliseconds."""
+    metrics = [f'total;dur={duration * 1000:.2f}']
+    for phase in PHASES:
+        if timings.calls[phase]:
+            metric = f'{phase};dur={timings.seconds[phase] * 1000:.2f}'
+            if phase == 'db':
+                metric += f';desc="{timings.calls[phase]} queries"'
+            metrics.append(metric)
+    return ', '.join(metrics)
+
+
+def _label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Histogram:
+    __slots__ = ('buckets', 'total', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS, self.buckets):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.total:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class Metrics:
+    """
+    Request duration and phase histograms per view, plus query counts, for this
+    process. Each worker process serves its own numbers, so scrape every worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._durations = {}
+            self._phases = {}
+            self._queries = {}
+
+    def observe(self, view, method, duration, timings):
+        with self._lock:
+            self._durations.setdefault((view, method), Histogram()).observe(duration)
+            for phase in PHASES:
+                if timings.calls[phase]:
+                    self._phases.setdefault((view, phase), Histogram()).observe(timings.seconds[phase])
+            self._queries[view] = self._queries.get(view, 0) + timings.calls['db']
+
+    def render(self):
+        """Prometheus text exposition format."""
+        with self._lock:
+            lines = ['# HELP banking_request_duration_seconds Wall time of requests by view and method.',
+                     '# TYPE banking_request_duration_seconds histogram']
+            for (view, method), histogram in sorted(self._durations.items()):
+                lines.extend(histogram.lines('banking_request_duration_seconds',
+                                             f'view="{_label(view)}",method="{_label(method)}"'))
+            lines += ['# HELP banking_request_phase_seconds Time per request spent in db, auth, serialize and fx.',
+                      '# TYPE banking_request_phase_seconds histogram']
+            for (view, phase), histogram in sorted(self._phases.items()):
+                lines.extend(histogram.lines('banking_request_phase_seconds', f'view="{_label(view)}",phase="{phase}"'))
+            lines += ['# HELP banking_db_queries_total Database queries run by requests, by view.',
+                      '# TYPE banking_db_queries_total counter']
+            lines += [f'banking_db_queries_total{{view="{_label(view)}"}} {count}'
+                      for view, count in sorted(self._queries.items())]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def should_profile():
+    """Whether to run this request under cProfile: a `PROFILING_SAMPLE_RATE` share, when a dump dir is set."""
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+    return bool(rate and getattr(settings, 'PROFILING_DUMP_DIR', None)) and random.random() < rate
+
+
+class SlowestProfiles:
+    """
+    Keeps the cProfile dumps of the `PROFILING_KEEP_SLOWEST` slowest sampled
+    requests in `PROFILING_DUMP_DIR`, deleting a dump once slower ones push it
+    out. Dumps left by earlier runs are ranked with the new ones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._directory = None
+            self._heap = []
+
+    def _load(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._heap = []
+        for name in os.listdir(directory):
+            match = PROFILE_NAME.match(name)
+            if match:
+                self._heap.append((float(match.group(1)) / 1000, os.path.join(directory, name)))
+        heapq.heapify(self._heap)
+
+    def offer(self, profile, duration, view):
+        """Dump `profile` if it is among the slowest; returns the file written, or None."""
+        directory = settings.PROFILING_DUMP_DIR
+        keep = getattr(settings, 'PROFILING_KEEP_SLOWEST', 20)
+        with self._lock:
+            if directory != self._directory:
+                self._load(directory)
+            if len(self._heap) >= keep and duration <= self._heap[0][0]:
+                return None
+            slug = re.sub(r'[^\w.-]+', '_', view)
+            path = os.path.join(directory, f'{duration * 1000:.1f}ms-{slug}-{time.time_ns()}.prof')
+            profile.dump_stats(path)
+            heapq.heappush(self._heap, (duration, path))
+            while len(self._heap) > keep:
+                _, evicted = heapq.heappop(self._heap)
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+            return path
+
+
+slowest_profiles = SlowestProfiles()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def finish(request, response, duration, timings, profile=None):
+    """Record a measured request: metrics, `Server-Timing` header and, if it was profiled, its dump."""
+    view = view_name(request)
+    metrics.observe(view, request.method, duration, timings)
+    response['Server-Timing'] = server_timing(duration, timings)
+    if profile is not None:
+        slowest_profiles.offer(profile, duration, view)
@@ -0,0 +1,90 @@
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import db
+
+GENERATION_CACHE_KEY = 'accounts:generation:{}'
+RESPONSE_CACHE_KEY = 'accounts:response:{}'
+
+
+def _generation_keys(account_ids):
+    return [GENERATION_CACHE_KEY.format(account_id) for account_id in sorted(set(account_ids))]
+
+
+def generations(account_ids):
+    """Current generation of each account, in ascending account id order."""
+    keys = _generation_keys(account_ids)
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # A fresh clock reading can never repeat a generation an evicted counter already handed out.
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(account_ids):
+    """Move the accounts to a new generation, orphaning every cached response built from them."""
+    for key in _generation_keys(account_ids):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=None)
+
+
+def _etag(request, account_ids):
+    fingerprint = '|'.join([
+        request.build_absolute_uri(),
+        request.META.get('HTTP_ACCEPT', ''),
+        ','.join(str(generation) for generation in generations(account_ids)),
+    ])
+    return quote_etag(hashlib.sha256(fingerprint.encode()).hexdigest()[:32])
+
+
+def cached_by_account(account_ids):
+    """
+    Cache a read-only viewset action per account generation, with ETags.
+
+    `account_ids(view, request, kwargs)` names the accounts the response is built
+    from, or returns None to skip caching. A matching `If-None-Match` gets a 304
+    and a cached body is replayed, both without touching the database; postings
+    bump the generation (see `bump`), which changes the ETag. Clients pinned to
+    the primary after a write skip the lookup and refresh the entry instead.
+
+    A miss is read from the primary: a replica can lag behind a posting whose
+    bump is already visible, and its body would then be cached as current.
+    """
+    def decorator(view_method):
+        @functools.wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            ids = account_ids(self, request, kwargs)
+            if ids is None:
+                return view_method(self, request, *args, **kwargs)
+
+            etag = _etag(request, ids)
+            key = RESPONSE_CACHE_KEY.format(etag.strip('"'))
+            if not db.is_pinned_to_primary():
+                if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+                data = cache.get(key)
+                if data is not None:
+                    return Response(data, headers={'ETag': etag})
+
+            # The generation was read first, so the body is at least as new as the one it is stored under.
+            with db.pinned_to_primary():
+                response = view_method(self, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, getattr(settings, 'RESPONSE_CACHE_TTL', 300))
+                response['ETag'] = etag
+            return response
+
+        return wrapper
+
+    return decorator
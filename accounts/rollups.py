@@ -0,0 +1,164 @@
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncMonth
+from django.utils import timezone
+
+from . import archive, convert
+from .models import Account, TransactionRollup
+
+GRANULARITIES = ('day', 'month')
+CHUNK_SIZE = 500
+
+
+def period_starts(created_at):
+    day = timezone.localtime(created_at).date()
+    return {'day': day, 'month': day.replace(day=1)}
+
+
+def _sides(txn):
+    """`(account_id, direction, amount in that account's currency)` for each account a posting touches."""
+    if txn.transaction_type == 'deposit':
+        return [(txn.account_id, 'in', txn.amount)]
+    if txn.transaction_type == 'withdraw':
+        return [(txn.account_id, 'out', txn.amount)]
+    return [(txn.account_id, 'out', txn.amount), (txn.to_account_id, 'in', txn.to_amount)]
+
+
+def _accumulate(deltas, key, count, amount, real_amount):
+    current = deltas.get(key)
+    if current is None:
+        deltas[key] = [count, amount, real_amount]
+    else:
+        current[0] += count
+        current[1] += amount
+        current[2] += real_amount
+
+
+def record(txns, shards=None):
+    """
+    Add freshly written postings to their day and month rollups.
+
+    Called by the ledger inside the posting transaction, after the affected
+    accounts are locked, so no two writers race on the same rollup row.
+    Credits to a sharded account only lock a balance shard; `shards` maps such
+    an account id to that shard, whose own rollup rows they are added to.
+    """
+    deltas = {}
+    for txn in txns:
+        periods = period_starts(txn.created_at)
+        for account_id, direction, amount in _sides(txn):
+            if account_id is None:
+                continue
+            for granularity in GRANULARITIES:
+                key = (account_id, granularity, periods[granularity], txn.transaction_type, txn.real_currency,
+                       direction)
+                _accumulate(deltas, key, 1, amount or Decimal(0), txn.real_amount)
+    apply_deltas(deltas, shards)
+
+
+def apply_deltas(deltas, shards=None):
+    if not deltas:
+        return
+    shards = shards or {}
+
+    account_ids = sorted({key[0] for key in deltas})
+    periods = {key[2] for key in deltas}
+    existing = {}
+    for start in range(0, len(account_ids), CHUNK_SIZE):
+        rows = TransactionRollup.objects.filter(
+            account_id__in=account_ids[start:start + CHUNK_SIZE], period_start__in=periods
+        ).values_list('id', 'account_id', 'granularity', 'period_start', 'transaction_type', 'real_currency',
+                      'direction', 'shard')
+        existing.update((tuple(row[1:]), row[0]) for row in rows)
+
+    updates = []
+    creates = []
+    for key, (count, amount, real_amount) in deltas.items():
+        shard = shards.get(key[0], 0)
+        rollup_id = existing.get(key + (shard,))
+        if rollup_id is not None:
+            updates.append((count, amount, real_amount, rollup_id))
+        else:
+            account_id, granularity, period_start, transaction_type, real_currency, direction = key
+            creates.append(TransactionRollup(
+                account_id=account_id, granularity=granularity, period_start=period_start,
+                transaction_type=transaction_type, real_currency=real_currency, direction=direction, shard=shard,
+                count=count, amount=amount, real_amount=real_amount
+            ))
+
+    if updates:
+        qn = connection.ops.quote_name
+        table = qn(TransactionRollup._meta.db_table)
+        count, amount, real_amount = (qn(TransactionRollup._meta.get_field(name).column)
+                                      for name in ('count', 'amount', 'real_amount'))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {table} SET {count} = {count} + %s, {amount} = {amount} + %s, '
+                f'{real_amount} = {real_amount} + %s WHERE {qn("id")} = %s',
+                updates
+            )
+    TransactionRollup.objects.bulk_create(creates, batch_size=CHUNK_SIZE)
+
+
+def _rebuild_history(deltas, accounts, account_currency, granularity, history):
+    """Add the `granularity` rollups of `accounts` from `history`, annotated with its `period`, to `deltas`."""
+    outgoing = history.filter(account__in=accounts).values(
+        'account_id', 'period', 'transaction_type', 'real_currency'
+    ).annotate(count=Count('id'), amount=Sum('amount'), real_amount=Sum('real_amount'))
+    for row in outgoing:
+        direction = 'in' if row['transaction_type'] == 'deposit' else 'out'
+        key = (row['account_id'], granularity, row['period'].date(), row['transaction_type'],
+               row['real_currency'], direction)
+        _accumulate(deltas, key, row['count'], row['amount'], row['real_amount'])
+
+    incoming = history.filter(to_account__in=accounts, transaction_type='transfer')
+    for row in incoming.values('to_account_id', 'period', 'real_currency').annotate(
+        count=Count('id'), amount=Sum('to_amount'), real_amount=Sum('real_amount')
+    ):
+        key = (row['to_account_id'], granularity, row['period'].date(), 'transfer', row['real_currency'], 'in')
+        _accumulate(deltas, key, row['count'], row['amount'] or Decimal(0), row['real_amount'])
+
+    # Transfers written before `to_amount` was recorded are converted at today's rate.
+    legacy = incoming.filter(to_amount__isnull=True).values_list('to_account_id', 'period', 'real_currency',
+                                                                 'real_amount')
+    for to_account_id, period, real_currency, real_amount in legacy:
+        key = (to_account_id, granularity, period.date(), 'transfer', real_currency, 'in')
+        _accumulate(deltas, key, 0, convert(real_currency, account_currency[to_account_id], real_amount),
+                    Decimal(0))
+
+
+def rebuild(account_id_range=None, account_ids=None):
+    """
+    Recompute rollups from the transaction history, archived transactions
+    included, with grouped queries.
+
+    `account_id_range` is an inclusive `(low, high)` pair and `account_ids` a
+    list of ids; by default every account is rebuilt. Returns the number of
+    rollup rows written.
+    """
+    accounts = Account.objects.all()
+    if account_id_range is not None:
+        accounts = accounts.filter(pk__range=account_id_range)
+    if account_ids is not None:
+        accounts = accounts.filter(pk__in=account_ids)
+    TransactionRollup.objects.filter(account__in=accounts).delete()
+
+    account_currency = dict(accounts.values_list('id', 'currency'))
+    deltas = {}
+    for granularity, trunc in (('day', TruncDay), ('month', TruncMonth)):
+        for model in archive.history_models():
+            _rebuild_history(deltas, accounts, account_currency, granularity,
+                             model.objects.annotate(period=trunc('created_at')))
+
+    TransactionRollup.objects.bulk_create([
+        TransactionRollup(
+            account_id=account_id, granularity=granularity, period_start=period_start,
+            transaction_type=transaction_type, real_currency=real_currency, direction=direction,
+            count=count, amount=amount, real_amount=real_amount
+        )
+        for (account_id, granularity, period_start, transaction_type, real_currency, direction),
+        (count, amount, real_amount) in deltas.items()
+    ], batch_size=CHUNK_SIZE)
+    return len(deltas)
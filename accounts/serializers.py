@@ -1,5 +1,83 @@
+from decimal import Decimal
+
+from django.utils import timezone
+from django.utils.functional import cached_property
 from rest_framework import serializers
-from .models import User, Account, Transaction
+from . import profiling
+from .models import User, Account, LedgerEntry, Transaction
+
+CENT = Decimal('0.01')
+
+
+def format_decimal(value):
+    return None if value is None else '{:f}'.format(value.quantize(CENT))
+
+
+def format_datetime(value):
+    # Same output as DRF's DateTimeField: current timezone, 'Z' for UTC
+    if value is None:
+        return None
+    value = timezone.localtime(value).isoformat() if timezone.is_aware(value) else value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def requested_fields(request, available):
+    """Field names picked with a comma-separated `?fields=` on a read request, or None for all."""
+    if request is None or request.method not in ('GET', 'HEAD'):
+        return None
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return [name for name in available if name in {field.strip() for field in fields.split(',')}] or None
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    """Times a whole list into the request's `serialize` phase, rather than each row."""
+
+    @property
+    def data(self):
+        with profiling.timed('serialize'):
+            return super().data
+
+
+class LeanReadMixin:
+    """
+    Serializer with a sparse `?fields=` selector and a hand-written read path.
+
+    `representation` maps each output field to the model attribute (or
+    `.values()` key) it comes from and an optional formatter, so reads skip
+    DRF's per-field machinery and work on model instances or value dicts alike.
+    """
+    representation = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = requested_fields(self.context.get('request'), self.Meta.fields)
+        if selected is not None:
+            for name in set(self.fields) - set(selected):
+                self.fields.pop(name)
+
+    @classmethod
+    def source_attributes(cls, request=None):
+        """Model attributes needed to render the fields selected by `request`."""
+        selected = requested_fields(request, cls.Meta.fields) or cls.Meta.fields
+        return [cls.representation[name][0] for name in selected]
+
+    @cached_property
+    def _readers(self):
+        return [(name,) + self.representation[name] for name in self.fields if not self.fields[name].write_only]
+
+    @property
+    def data(self):
+        with profiling.timed('serialize'):
+            return super().data
+
+    def to_representation(self, instance):
+        if isinstance(instance, dict):
+            return {name: formatter(instance[attr]) if formatter else instance[attr]
+                    for name, attr, formatter in self._readers}
+        return {name: formatter(getattr(instance, attr)) if formatter else getattr(instance, attr)
+                for name, attr, formatter in self._readers}
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -15,13 +93,55 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class AccountSerializer(serializers.ModelSerializer):
+class AccountSerializer(LeanReadMixin, serializers.ModelSerializer):
+    representation = {
+        'id': ('id', None),
+        'user': ('user_id', None),
+        # Sums the balance shards of sharded accounts (see accounts.shards)
+        'balance': ('total_balance', format_decimal),
+        'currency': ('currency', None),
+        'created_at': ('created_at', format_datetime),
+    }
+
     class Meta:
         model = Account
-        fields = '__all__'
+        fields = ['id', 'user', 'balance', 'currency', 'created_at']
+        list_serializer_class = TimedListSerializer
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(LeanReadMixin, serializers.ModelSerializer):
+    representation = {
+        'id': ('id', None),
+        'account': ('account_id', None),
+        'to_account': ('to_account_id', None),
+        'amount': ('amount', format_decimal),
+        'currency': ('currency', None),
+        'real_amount': ('real_amount', format_decimal),
+        'real_currency': ('real_currency', None),
+        'to_amount': ('to_amount', format_decimal),
+        'transaction_type': ('transaction_type', None),
+        'created_at': ('created_at', format_datetime),
+    }
+
     class Meta:
         model = Transaction
-        fields = '__all__'
+        fields = ['id', 'account', 'to_account', 'amount', 'currency', 'real_amount', 'real_currency', 'to_amount',
+                  'transaction_type', 'created_at']
+        list_serializer_class = TimedListSerializer
+
+
+class LedgerEntrySerializer(LeanReadMixin, serializers.ModelSerializer):
+    representation = {
+        'id': ('id', None),
+        'transaction': ('transaction_id', None),
+        'shard': ('shard', None),
+        'sequence': ('sequence', None),
+        'amount': ('amount', format_decimal),
+        'balance': ('balance', format_decimal),
+        'created_at': ('created_at', format_datetime),
+    }
+
+    class Meta:
+        model = LedgerEntry
+        fields = ['id', 'transaction', 'shard', 'sequence', 'amount', 'balance', 'created_at']
+        list_serializer_class = TimedListSerializer
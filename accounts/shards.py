@@ -0,0 +1,55 @@
+from decimal import Decimal
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from . import response_cache
+from .models import Account, BalanceShard, LedgerEntry
+
+
+def with_total_balance(queryset):
+    """Annotate `total_balance` (see `Account.total_balance`) with one correlated sum, not a query per account."""
+    shard_sum = (BalanceShard.objects.filter(account_id=OuterRef('pk')).values('account_id')
+                 .annotate(total=Sum('balance')).values('total'))
+    return queryset.annotate(total_balance=Case(
+        When(shard_count=0, then=F('balance')),
+        default=F('balance') + Coalesce(Subquery(shard_sum), Value(Decimal(0))),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    ))
+
+
+def shard_totals(account_ids, lock=False):
+    """Sum of the balance shards of each given account that has any, optionally locking every shard."""
+    queryset = BalanceShard.objects.filter(account_id__in=account_ids)
+    if not lock:
+        return dict(queryset.values('account_id').annotate(total=Sum('balance')).values_list('account_id', 'total'))
+    totals = {}
+    for account_id, balance in queryset.select_for_update().order_by('account_id', 'shard').values_list(
+            'account_id', 'balance'):
+        totals[account_id] = totals.get(account_id, Decimal(0)) + balance
+    return totals
+
+
+def reshard(account_id, shard_count):
+    """
+    Spread future credits to an account over `shard_count` balance shards (0 turns sharding off).
+
+    The current shards are folded back into the account row first, under the
+    row lock and every shard's lock, so the total balance never changes. A
+    shard that comes back numbers its entries on from its last one.
+    Raises `Account.DoesNotExist` for an unknown id.
+    """
+    with transaction.atomic():
+        account = Account.objects.select_for_update().only('id', 'balance', 'shard_count').get(pk=account_id)
+        folded = shard_totals([account.id], lock=True).get(account.id, Decimal(0))
+        BalanceShard.objects.filter(account_id=account.id).delete()
+        sequences = dict(LedgerEntry.objects.filter(account_id=account.id, shard__gt=0).values('shard')
+                         .annotate(last=Max('sequence')).values_list('shard', 'last'))
+        BalanceShard.objects.bulk_create([BalanceShard(account_id=account.id, shard=shard,
+                                                       entry_count=sequences.get(shard, 0))
+                                          for shard in range(1, shard_count + 1)])
+        Account.objects.filter(pk=account.id).update(balance=F('balance') + folded, shard_count=shard_count)
+        transaction.on_commit(partial(response_cache.bump, [account.id]))
+    return account.balance + folded
@@ -0,0 +1,48 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import profiling
+from .authentication import user_status_cache
+from .db import configure_sqlite
+from .fx import rate_cache
+from .models import Account, FxRate, User
+from .response_cache import bump
+from .snapshots import record_opening_snapshot
+
+
+@receiver([post_save, post_delete], sender=FxRate)
+def invalidate_fx_rates(sender, **kwargs):
+    rate_cache.invalidate()
+
+
+@receiver(post_save, sender=Account)
+def record_opening_balance(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_opening_snapshot(instance)
+
+
+@receiver([post_save, post_delete], sender=Account)
+def invalidate_account_responses(sender, instance, created=False, **kwargs):
+    # Postings bump the generation themselves; this covers edits made through the account endpoints.
+    if not created:
+        transaction.on_commit(partial(bump, [instance.pk]))
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_status(sender, instance, **kwargs):
+    user_status_cache.invalidate(instance.pk)
+
+
+@receiver(connection_created)
+def tune_sqlite_connection(sender, connection, **kwargs):
+    configure_sqlite(connection)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if profiling.enabled():
+        profiling.instrument(connection)
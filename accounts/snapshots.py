@@ -0,0 +1,96 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Case, DecimalField, F, Q, Sum, When
+from django.utils import timezone
+
+from . import archive, convert
+from .models import BalanceSnapshot
+
+
+def snapshot_interval():
+    return getattr(settings, 'BALANCE_SNAPSHOT_INTERVAL', 500)
+
+
+def snapshot_due(account, postings=1):
+    """
+    Whether `postings` more postings on a locked account should end in a snapshot.
+
+    Never for sharded accounts: no posting locks all their shards, so only
+    `snapshot_balances` can see a consistent total.
+    """
+    if account.shard_count:
+        return False
+    return account.postings_since_snapshot + postings >= snapshot_interval()
+
+
+def record_snapshot(account, balance, txn):
+    return BalanceSnapshot.objects.create(
+        account_id=account.id, as_of=txn.created_at, balance=balance, last_transaction_id=txn.id
+    )
+
+
+def record_opening_snapshot(account):
+    return BalanceSnapshot.objects.create(
+        account_id=account.id, as_of=account.created_at, balance=account.balance, last_transaction_id=None
+    )
+
+
+def _after(as_of, last_transaction_id):
+    return Q(created_at__gt=as_of) | Q(created_at=as_of, id__gt=last_transaction_id or 0)
+
+
+def _net_change(account, queryset_filter, since=None):
+    """
+    Net effect on `account` of its postings matching `queryset_filter`, none
+    of them before `since`; the archive is only read when it reaches `since`.
+    """
+    total = Decimal(0)
+    for model in archive.history_models(since):
+        total += _table_net_change(account, model, queryset_filter)
+    return total
+
+
+def _table_net_change(account, model, queryset_filter):
+    outgoing = model.objects.filter(queryset_filter, account_id=account.id).aggregate(total=Sum(Case(
+        When(transaction_type='deposit', then=F('amount')),
+        default=-F('amount'),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )))['total'] or Decimal(0)
+
+    incoming = model.objects.filter(queryset_filter, to_account_id=account.id)
+    total = incoming.aggregate(total=Sum('to_amount'))['total'] or Decimal(0)
+    # Transfers written before `to_amount` was recorded are converted at today's rate.
+    for real_currency, real_amount in incoming.filter(to_amount__isnull=True).values_list('real_currency',
+                                                                                           'real_amount'):
+        total += convert(real_currency, account.currency, real_amount)
+
+    return outgoing + total
+
+
+def balance_at(account, at=None):
+    """
+    Balance of `account` after every posting with `created_at <= at`.
+
+    Starts from the latest snapshot at or before `at` and replays forward, or, if
+    there is none, from the earliest later snapshot and replays backwards, so the
+    work is bounded by BALANCE_SNAPSHOT_INTERVAL postings rather than the
+    account's whole history.
+    """
+    if at is None:
+        at = timezone.now()
+
+    snapshots = BalanceSnapshot.objects.filter(account_id=account.id)
+    before = snapshots.filter(as_of__lte=at).order_by('-as_of', F('last_transaction_id').desc(nulls_last=True)).first()
+    if before is not None:
+        tail = _after(before.as_of, before.last_transaction_id) & Q(created_at__lte=at)
+        return before.balance + _net_change(account, tail, since=before.as_of)
+
+    after = snapshots.filter(as_of__gt=at).order_by('as_of', F('last_transaction_id').asc(nulls_first=True)).first()
+    if after is not None:
+        head = Q(created_at__gt=at) & ~_after(after.as_of, after.last_transaction_id)
+        return after.balance - _net_change(account, head, since=at)
+
+    # No snapshots at all (e.g. bulk-loaded accounts): replay the whole history.
+    return _net_change(account, Q(created_at__lte=at))
+
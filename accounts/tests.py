@@ -1,17 +1,54 @@
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from rest_framework.test import APITestCase, APIClient
-from rest_framework import status
+from rest_framework import serializers, status
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.db.models import F
+from django import test as django_test
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from . import USD_TO_THB_RATE
-from .models import Account, Transaction
+from . import (USD_TO_THB_RATE, admission, archive, async_views, authentication, benchmark, convert, db, events,
+               export, fx, idempotency, journal, ledger, middleware, profiling, response_cache, rollups, shards,
+               snapshots, verification)
+from .models import (Account, ArchivedTransaction, BalanceShard, BalanceSnapshot, FxRate, IdempotencyKey,
+                     ImportedWithoutBalance, LedgerEntry, Transaction, TransactionRollup)
+from .serializers import TransactionSerializer
+from .views import AccountViewSet
 from decimal import Decimal
 from rest_framework_simplejwt.tokens import RefreshToken
 
 User = get_user_model()  # Use the custom user model
 
 
+def model_serializer_for(model_class, field_names):
+    # Plain DRF serializer used as the reference output for the lean read serializers
+    class Serializer(serializers.ModelSerializer):
+        class Meta:
+            model = model_class
+            fields = field_names
+
+    return Serializer
+
+
 class AccountTestCase(APITestCase):
     def setUp(self):
         self.user1 = User.objects.create_user(username='user1', password='password123')
@@ -38,7 +75,24 @@ class AccountTestCase(APITestCase):
     def test_retrieve_accounts(self):
         response = self.client.get(reverse('account-list'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        # Only the requesting user's accounts are listed
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['id'], self.account1.id)
+        self.assertEqual(response.data[0]['balance'], '100.00')
+
+    def test_retrieve_accounts_sparse_fields(self):
+        response = self.client.get(reverse('account-list'), {'fields': 'id,balance'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'id': self.account1.id, 'balance': '100.00'}])
+
+    def test_list_accounts_query_count(self):
+        for _ in range(20):
+            Account.objects.create(user=self.user1)
+        self.client.get(reverse('account-list'))
+        # Only the account query once the user's status is cached, however many accounts there are
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('account-list'))
+        self.assertEqual(len(response.data), 21)
 
     def test_update_account(self):
         data = {
@@ -49,6 +103,22 @@ class AccountTestCase(APITestCase):
         self.account1.refresh_from_db()
         self.assertEqual(self.account1.balance, Decimal('300.00'))
 
+    def test_update_account_keeps_ledger_counters(self):
+        get_object = AccountViewSet.get_object
+
+        def get_object_then_post(view):
+            account = get_object(view)
+            # A posting commits after the view has read the account
+            Account.objects.filter(pk=account.pk).update(entry_count=5, postings_since_snapshot=3)
+            return account
+
+        with mock.patch.object(AccountViewSet, 'get_object', get_object_then_post):
+            response = self.client.patch(reverse('account-detail', kwargs={'pk': self.account1.id}), {'currency': 'USD'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.currency, 'USD')
+        self.assertEqual((self.account1.entry_count, self.account1.postings_since_snapshot), (5, 3))
+
     def test_delete_account_with_referenced_transactions(self):
         # Create a transaction
         Transaction.objects.create(account=self.account1, to_account=self.account2, amount=Decimal('50.00'), real_amount=Decimal('50.00'), transaction_type='transfer')
@@ -92,24 +162,24 @@ class TransactionTestCase(APITestCase):
     def test_list_transactions(self):
         response = self.client.get(reverse('transaction-list'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_list_transactions_by_account_id(self):
         response = self.client.get(reverse('transaction-list'), {'account_id': self.account1.id})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_list_transactions_by_to_account_id(self):
         response = self.client.get(reverse('transaction-list'), {'to_account_id': self.account2.id})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['to_account'], self.account2.id)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['to_account'], self.account2.id)
 
     def test_list_transactions_by_transaction_type(self):
         response = self.client.get(reverse('transaction-list'), {'transaction_type': 'withdraw'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['transaction_type'], 'withdraw')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['transaction_type'], 'withdraw')
 
     def test_list_transactions_by_multiple_filters(self):
         response = self.client.get(reverse('transaction-list'), {
@@ -117,9 +187,79 @@ class TransactionTestCase(APITestCase):
             'transaction_type': 'transfer'
         })
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['transaction_type'], 'transfer')
-        self.assertEqual(response.data[0]['account'], self.account1.id)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['transaction_type'], 'transfer')
+        self.assertEqual(response.data['results'][0]['account'], self.account1.id)
+
+    def test_list_transactions_cursor_pagination(self):
+        transactions = [self.transaction1, self.transaction2]
+        for i in range(3):
+            transactions.append(Transaction.objects.create(
+                account=self.account1, amount=Decimal('1.00'), real_amount=Decimal('1.00'), transaction_type='deposit'
+            ))
+
+        seen = []
+        response = self.client.get(reverse('transaction-list'), {'page_size': 2})
+        self.assertIsNone(response.data['previous'])
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(item['id'] for item in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, [t.id for t in transactions])
+
+        # Walking back from the last page returns the preceding page in order
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([item['id'] for item in response.data['results']], seen[2:4])
+
+    def test_list_transactions_sparse_fields(self):
+        response = self.client.get(reverse('transaction-list'), {'fields': 'id,amount,to_account'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0], {
+            'id': self.transaction1.id, 'to_account': self.account2.id, 'amount': '50.00'
+        })
+
+    def test_list_transactions_matches_model_serializer_output(self):
+        response = self.client.get(reverse('transaction-detail', kwargs={'pk': self.transaction1.id}))
+        expected = model_serializer_for(Transaction, TransactionSerializer.Meta.fields)(self.transaction1).data
+        self.assertEqual(response.data, expected)
+        response = self.client.get(reverse('transaction-list'))
+        self.assertEqual(response.data['results'][0], expected)
+
+    def test_list_transactions_query_count(self):
+        for _ in range(20):
+            Transaction.objects.create(account=self.account1, to_account=self.account2, amount=Decimal('1.00'),
+                                       real_amount=Decimal('1.00'), transaction_type='transfer')
+        self.client.get(reverse('transaction-list'))
+        # Only the page query once the user's status is cached, however many transactions there are
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('transaction-list'))
+        self.assertEqual(len(response.data['results']), 22)
+
+    def test_list_transactions_invalid_cursor(self):
+        response = self.client.get(reverse('transaction-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_transactions_ndjson(self):
+        response = self.client.get(reverse('transaction-export'), {'account_id': self.account1.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.transaction1.id, self.transaction2.id])
+        self.assertEqual(rows[0]['to_account'], self.account2.id)
+        self.assertEqual(rows[0]['amount'], '50.00')
+        self.assertEqual(rows[1]['to_account'], None)
+
+    def test_export_transactions_csv(self):
+        response = self.client.get(reverse('transaction-export'), {'format': 'csv', 'transaction_type': 'withdraw'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:4], ['id', 'account', 'to_account', 'amount'])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][0], str(self.transaction2.id))
+        self.assertEqual(rows[1][8], 'withdraw')
 
 
 class AccountTransactionTestCase(APITestCase):
@@ -254,4 +394,1585 @@ class AccountTransactionTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.account1.refresh_from_db()
         self.assertEqual(self.account1.balance, Decimal('100.00'))
-        self.assertEqual(Transaction.objects.filter(account=self.account1, transaction_type='transfer').count(), 0)
\ No newline at end of file
+        self.assertEqual(Transaction.objects.filter(account=self.account1, transaction_type='transfer').count(), 0)
+
+    def test_deposit_unknown_account(self):
+        response = self.client.post(reverse('custom_account-deposit', kwargs={'pk': 999}), {'amount': '50.00'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_transfer_unknown_to_account(self):
+        data = {
+            'to_account_id': 999,
+            'amount': '50.00'
+        }
+        response = self.client.post(reverse('custom_account-transfer', kwargs={'pk': self.account1.id}), data)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('100.00'))
+
+    def test_invalid_amounts_are_rejected(self):
+        postings = [
+            ('custom_account-deposit', {}),
+            ('custom_account-withdraw', {}),
+            ('custom_account-transfer', {'to_account_id': self.account2.id}),
+        ]
+        for name, data in postings:
+            url = reverse(name, kwargs={'pk': self.account1.id})
+            for amount in ('-50.00', '0', 'NaN', 'abc', None):
+                with self.subTest(name=name, amount=amount):
+                    body = data if amount is None else {**data, 'amount': amount}
+                    response = self.client.post(url, body, format='json')
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                    self.assertEqual(response.data, {'status': 'amount must be positive'})
+        response = self.client.post(reverse('custom_account-transfer', kwargs={'pk': self.account1.id}),
+                                    {'amount': '1.00'}, format='json')
+        self.assertEqual(response.data, {'status': 'to_account_id must be an account id'})
+        self.account2.refresh_from_db()
+        self.assertEqual(self.account2.balance, Decimal('200.00'))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class LedgerTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user, balance=Decimal('200.00'), currency='USD')
+
+    def test_transfer_round_trips(self):
+        # lock both rows, debit, credit, insert, ledger entries, rollup lookup and insert; plus the savepoint
+        # pair of the nested atomic block
+        with self.assertNumQueries(9):
+            ledger.transfer(self.account2.id, self.account1.id, Decimal('1.00'), 'USD')
+        self.account1.refresh_from_db()
+        self.account2.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal(100 + USD_TO_THB_RATE))
+        self.assertEqual(self.account2.balance, Decimal('199.00'))
+
+    def test_withdraw_insufficient_funds_rolls_back(self):
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.withdraw(self.account1.id, Decimal('100.01'))
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('100.00'))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_transfer_same_account(self):
+        with self.assertRaises(ledger.SameAccountTransfer):
+            ledger.transfer(self.account1.id, str(self.account1.id), Decimal('1.00'))
+
+    def test_postings_need_a_positive_amount(self):
+        for amount in (Decimal('-5.00'), Decimal('0'), Decimal('0.001'), Decimal('NaN'), Decimal('Infinity'), None):
+            with self.subTest(amount=amount):
+                with self.assertRaises(ledger.InvalidAmount):
+                    ledger.deposit(self.account1.id, amount)
+                with self.assertRaises(ledger.InvalidAmount):
+                    ledger.withdraw(self.account1.id, amount)
+                with self.assertRaises(ledger.InvalidAmount):
+                    ledger.transfer(self.account1.id, self.account2.id, amount)
+        with self.assertRaises(ledger.InvalidAccount):
+            ledger.transfer(self.account1.id, None, Decimal('1.00'))
+        self.assertEqual(ledger.deposit(self.account1.id, '1.005').real_amount, Decimal('1.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_converted_amounts_are_rounded_to_cents(self):
+        txn = ledger.deposit(self.account2.id, Decimal('10.00'), 'THB')
+        self.assertEqual(txn.amount, Decimal('0.33'))
+        self.account2.refresh_from_db()
+        self.assertEqual(self.account2.balance, Decimal('200.33'))
+
+    def test_post_many_mixed_postings(self):
+        results = ledger.post_many([
+            ('deposit', self.account1.id, None, Decimal('50.00'), 'THB'),
+            ('withdraw', self.account1.id, None, Decimal('500.00'), 'THB'),
+            ('transfer', self.account1.id, self.account2.id, Decimal('1.00'), 'USD'),
+            ('withdraw', 9999, None, Decimal('1.00'), 'THB'),
+        ])
+        self.assertIsInstance(results[0], Transaction)
+        self.assertIsInstance(results[1], ledger.InsufficientFunds)
+        self.assertEqual(results[2].to_amount, Decimal('1.00'))
+        self.assertIsInstance(results[3], Account.DoesNotExist)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal(150 - USD_TO_THB_RATE))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class BatchTransferTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'))
+        self.account3 = Account.objects.create(user=self.user1, balance=Decimal('10.00'), currency='USD')
+        self.client = APIClient()
+
+        # Obtain JWT tokens for authentication
+        self.refresh_token = RefreshToken.for_user(self.user1)
+        self.access_token = self.refresh_token.access_token
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+
+    def test_batch_transfer_partial_success(self):
+        data = {
+            'transfers': [
+                {'from': self.account1.id, 'to': self.account2.id, 'amount': '60.00'},
+                # Funded by the credit from the previous item
+                {'from': self.account2.id, 'to': self.account3.id, 'amount': '1.00', 'currency': 'USD'},
+                {'from': self.account1.id, 'to': self.account2.id, 'amount': '60.00'},
+                {'from': self.account1.id, 'to': 999, 'amount': '1.00'},
+                {'from': self.account1.id, 'to': self.account1.id, 'amount': '1.00'},
+                {'from': self.account1.id, 'to': self.account2.id, 'amount': '-1.00'},
+            ]
+        }
+        response = self.client.post(reverse('transfer-batch'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['succeeded'], 2)
+        self.assertEqual(response.data['failed'], 4)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['ok', 'ok', 'failed', 'failed', 'failed', 'failed'])
+        self.assertEqual(response.data['results'][2]['error'], 'insufficient funds')
+        self.assertEqual(response.data['results'][3]['error'], 'account not found')
+
+        self.account1.refresh_from_db()
+        self.account2.refresh_from_db()
+        self.account3.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('40.00'))
+        self.assertEqual(self.account2.balance, Decimal(60 - USD_TO_THB_RATE))
+        self.assertEqual(self.account3.balance, Decimal('11.00'))
+        self.assertEqual(Transaction.objects.filter(transaction_type='transfer').count(), 2)
+
+    def test_batch_transfer_all_or_nothing(self):
+        data = {
+            'all_or_nothing': True,
+            'transfers': [
+                {'from': self.account1.id, 'to': self.account2.id, 'amount': '60.00'},
+                {'from': self.account1.id, 'to': self.account2.id, 'amount': '60.00'},
+            ]
+        }
+        response = self.client.post(reverse('transfer-batch'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([result['status'] for result in response.data['results']], ['skipped', 'failed'])
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('100.00'))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_batch_transfer_parses_all_or_nothing(self):
+        transfers = [{'from': self.account1.id, 'to': self.account2.id, 'amount': '200.00'}]
+        response = self.client.post(reverse('transfer-batch'), {'all_or_nothing': 'false', 'transfers': transfers},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['status'], 'failed')
+
+        response = self.client.post(reverse('transfer-batch'), {'all_or_nothing': 'maybe', 'transfers': transfers},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['status'], 'all_or_nothing must be a boolean')
+
+    def test_batch_transfer_query_count(self):
+        transfers = [{'from': self.account1.id, 'to': self.account2.id, 'amount': '0.04'}] * 100
+        # lock, bulk_create, ledger entries (two inserts under SQLite's parameter limit), balance update, rollup
+        # lookup and insert, savepoint pair; plus the auth user lookup
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse('transfer-batch'), {'transfers': transfers}, format='json')
+        self.assertEqual(response.data['succeeded'], 100)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('96.00'))
+
+    def test_batch_transfer_rejects_empty_batch(self):
+        response = self.client.post(reverse('transfer-batch'), {'transfers': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class IdempotencyTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'))
+        self.client = APIClient()
+
+        # Obtain JWT tokens for authentication
+        self.refresh_token = RefreshToken.for_user(self.user1)
+        self.access_token = self.refresh_token.access_token
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+
+    def test_repeated_key_replays_response(self):
+        url = reverse('custom_account-transfer', kwargs={'pk': self.account1.id})
+        data = {'to_account_id': self.account2.id, 'amount': '30.00'}
+        first = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+        second = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('70.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_replayed_failure_does_not_repost(self):
+        url = reverse('custom_account-withdraw', kwargs={'pk': self.account1.id})
+        first = self.client.post(url, {'amount': '150.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, status.HTTP_400_BAD_REQUEST)
+        Account.objects.filter(pk=self.account1.id).update(balance=Decimal('500.00'))
+        second = self.client.post(url, {'amount': '150.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(second.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_key_reused_for_different_request(self):
+        url = reverse('custom_account-deposit', kwargs={'pk': self.account1.id})
+        self.client.post(url, {'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        response = self.client.post(url, {'amount': '20.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('110.00'))
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=timedelta(milliseconds=100))
+    def test_in_flight_duplicate_waits_then_conflicts(self):
+        url = reverse('custom_account-deposit', kwargs={'pk': self.account1.id})
+        self.client.post(url, {'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        # Pretend the original request is still being processed
+        IdempotencyKey.objects.update(response_status=None, response_body=None)
+        response = self.client.post(url, {'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('110.00'))
+
+    @override_settings(IDEMPOTENCY_KEY_TTL=timedelta(hours=1))
+    def test_expired_keys_are_purged(self):
+        url = reverse('custom_account-deposit', kwargs={'pk': self.account1.id})
+        self.client.post(url, {'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        self.client.post(url, {'amount': '10.00'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('120.00'))
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(idempotency.purge_expired(), 1)
+
+
+class FxRateTestCase(TestCase):
+    def setUp(self):
+        fx.rate_cache.invalidate()
+
+    def tearDown(self):
+        fx.rate_cache.invalidate()
+
+    def test_stub_rates_round_trip(self):
+        thb = convert('USD', 'THB', Decimal('1.00'))
+        self.assertEqual(thb, Decimal(USD_TO_THB_RATE))
+        self.assertEqual(convert('THB', 'USD', thb), Decimal('1.00'))
+
+    def test_triangulates_through_base_currency(self):
+        self.assertEqual(fx.rate_cache.rate('EUR', 'THB'), fx.STUB_RATES['THB'] / fx.STUB_RATES['EUR'])
+        self.assertEqual(convert('EUR', 'THB', Decimal('0.92')), Decimal('30'))
+
+    def test_database_rates_override_stub_and_invalidate_cache(self):
+        self.assertEqual(convert('USD', 'THB', Decimal('2')), Decimal('60'))
+        FxRate.objects.create(currency='THB', rate=Decimal('35'), effective_at=timezone.now())
+        self.assertEqual(convert('USD', 'THB', Decimal('2')), Decimal('70'))
+        # Not yet effective
+        FxRate.objects.create(currency='THB', rate=Decimal('40'), effective_at=timezone.now() + timedelta(days=1))
+        self.assertEqual(convert('USD', 'THB', Decimal('2')), Decimal('70'))
+
+    def test_cached_lookups_do_not_query(self):
+        convert('USD', 'THB', Decimal('1'))
+        with self.assertNumQueries(0):
+            convert('USD', 'THB', Decimal('1'))
+            convert('GBP', 'JPY', Decimal('1'))
+
+    def test_file_provider_rebases_rates(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'base': 'THB', 'rates': {'USD': '0.025'}}, f)
+        self.addCleanup(os.remove, f.name)
+        rates, _ = fx.FileRateProvider(f.name).get_rates()
+        self.assertEqual(rates['THB'], Decimal('40'))
+        self.assertEqual(rates['USD'], Decimal('1'))
+
+    def test_unknown_currency(self):
+        with self.assertRaises(fx.UnknownCurrency):
+            convert('USD', 'XXX', Decimal('1'))
+
+
+@override_settings(BALANCE_SNAPSHOT_INTERVAL=3)
+class BalanceSnapshotTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'), currency='USD')
+        self.client = APIClient()
+
+        # Obtain JWT tokens for authentication
+        self.refresh_token = RefreshToken.for_user(self.user1)
+        self.access_token = self.refresh_token.access_token
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+
+    def _post_history(self):
+        # Returns (timestamp, expected balance of account1) after each posting
+        history = []
+        for amount in ['10.00', '20.00', '30.00', '40.00', '50.00', '60.00', '70.00']:
+            txn = ledger.deposit(self.account1.id, Decimal(amount))
+            self.account1.refresh_from_db()
+            history.append((txn.created_at, self.account1.balance))
+        txn = ledger.transfer(self.account1.id, self.account2.id, Decimal('30.00'))
+        history.append((txn.created_at, Decimal('350.00')))
+        txn = ledger.transfer(self.account2.id, self.account1.id, Decimal('1.00'), 'USD')
+        history.append((txn.created_at, Decimal('380.00')))
+        return history
+
+    def test_snapshots_written_every_interval(self):
+        self._post_history()
+        # Opening balance plus one per three postings
+        self.assertEqual(BalanceSnapshot.objects.filter(account=self.account1).count(), 1 + 3)
+        snapshot = BalanceSnapshot.objects.filter(account=self.account1).order_by('-as_of').first()
+        self.assertEqual(snapshot.balance, Decimal('380.00'))
+
+    def test_balance_at_matches_history(self):
+        history = self._post_history()
+        opening_at = self.account1.created_at
+        self.assertEqual(snapshots.balance_at(self.account1, opening_at), Decimal('100.00'))
+        for at, expected in history:
+            self.assertEqual(snapshots.balance_at(self.account1, at), expected)
+
+        # Without the earlier snapshots, replay runs backwards from a later one
+        BalanceSnapshot.objects.filter(account=self.account1, last_transaction_id__isnull=True).delete()
+        for at, expected in history[:2]:
+            self.assertEqual(snapshots.balance_at(self.account1, at), expected)
+
+    def test_balance_endpoint(self):
+        history = self._post_history()
+        at, expected = history[4]
+        response = self.client.get(reverse('custom_account-balance', kwargs={'pk': self.account1.id}),
+                                   {'at': at.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['balance'], str(expected))
+
+        response = self.client.get(reverse('custom_account-balance', kwargs={'pk': self.account2.id}))
+        self.assertEqual(response.data['balance'], '0.00')
+
+        response = self.client.get(reverse('custom_account-balance', kwargs={'pk': self.account1.id}),
+                                   {'at': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_snapshot_command_skips_accounts_without_history(self):
+        call_command('snapshot_balances', stdout=io.StringIO())
+        # Only the opening snapshots, which are the ones without a transaction
+        self.assertEqual(BalanceSnapshot.objects.count(), 2)
+        self.assertEqual(BalanceSnapshot.objects.filter(last_transaction_id__isnull=True).count(), 2)
+
+        txn = ledger.deposit(self.account1.id, Decimal('5.00'))
+        call_command('snapshot_balances', stdout=io.StringIO())
+        self.assertEqual(list(BalanceSnapshot.objects.filter(last_transaction_id=txn.id).order_by('account_id')
+                              .values_list('account_id', 'balance')),
+                         [(self.account1.id, Decimal('105.00')), (self.account2.id, Decimal('0.00'))])
+
+    def test_batch_transfer_records_snapshots(self):
+        transfers = [{'from': self.account1.id, 'to': self.account2.id, 'amount': '30.00'}] * 3
+        ledger.batch_transfer(transfers)
+        self.account2.refresh_from_db()
+        snapshot = BalanceSnapshot.objects.filter(account=self.account2).order_by('-as_of').first()
+        self.assertEqual(snapshot.balance, self.account2.balance)
+        self.assertEqual(snapshot.last_transaction_id, Transaction.objects.order_by('-id').first().id)
+        self.assertEqual(Account.objects.get(pk=self.account2.id).postings_since_snapshot, 0)
+
+
+class TransactionRollupTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'), currency='USD')
+        self.client = APIClient()
+
+        # Obtain JWT tokens for authentication
+        self.refresh_token = RefreshToken.for_user(self.user1)
+        self.access_token = self.refresh_token.access_token
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token}')
+
+    def _rollups(self):
+        return sorted(TransactionRollup.objects.values_list(
+            'account_id', 'granularity', 'period_start', 'transaction_type', 'real_currency', 'direction', 'count',
+            'amount', 'real_amount'
+        ))
+
+    def _post_history(self):
+        ledger.deposit(self.account1.id, Decimal('10.00'))
+        ledger.deposit(self.account1.id, Decimal('1.00'), 'USD')
+        ledger.deposit(self.account1.id, Decimal('5.00'))
+        ledger.withdraw(self.account1.id, Decimal('20.00'))
+        ledger.transfer(self.account1.id, self.account2.id, Decimal('60.00'))
+        ledger.batch_transfer([{'from': self.account2.id, 'to': self.account1.id, 'amount': '1.00', 'currency': 'USD'}])
+
+    def test_summary_endpoint(self):
+        self._post_history()
+        response = self.client.get(reverse('custom_account-summary', kwargs={'pk': self.account1.id}),
+                                   {'granularity': 'month'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = {(row['transaction_type'], row['currency'], row['direction']): row for row in response.data['results']}
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[('deposit', 'THB', 'in')]['count'], 2)
+        self.assertEqual(rows[('deposit', 'THB', 'in')]['amount'], '15.00')
+        self.assertEqual(rows[('deposit', 'USD', 'in')]['amount'], '30.00')
+        self.assertEqual(rows[('deposit', 'USD', 'in')]['real_amount'], '1.00')
+        self.assertEqual(rows[('withdraw', 'THB', 'out')]['amount'], '20.00')
+        self.assertEqual(rows[('transfer', 'THB', 'out')]['amount'], '60.00')
+        self.assertEqual(rows[('transfer', 'USD', 'in')]['amount'], '30.00')
+
+        response = self.client.get(reverse('custom_account-summary', kwargs={'pk': self.account2.id}))
+        self.assertEqual({row['direction'] for row in response.data['results']}, {'in', 'out'})
+
+    def test_summary_filters_periods(self):
+        self._post_history()
+        tomorrow = (timezone.now() + timedelta(days=1)).date().isoformat()
+        response = self.client.get(reverse('custom_account-summary', kwargs={'pk': self.account1.id}),
+                                   {'from': tomorrow})
+        self.assertEqual(response.data['results'], [])
+
+        response = self.client.get(reverse('custom_account-summary', kwargs={'pk': self.account1.id}),
+                                   {'granularity': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        self._post_history()
+        incremental = self._rollups()
+        TransactionRollup.objects.all().delete()
+        call_command('rebuild_rollups', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual(self._rollups(), incremental)
+
+
+class LedgerEntryTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'), currency='USD')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user1).access_token}')
+
+    def _entries(self, account):
+        return list(LedgerEntry.objects.filter(account=account).order_by('id').values_list(
+            'transaction__transaction_type', 'sequence', 'amount', 'balance'))
+
+    def _post_history(self):
+        ledger.deposit(self.account1.id, Decimal('10.00'))
+        ledger.withdraw(self.account1.id, Decimal('20.00'))
+        ledger.transfer(self.account1.id, self.account2.id, Decimal('60.00'))
+        ledger.batch_transfer([{'from': self.account2.id, 'to': self.account1.id, 'amount': '1.00', 'currency': 'USD'},
+                               {'from': self.account2.id, 'to': self.account1.id, 'amount': '0.50', 'currency': 'USD'}])
+
+    def test_every_posting_writes_its_entries_with_running_balances(self):
+        self._post_history()
+        self.assertEqual(self._entries(self.account1), [
+            ('deposit', 1, Decimal('10.00'), Decimal('110.00')),
+            ('withdraw', 2, Decimal('-20.00'), Decimal('90.00')),
+            ('transfer', 3, Decimal('-60.00'), Decimal('30.00')),
+            ('transfer', 4, Decimal('30.00'), Decimal('60.00')),
+            ('transfer', 5, Decimal('15.00'), Decimal('75.00')),
+        ])
+        self.assertEqual(self._entries(self.account2), [
+            ('transfer', 1, Decimal('2.00'), Decimal('2.00')),
+            ('transfer', 2, Decimal('-1.00'), Decimal('1.00')),
+            ('transfer', 3, Decimal('-0.50'), Decimal('0.50')),
+        ])
+        for account in (self.account1, self.account2):
+            account.refresh_from_db()
+            latest = LedgerEntry.objects.filter(account=account).latest('sequence')
+            self.assertEqual((account.entry_count, account.balance), (latest.sequence, latest.balance))
+
+    def test_sharded_accounts_number_entries_per_shard(self):
+        shards.reshard(self.account1.id, 2)
+        with mock.patch('accounts.ledger.random.randint', side_effect=[2, 1, 2]):
+            for _ in range(3):
+                ledger.deposit(self.account1.id, Decimal('10.00'))
+        ledger.withdraw(self.account1.id, Decimal('20.00'))
+        self.assertEqual(list(LedgerEntry.objects.filter(account=self.account1).order_by('id')
+                              .values_list('shard', 'sequence', 'balance')),
+                         [(2, 1, None), (1, 1, None), (2, 2, None), (0, 1, None)])
+
+        # A shard that comes back carries on from its last entry
+        shards.reshard(self.account1.id, 0)
+        shards.reshard(self.account1.id, 2)
+        with mock.patch('accounts.ledger.random.randint', return_value=2):
+            ledger.deposit(self.account1.id, Decimal('10.00'))
+        self.assertEqual(LedgerEntry.objects.filter(account=self.account1).latest('id').sequence, 3)
+
+    def test_rebuild_matches_incremental_entries(self):
+        self._post_history()
+        incremental = [self._entries(self.account1), self._entries(self.account2)]
+        LedgerEntry.objects.all().delete()
+        Account.objects.update(entry_count=0)
+        call_command('rebuild_ledger_entries', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual([self._entries(self.account1), self._entries(self.account2)], incremental)
+
+        # Postings after the rebuild carry on from the rebuilt sequence
+        ledger.deposit(self.account1.id, Decimal('5.00'))
+        self.assertEqual(self._entries(self.account1)[-1], ('deposit', 6, Decimal('5.00'), Decimal('80.00')))
+
+    def test_statement_endpoint(self):
+        self._post_history()
+        url = reverse('custom_account-statement', kwargs={'pk': self.account1.id})
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['balance'] for entry in response.data['results']], ['110.00', '90.00'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([entry['sequence'] for entry in response.data['results']], [3, 4])
+
+        later = (timezone.now() + timedelta(seconds=1)).isoformat()
+        self.assertEqual(self.client.get(url, {'from': later}).data['results'], [])
+        self.assertEqual(self.client.get(url, {'to': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('custom_account-statement', kwargs={'pk': 9999})).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+
+class VerifyBalancesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.accounts = [Account.objects.create(user=self.user, balance=Decimal('100.00')) for _ in range(5)]
+        self.accounts.append(Account.objects.create(user=self.user, balance=Decimal('0.00'), currency='USD'))
+        ledger.deposit(self.accounts[0].id, Decimal('10.00'))
+        ledger.withdraw(self.accounts[1].id, Decimal('20.00'))
+        ledger.transfer(self.accounts[2].id, self.accounts[5].id, Decimal('60.00'))
+        ledger.batch_transfer([{'from': self.accounts[5].id, 'to': self.accounts[3].id, 'amount': '1.00',
+                                'currency': 'USD'}])
+        shards.reshard(self.accounts[4].id, 2)
+        ledger.deposit(self.accounts[4].id, Decimal('5.00'))
+
+    def _verify(self, **options):
+        out = io.StringIO()
+        call_command('verify_balances', workers=1, chunk_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_consistent_history_passes(self):
+        self.assertIn('Verified 6 accounts (0 without an opening balance)', self._verify())
+
+    def test_drift_is_reported(self):
+        Account.objects.filter(pk=self.accounts[3].id).update(balance=F('balance') + Decimal('0.01'))
+        BalanceShard.objects.filter(account=self.accounts[4], shard=1).update(balance=F('balance') - 1)
+        with self.assertRaisesMessage(CommandError, '2 balance mismatches'):
+            self._verify()
+
+    def test_resumes_from_checkpoint(self):
+        path = os.path.join(tempfile.mkdtemp(), 'verify.json')
+        self._verify(checkpoint=path)
+        # Drift in chunks the checkpoint already covers is not rescanned
+        Account.objects.filter(pk=self.accounts[0].id).update(balance=0)
+        with mock.patch.object(verification, 'verify_chunk', wraps=verification.verify_chunk) as verify_chunk:
+            self.assertIn('Resuming: 3 chunks already verified', self._verify(checkpoint=path))
+        verify_chunk.assert_not_called()
+
+        with self.assertRaisesMessage(CommandError, 'checkpoint was written with --chunk-size 2'):
+            call_command('verify_balances', workers=1, chunk_size=3, checkpoint=path, stdout=io.StringIO())
+
+
+class BulkImportTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.users = self._write('users.csv', [
+            'id,username,password,password_hash,email',
+            '501,alice,secret-1,,alice@example.com',
+            f'502,bob,,{make_password("secret-2")},',
+        ])
+        self.accounts = self._write('accounts.ndjson', [
+            json.dumps({'id': 701, 'user': 501, 'balance': '150.00', 'created_at': '2020-01-01T00:00:00Z'}),
+            json.dumps({'id': 702, 'user': 502, 'balance': '5.00', 'currency': 'USD',
+                        'created_at': '2020-01-02T00:00:00Z'}),
+            json.dumps({'id': 703, 'user': 502, 'balance': '0'}),
+        ])
+        self.transactions = self._write('transactions.csv', [
+            ','.join(export.EXPORT_COLUMNS),
+            '901,701,,100.00,THB,100.00,THB,,deposit,2020-02-01T00:00:00Z',
+            '902,701,702,30.00,THB,30.00,THB,1.00,transfer,2020-02-02T00:00:00Z',
+            '903,701,,20.00,THB,,,,withdraw,2020-02-03T00:00:00',
+        ])
+
+    def _write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def _import(self, **options):
+        out = io.StringIO()
+        call_command('bulk_import', workers=1, batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_imports_history_and_derives_opening_balances(self):
+        output = self._import(users=self.users, accounts=self.accounts, transactions=self.transactions)
+        self.assertIn('Imported 3 transactions (0 already present)', output)
+        self.assertIn('of 3 accounts', output)
+
+        alice, bob = User.objects.get(pk=501), User.objects.get(pk=502)
+        self.assertTrue(alice.check_password('secret-1'))
+        self.assertTrue(bob.check_password('secret-2'))
+        account = Account.objects.get(pk=701)
+        self.assertEqual(account.balance, Decimal('150.00'))
+        self.assertEqual(account.created_at.year, 2020)
+        self.assertEqual(Transaction.objects.get(pk=903).created_at.month, 2)
+
+        openings = dict(BalanceSnapshot.objects.filter(last_transaction_id__isnull=True)
+                        .values_list('account_id', 'balance'))
+        self.assertEqual(openings, {701: Decimal('100.00'), 702: Decimal('4.00'), 703: Decimal('0.00')})
+        self.assertEqual(list(LedgerEntry.objects.filter(account_id=701).order_by('sequence')
+                              .values_list('sequence', 'balance')),
+                         [(1, Decimal('200.00')), (2, Decimal('170.00')), (3, Decimal('150.00'))])
+        self.assertEqual(Account.objects.get(pk=701).entry_count, 3)
+        self.assertTrue(TransactionRollup.objects.filter(account_id=702, direction='in').exists())
+        self.assertIn('All balances match', self._verify())
+
+    def _verify(self):
+        out = io.StringIO()
+        call_command('verify_balances', workers=1, stdout=out)
+        return out.getvalue()
+
+    def test_resumes_and_skips_loaded_rows(self):
+        checkpoint = os.path.join(self.directory, 'import.json')
+        self._import(users=self.users, accounts=self.accounts, checkpoint=checkpoint, no_finish=True)
+        self.assertFalse(BalanceSnapshot.objects.exists())
+        output = self._import(users=self.users, accounts=self.accounts, transactions=self.transactions,
+                              checkpoint=checkpoint)
+        self.assertIn('Resuming users after 2 rows', output)
+        self.assertIn('Imported 0 users (0 already present)', output)
+        self.assertIn('Imported 3 transactions', output)
+
+        # Without the checkpoint, rows whose ids are already loaded are skipped rather than duplicated
+        self.assertIn('Imported 0 transactions (3 already present)', self._import(transactions=self.transactions))
+        self.assertIn('All balances match', self._verify())
+
+    def test_missing_balance_is_the_net_of_the_history(self):
+        accounts = self._write('unbalanced.csv', ['id,user', '704,501'])
+        transactions = self._write('unbalanced_history.csv', [
+            ','.join(export.EXPORT_COLUMNS),
+            '904,704,,25.00,THB,25.00,THB,,deposit,2020-02-01T00:00:00Z',
+            '905,704,,5.00,THB,,,,withdraw,2020-02-02T00:00:00Z',
+        ])
+        self._import(users=self.users, accounts=accounts, no_finish=True)
+        self.assertTrue(ImportedWithoutBalance.objects.filter(account_id=704).exists())
+        self._import(transactions=transactions)
+        self.assertEqual(Account.objects.get(pk=704).balance, Decimal('20.00'))
+        self.assertEqual(BalanceSnapshot.objects.get(account_id=704).balance, Decimal('0.00'))
+        self.assertFalse(ImportedWithoutBalance.objects.exists())
+        self.assertIn('All balances match', self._verify())
+
+    def test_finishing_leaves_live_accounts_alone(self):
+        live = Account.objects.create(id=700, user=User.objects.create_user(username='carol'))
+        rollup = TransactionRollup.objects.create(account=live, granularity='day', period_start='2020-01-01',
+                                                  transaction_type='deposit', real_currency='THB', direction='in',
+                                                  count=1, amount=Decimal('1.00'), real_amount=Decimal('1.00'))
+        self._import(users=self.users, accounts=self.accounts, transactions=self.transactions)
+        # 700 shares a chunk with imported accounts but has no imported history to rebuild from
+        self.assertTrue(TransactionRollup.objects.filter(pk=rollup.pk).exists())
+
+    def test_bad_row_reports_its_line(self):
+        bad = self._write('bad.csv', [','.join(export.EXPORT_COLUMNS), '901,701,,ten,THB,,,,deposit,'])
+        with self.assertRaisesMessage(CommandError, "transactions: line 2: amount is not a number: 'ten'"):
+            self._import(transactions=bad)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(benchmark.percentile(values, 50), 50.5)
+        self.assertAlmostEqual(benchmark.percentile(values, 99), 99.01)
+        self.assertEqual(benchmark.percentile([3.0], 95), 3.0)
+
+    def test_seed_and_run_scenarios(self):
+        fixture = benchmark.seed(users=3, accounts_per_user=2, transactions=20)
+        self.assertEqual(len(fixture), 3)
+        self.assertEqual(Transaction.objects.count(), 20)
+
+        result = benchmark.run_scenario('transaction_list', fixture, requests=5, concurrency=1, warmup=1)
+        self.assertEqual(result['requests'], 5)
+        self.assertEqual(result['errors'], 0)
+        self.assertLessEqual(result['max_queries'], 2)
+        self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'])
+
+        result = benchmark.run_scenario('transfer', fixture, requests=5, concurrency=1, warmup=0)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(Transaction.objects.count(), 25)
+
+    def test_compare_with_baseline(self):
+        def report(p95, ops, queries):
+            return {'scenarios': {'transfer': {
+                'latency_ms': {'p95': p95}, 'ops_per_sec': ops, 'queries_per_request': queries
+            }}}
+
+        baseline = report(10.0, 100.0, 8)
+        self.assertEqual(benchmark.compare(report(11.0, 90.0, 8), baseline, tolerance=0.2), [])
+        regressions = benchmark.compare(report(13.0, 70.0, 9), baseline, tolerance=0.2)
+        self.assertEqual(len(regressions), 3)
+
+
+class AsyncEndpointTestCase(django_test.TransactionTestCase):
+    """Postings run on threads with connections of their own, which only see committed rows."""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='testuser1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'), currency='THB')
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('0.00'), currency='USD')
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user1).access_token}'}
+        self.addCleanup(authentication.user_status_cache.invalidate)
+        admission.local_buckets.reset()
+        cache.clear()
+
+    async def test_postings_overlap(self):
+        # Both postings have to be running at once to pass the barrier; on the one thread shared by
+        # thread-sensitive calls the second would wait for the first.
+        barrier = threading.Barrier(2, timeout=5)
+        movements = {**async_views.MOVEMENTS, 'deposit': (lambda *args: barrier.wait(), 'deposit successful')}
+        url = reverse('async-deposit', kwargs={'pk': self.account1.id})
+        with mock.patch.dict(async_views.MOVEMENTS, movements):
+            responses = await asyncio.gather(*[
+                self.async_client.post(url, {'amount': 10}, content_type='application/json', headers=self.headers)
+                for _ in range(2)
+            ])
+        self.assertEqual([response.json() for response in responses], [{'status': 'deposit successful'}] * 2)
+
+    @override_settings(RATE_LIMIT_ACCOUNT_RATE=0.01, RATE_LIMIT_ACCOUNT_BURST=1)
+    async def test_async_endpoints_are_admitted(self):
+        url = reverse('async-deposit', kwargs={'pk': self.account1.id})
+        statuses = [(await self.async_client.post(url, {'amount': 1}, content_type='application/json',
+                                                  headers=self.headers)).status_code for _ in range(2)]
+        self.assertEqual(statuses, [status.HTTP_200_OK, status.HTTP_429_TOO_MANY_REQUESTS])
+
+    async def test_deposit_withdraw_and_transfer(self):
+        response = await self.async_client.post(
+            reverse('async-deposit', kwargs={'pk': self.account1.id}), {'amount': 50},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'status': 'deposit successful'})
+
+        response = await self.async_client.post(
+            reverse('async-withdraw', kwargs={'pk': self.account1.id}), {'amount': 500},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'status': 'insufficient funds'})
+
+        response = await self.async_client.post(
+            reverse('async-transfer', kwargs={'pk': self.account1.id}),
+            {'to_account_id': self.account2.id, 'amount': 30, 'currency': 'THB'},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        await self.account1.arefresh_from_db()
+        await self.account2.arefresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('120.00'))
+        self.assertEqual(self.account2.balance, Decimal('1.00'))
+
+    async def test_deposit_is_idempotent(self):
+        url = reverse('async-deposit', kwargs={'pk': self.account1.id})
+        headers = {**self.headers, 'Idempotency-Key': 'async-1'}
+        first = await self.async_client.post(url, {'amount': 10}, content_type='application/json', headers=headers)
+        second = await self.async_client.post(url, {'amount': 10}, content_type='application/json', headers=headers)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        await self.account1.arefresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('110.00'))
+
+    async def test_errors(self):
+        url = reverse('async-deposit', kwargs={'pk': self.account1.id})
+        response = await self.async_client.post(url, {'amount': 10}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.post(url, {'amount': 10}, content_type='application/json',
+                                                headers={'Authorization': 'Bearer not-a-token'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        response = await self.async_client.post(url, {'amount': 'abc'}, content_type='application/json',
+                                                headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = await self.async_client.post(reverse('async-deposit', kwargs={'pk': 9999}), {'amount': 10},
+                                                content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_transaction_list_matches_sync_endpoint(self):
+        for _ in range(3):
+            await self.async_client.post(
+                reverse('async-transfer', kwargs={'pk': self.account1.id}),
+                {'to_account_id': self.account2.id, 'amount': 1}, content_type='application/json',
+                headers=self.headers
+            )
+        response = await self.async_client.get(reverse('async-transaction-list'),
+                                               {'account_id': self.account1.id, 'page_size': 2},
+                                               headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.json()
+        self.assertEqual(len(page['results']), 2)
+        self.assertIsNotNone(page['next'])
+
+        sync_client = APIClient()
+        sync_client.credentials(HTTP_AUTHORIZATION=self.headers['Authorization'])
+        expected = await sync_to_async(sync_client.get)(reverse('transaction-list'),
+                                                         {'account_id': self.account1.id, 'page_size': 2})
+        self.assertEqual(page['results'], json.loads(expected.content)['results'])
+
+        response = await self.async_client.get(page['next'], headers=self.headers)
+        self.assertEqual(len(response.json()['results']), 1)
+
+
+class CachedJWTAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='testuser1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'), currency='THB')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user1).access_token}')
+
+    def test_user_status_is_cached(self):
+        # The account list is not served from the response cache, so the second request still hits the table.
+        url = reverse('account-list')
+        with self.assertNumQueries(2):
+            self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data[0]['balance'], '100.00')
+
+    def test_deactivated_user_is_rejected(self):
+        url = reverse('account-list')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        self.user1.is_active = False
+        self.user1.save()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        # The inactive status is cached as well
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_staff_flag_comes_from_the_database(self):
+        other = User.objects.create_user(username='testuser2', password='password123')
+        Account.objects.create(user=other)
+        self.assertEqual(len(self.client.get(reverse('account-list')).data), 1)
+        self.user1.is_staff = True
+        self.user1.save()
+        self.assertEqual(len(self.client.get(reverse('account-list')).data), 2)
+
+    def test_lru_eviction_and_ttl(self):
+        cache = authentication.UserStatusCache(max_size=2, ttl=60)
+        user_status = authentication.UserStatus(True, False, False, 'a')
+        cache.set(1, user_status)
+        cache.set(2, user_status)
+        cache.get(1)
+        cache.set(3, user_status)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), user_status)
+
+        expired = authentication.UserStatusCache(ttl=0)
+        expired.set(1, user_status)
+        self.assertIsNone(expired.get(1))
+
+
+@override_settings(PROFILING=True)
+class ProfilingTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        profiling.metrics.reset()
+        profiling.slowest_profiles.reset()
+        self.user = User.objects.create_user(username='testuser1', password='password123')
+        self.account = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def _deposit(self, currency='THB'):
+        url = reverse('custom_account-deposit', kwargs={'pk': self.account.id})
+        return self.client.post(url, {'amount': '10.00', 'currency': currency}, format='json')
+
+    def test_server_timing_reports_phases(self):
+        response = self._deposit(currency='USD')
+        phases = dict(metric.split(';', 1) for metric in response['Server-Timing'].split(', '))
+        self.assertEqual(set(phases), {'total', 'db', 'auth', 'fx'})
+        self.assertRegex(phases['db'], r'^dur=[\d.]+;desc="\d+ queries"$')
+
+        response = self.client.get(reverse('account-list'))
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+
+    def test_metrics_endpoint(self):
+        self._deposit()
+        self._deposit()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], profiling.PROMETHEUS_CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('banking_request_duration_seconds_count{view="custom_account-deposit",method="POST"} 2', body)
+        self.assertIn('banking_request_duration_seconds_bucket{view="custom_account-deposit",method="POST",le="+Inf"} 2',
+                      body)
+        self.assertIn('banking_request_phase_seconds_count{view="custom_account-deposit",phase="auth"} 2', body)
+        self.assertRegex(body, r'banking_db_queries_total\{view="custom_account-deposit"\} [1-9]\d*')
+
+    def test_keeps_slowest_profiles(self):
+        directory = tempfile.mkdtemp()
+        with self.settings(PROFILING_SAMPLE_RATE=1, PROFILING_DUMP_DIR=directory, PROFILING_KEEP_SLOWEST=2):
+            for _ in range(4):
+                self._deposit()
+        dumps = os.listdir(directory)
+        self.assertEqual(len(dumps), 2)
+        self.assertTrue(all('ms-custom_account-deposit-' in name and name.endswith('.prof') for name in dumps))
+
+    @override_settings(PROFILING=False)
+    def test_disabled_by_default(self):
+        response = self._deposit()
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ValuationTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='testuser1', password='password123')
+        self.user2 = User.objects.create_user(username='testuser2', password='password123')
+        self.admin = User.objects.create_user(username='admin', password='password123', is_staff=True)
+        Account.objects.create(user=self.user1, balance=Decimal('100.00'), currency='THB')
+        Account.objects.create(user=self.user1, balance=Decimal('200.00'), currency='THB')
+        self.usd = Account.objects.create(user=self.user1, balance=Decimal('10.00'), currency='USD')
+        Account.objects.create(user=self.user2, balance=Decimal('0.01'), currency='USD')
+        shards.reshard(self.usd.id, 2)
+        ledger.deposit(self.usd.id, Decimal('5.00'), 'USD')
+
+    def _get(self, user, url, **params):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        return self.client.get(url, params)
+
+    def test_own_valuation(self):
+        url = reverse('user-me-valuation')
+        response = self._get(self.user1, url, currency='USD')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'user': self.user1.id, 'currency': 'USD', 'total': '25.00', 'balances': [
+            {'currency': 'THB', 'balance': '300.00', 'value': '10.00'},
+            {'currency': 'USD', 'balance': '15.00', 'value': '15.00'},
+        ]})
+        self.assertEqual(self._get(self.user1, url).data['total'], '750.00')
+
+        self._get(self.user2, url)
+        # One grouped query over the account rows and one over their balance shards
+        with self.assertNumQueries(2):
+            self._get(self.user2, url, currency='USD')
+        self.assertEqual(self._get(self.admin, url).data, {'user': self.admin.id, 'currency': 'THB', 'total': '0.00',
+                                                           'balances': []})
+        self.assertEqual(self._get(self.user1, url, currency='XYZ').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_every_user_valuation_is_staff_only(self):
+        url = reverse('user-valuation')
+        self.assertEqual(self._get(self.user1, url).status_code, status.HTTP_403_FORBIDDEN)
+        response = self._get(self.admin, url, currency='THB')
+        self.assertEqual([(row['user'], row['total']) for row in response.data['users']],
+                         [(self.user1.id, '750.00'), (self.user2.id, '0.30')])
+
+
+class AccountEventsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user, balance=Decimal('0.00'))
+        ledger.deposit(self.account1.id, Decimal('10.00'))
+        ledger.transfer(self.account1.id, self.account2.id, Decimal('5.00'))
+        self.entry_ids = list(LedgerEntry.objects.filter(account=self.account1).order_by('id')
+                              .values_list('id', flat=True))
+        self.url = reverse('account-events', kwargs={'pk': self.account1.id})
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+    def _withdraw(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ledger.withdraw(self.account1.id, Decimal('1.00'))
+
+    async def test_long_poll_resumes_after_last_event_id(self):
+        response = await self.async_client.get(self.url, {'last_event_id': '0:0'}, headers=self.headers)
+        self.assertEqual([event['id'] for event in response.json()['events']], self.entry_ids)
+        self.assertEqual(response.json()['events'][1]['amount'], '-5.00')
+        self.assertEqual(response.json()['last_event_id'], '0:2')
+
+        response = await self.async_client.get(self.url, {'timeout': 0},
+                                               headers={**self.headers, 'Last-Event-ID': '0:2'})
+        self.assertEqual(response.json(), {'events': [], 'last_event_id': '0:2'})
+
+        for invalid in ('x', '12', '0:1,'):
+            response = await self.async_client.get(self.url, {'last_event_id': invalid}, headers=self.headers)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for invalid in ('x', 'nan', 'inf', '-1'):
+            response = await self.async_client.get(self.url, {'timeout': invalid}, headers=self.headers)
+            self.assertEqual(response.json(), {'status': 'invalid timeout'})
+        response = await self.async_client.get(reverse('account-events', kwargs={'pk': 0}), headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_committed_posting_wakes_long_poll(self):
+        # Without a last event id the feed starts from the next entry
+        poll = asyncio.ensure_future(self.async_client.get(self.url, {'timeout': 10}, headers=self.headers))
+        while not events.broker.listener_count(self.account1.id):
+            await asyncio.sleep(0.01)
+        txn = await sync_to_async(self._withdraw)()
+        response = await asyncio.wait_for(poll, 5)
+        self.assertEqual([event['transaction'] for event in response.json()['events']], [txn.id])
+        self.assertEqual(events.broker.listener_count(self.account1.id), 0)
+
+    async def test_event_stream(self):
+        headers = {**self.headers, 'Accept': 'text/event-stream', 'Last-Event-ID': '0:1'}
+        response = await self.async_client.get(self.url, headers=headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = response.streaming_content
+        try:
+            self.assertEqual(await content.__anext__(), b'retry: 15000\n\n')
+            chunk = (await content.__anext__()).decode()
+            self.assertTrue(chunk.startswith('id: 0:2\nevent: entry\ndata: '))
+            self.assertEqual(json.loads(chunk.split('data: ')[1])['balance'], '105.00')
+
+            txn = await sync_to_async(self._withdraw)()
+            chunk = (await asyncio.wait_for(content.__anext__(), 5)).decode()
+            self.assertEqual(json.loads(chunk.split('data: ')[1])['transaction'], txn.id)
+        finally:
+            await content.aclose()
+
+    async def test_shard_credit_committed_out_of_id_order_is_delivered(self):
+        await sync_to_async(shards.reshard)(self.account1.id, 2)
+        position = await events.latest_position(self.account1.id)
+        with mock.patch('accounts.ledger.random.randint', side_effect=[1, 2]):
+            first = await sync_to_async(ledger.deposit)(self.account1.id, Decimal('1.00'))
+            second = await sync_to_async(ledger.deposit)(self.account1.id, Decimal('2.00'))
+        # As on a backend with concurrent writers: the first credit took the lower id but commits after a poll
+        # has already seen the second.
+        late = await LedgerEntry.objects.aget(transaction=first)
+        await late.adelete()
+        response = await self.async_client.get(self.url, {'last_event_id': events.format_position(position)},
+                                               headers=self.headers)
+        self.assertEqual([event['transaction'] for event in response.json()['events']], [second.id])
+        self.assertEqual(response.json()['last_event_id'], '0:2,2:1')
+
+        await late.asave()
+        response = await self.async_client.get(self.url, {'last_event_id': response.json()['last_event_id']},
+                                               headers=self.headers)
+        self.assertEqual([event['transaction'] for event in response.json()['events']], [first.id])
+        self.assertEqual(response.json()['last_event_id'], '0:2,1:1,2:1')
+
+
+class AdmissionTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        admission.local_buckets.reset()
+        cache.clear()
+
+    def _deposit(self, account):
+        return self.client.post(reverse('custom_account-deposit', kwargs={'pk': account.id}), {'amount': '1.00'})
+
+    # Refills of one token per 100 seconds leave the test nothing to wait for
+    @override_settings(RATE_LIMIT_USER_RATE=0.01, RATE_LIMIT_USER_BURST=3, RATE_LIMIT_ACCOUNT_RATE=0.01,
+                       RATE_LIMIT_ACCOUNT_BURST=2)
+    def test_rate_limited_per_account_and_user(self):
+        self.assertEqual([self._deposit(self.account1).status_code for _ in range(2)], [200, 200])
+        response = self._deposit(self.account1)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '100')
+        # Refused requests spend no tokens, so the user still has one for the other account
+        self.assertEqual(self._deposit(self.account2).status_code, status.HTTP_200_OK)
+        self.assertEqual(self._deposit(self.account2).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    @override_settings(RATE_LIMIT_USER_RATE=0.01, RATE_LIMIT_USER_BURST=1, RATE_LIMIT_CACHE='default')
+    def test_shared_cache_buckets(self):
+        self.assertEqual(admission.check_rate(self.user.id, self.account1.id), 0)
+        self.assertGreater(admission.check_rate(self.user.id, self.account2.id), 99)
+        self.assertIsNotNone(cache.get(admission.BUCKET_CACHE_KEY.format(f'user:{self.user.id}')))
+        self.assertEqual(admission.local_buckets.take({'user:other': (0.01, 1)}), 0)
+
+    @override_settings(RATE_LIMIT_ACCOUNT_RATE=0, RATE_LIMIT_ACCOUNT_BURST=2)
+    def test_zero_rate_admits_only_the_burst(self):
+        self.assertEqual([self._deposit(self.account1).status_code for _ in range(2)], [200, 200])
+        response = self._deposit(self.account1)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], str(admission.MAX_RETRY_AFTER))
+        with override_settings(RATE_LIMIT_CACHE='default'):
+            self.assertEqual(admission.check_rate(self.user.id, self.account2.id), 0)
+            self.assertEqual(admission.check_rate(self.user.id, self.account2.id), 0)
+            self.assertEqual(admission.check_rate(self.user.id, self.account2.id), math.inf)
+
+    @override_settings(MAX_CONCURRENT_WRITES=1, WRITE_QUEUE_TIMEOUT=0)
+    def test_saturated_writes_are_shed(self):
+        self.assertTrue(admission.write_slots.acquire(1, 0))
+        try:
+            response = self._deposit(self.account1)
+        finally:
+            admission.write_slots.release()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(self._deposit(self.account1).status_code, status.HTTP_200_OK)
+        self.assertEqual(admission.write_slots.active, 0)
+
+
+@override_settings(TRANSACTION_ARCHIVE_AFTER=timedelta(0))
+class TransactionArchiveTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user, balance=Decimal('0.00'), currency='USD')
+        ledger.deposit(self.account1.id, Decimal('10.00'))
+        ledger.transfer(self.account1.id, self.account2.id, Decimal('30.00'))
+        ledger.withdraw(self.account1.id, Decimal('5.00'))
+        ledger.transfer(self.account2.id, self.account1.id, Decimal('0.50'), 'USD')
+        # With a zero horizon everything so far is old enough
+        out = io.StringIO()
+        call_command('archive_transactions', batch_size=3, stdout=out)
+        self.output = out.getvalue()
+        ledger.deposit(self.account2.id, Decimal('2.00'), 'USD')
+        ledger.deposit(self.account1.id, Decimal('1.00'))
+        self.ids = sorted(ArchivedTransaction.objects.values_list('id', flat=True)) + sorted(
+            Transaction.objects.values_list('id', flat=True))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_old_transactions_move_to_archive(self):
+        self.assertIn('Archived 4 transactions', self.output)
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(ArchivedTransaction.objects.count(), 4)
+        # Ledger entries keep their transaction ids
+        self.assertEqual(set(LedgerEntry.objects.values_list('transaction_id', flat=True)), set(self.ids))
+        with override_settings(TRANSACTION_ARCHIVE_AFTER=timedelta(days=1)):
+            self.assertIn('Archived 0 transactions', self._archive())
+
+    def _archive(self):
+        out = io.StringIO()
+        call_command('archive_transactions', stdout=out)
+        return out.getvalue()
+
+    def test_list_pages_across_archive(self):
+        ids, url = [], reverse('transaction-list') + '?page_size=4'
+        while url:
+            response = self.client.get(url)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, self.ids)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([row['id'] for row in response.data['results']], self.ids[:4])
+        response = self.client.get(reverse('transaction-list'), {'account_id': self.account2.id})
+        self.assertEqual([row['id'] for row in response.data['results']], [self.ids[3], self.ids[4]])
+
+    async def test_async_list_pages_across_archive(self):
+        headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+        response = await self.async_client.get(reverse('async-transaction-list'), {'page_size': 5}, headers=headers)
+        self.assertEqual([row['id'] for row in response.json()['results']], self.ids[:5])
+        response = await self.async_client.get(response.json()['next'], headers=headers)
+        self.assertEqual([row['id'] for row in response.json()['results']], self.ids[5:])
+
+    def test_retrieve_and_export_archived(self):
+        response = self.client.get(reverse('transaction-detail', args=[self.ids[1]]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['transaction_type'], response.data['to_account']),
+                         ('transfer', self.account2.id))
+        self.assertEqual(self.client.get(reverse('transaction-detail', args=[0])).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(reverse('transaction-export'))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.ids)
+
+    def test_history_replays_include_archive(self):
+        self.assertIn('Verified 2 accounts', self._verify())
+        self.account1.refresh_from_db()
+        self.assertEqual(snapshots.balance_at(self.account1), self.account1.balance)
+        self.assertEqual(snapshots.balance_at(self.account1, self.account1.created_at), Decimal('100.00'))
+
+        rollup_rows = set(TransactionRollup.objects.values_list('account_id', 'granularity', 'transaction_type',
+                                                                'direction', 'count', 'amount'))
+        rollups.rebuild()
+        self.assertEqual(set(TransactionRollup.objects.values_list(
+            'account_id', 'granularity', 'transaction_type', 'direction', 'count', 'amount')), rollup_rows)
+
+    def test_deleting_an_account_cascades_into_the_archive(self):
+        self.account2.delete()
+        # As in the hot table: its own transactions go, transfers to it lose their counterparty
+        self.assertFalse(ArchivedTransaction.objects.filter(account_id=self.account2.id).exists())
+        self.assertIsNone(ArchivedTransaction.objects.get(pk=self.ids[1]).to_account_id)
+        remaining = [self.ids[0], self.ids[1], self.ids[2], self.ids[5]]
+
+        response = self.client.get(reverse('transaction-list'))
+        self.assertEqual([row['id'] for row in response.data['results']], remaining)
+        self.assertEqual(self.client.get(reverse('transaction-detail', args=[self.ids[3]])).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('transaction-export'))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], remaining)
+
+        call_command('rebuild_ledger_entries', stdout=io.StringIO())
+        self.assertEqual(list(LedgerEntry.objects.order_by('id').values_list('transaction_id', 'amount')), [
+            (self.ids[0], Decimal('10.00')), (self.ids[1], Decimal('-30.00')), (self.ids[2], Decimal('-5.00')),
+            (self.ids[5], Decimal('1.00')),
+        ])
+
+    def test_rebuild_skips_counterparties_it_cannot_load(self):
+        # Rows written without the ORM can still point at an account that is gone
+        ArchivedTransaction.objects.filter(pk=self.ids[1]).update(to_account_id=0)
+        call_command('rebuild_ledger_entries', stdout=io.StringIO())
+        self.assertEqual(LedgerEntry.objects.filter(transaction_id=self.ids[1]).get().account_id, self.account1.id)
+
+    def _verify(self):
+        out = io.StringIO()
+        call_command('verify_balances', workers=1, stdout=out)
+        return out.getvalue()
+
+    def test_archive_off_is_never_read(self):
+        with override_settings(TRANSACTION_ARCHIVE_AFTER=None):
+            with self.assertNumQueries(0):
+                self.assertEqual(archive.history_models(), (Transaction,))
+            with self.assertRaisesMessage(CommandError, 'TRANSACTION_ARCHIVE_AFTER'):
+                self._archive()
+        # Only history from before the newest archived transaction needs the archive
+        self.assertEqual(archive.history_models(timezone.now()), (Transaction,))
+
+
+class ResponseCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create_user(username='testuser1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('50.00'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user1).access_token}')
+        # Warm the user status cache so the query counts below are the view's alone
+        self.client.get(reverse('account-list'))
+
+    def _deposit(self, account, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.deposit(account.id, Decimal(amount))
+
+    def test_account_is_served_from_cache_until_a_posting(self):
+        url = reverse('account-detail', kwargs={'pk': self.account1.id})
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+        self._deposit(self.account1, '5.00')
+        response = self.client.get(url)
+        self.assertEqual(response.data['balance'], '105.00')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_if_none_match_returns_not_modified(self):
+        url = reverse('account-detail', kwargs={'pk': self.account1.id})
+        etag = self.client.get(url)['ETag']
+        cache.delete(response_cache.RESPONSE_CACHE_KEY.format(etag.strip('"')))
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        self._deposit(self.account1, '5.00')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_transaction_history_is_versioned_by_both_accounts(self):
+        self._deposit(self.account1, '5.00')
+        url = reverse('transaction-list')
+        params = {'to_account_id': self.account2.id}
+        etag = self.client.get(url, params)['ETag']
+        self.assertEqual(len(self.client.get(url, {'account_id': self.account1.id}).data['results']), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.transfer(self.account1.id, self.account2.id, Decimal('1.00'))
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(len(self.client.get(url, {'account_id': self.account1.id}).data['results']), 2)
+        # Unfiltered history is never cached
+        self.assertNotIn('ETag', self.client.get(url))
+
+    def test_batch_postings_and_edits_bump_generations(self):
+        generations = response_cache.generations([self.account1.id, self.account2.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.batch_transfer([{'from': self.account1.id, 'to': self.account2.id, 'amount': '1.00'}])
+        bumped = response_cache.generations([self.account1.id, self.account2.id])
+        self.assertEqual(bumped, [generation + 1 for generation in generations])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse('account-detail', kwargs={'pk': self.account1.id}), {'currency': 'USD'})
+        self.assertEqual(response_cache.generations([self.account1.id])[0], bumped[0] + 1)
+
+    def test_misses_are_read_from_the_primary(self):
+        # A lagging replica could otherwise store a pre-posting body under the bumped generation
+        pinned = []
+        get_object = AccountViewSet.get_object
+
+        def recording_get_object(view):
+            pinned.append(db.is_pinned_to_primary())
+            return get_object(view)
+
+        url = reverse('account-detail', kwargs={'pk': self.account1.id})
+        with mock.patch.object(AccountViewSet, 'get_object', recording_get_object):
+            self.client.get(url)
+            self.client.get(url)
+            self._deposit(self.account1, '5.00')
+            self.assertEqual(self.client.get(url).data['balance'], '105.00')
+        self.assertEqual(pinned, [True, True])
+
+    def test_writer_pinned_to_primary_bypasses_cached_reads(self):
+        url = reverse('account-detail', kwargs={'pk': self.account1.id})
+        etag = self.client.get(url)['ETag']
+        with db.pinned_to_primary(), self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ShardedBalanceTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create_user(username='testuser1', password='password123')
+        self.account1 = Account.objects.create(user=self.user1, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user1, balance=Decimal('50.00'))
+        shards.reshard(self.account1.id, 4)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user1).access_token}')
+
+    def _balances(self, account):
+        account.refresh_from_db()
+        return account.balance, sorted(account.balance_shards.values_list('shard', 'balance'))
+
+    def test_credits_go_to_shards_and_reads_sum_them(self):
+        for _ in range(20):
+            ledger.deposit(self.account1.id, Decimal('1.00'))
+        ledger.transfer(self.account2.id, self.account1.id, Decimal('5.00'))
+
+        base, shard_balances = self._balances(self.account1)
+        self.assertEqual(base, Decimal('100.00'))
+        self.assertEqual(len(shard_balances), 4)
+        self.assertEqual(sum(balance for _, balance in shard_balances), Decimal('25.00'))
+
+        self.assertEqual(self.client.get(reverse('account-detail', kwargs={'pk': self.account1.id})).data['balance'],
+                         '125.00')
+        listed = {row['id']: row['balance'] for row in self.client.get(reverse('account-list')).data}
+        self.assertEqual(listed, {self.account1.id: '125.00', self.account2.id: '45.00'})
+        self.assertEqual(self.client.get(reverse('account-list'), {'fields': 'id'}).data[0], {'id': self.account1.id})
+
+    def test_debits_spend_the_account_row_then_shards_in_order(self):
+        BalanceShard.objects.filter(account=self.account1, shard__in=[1, 3]).update(balance=Decimal('10.00'))
+        ledger.withdraw(self.account1.id, Decimal('105.00'))
+        self.assertEqual(self._balances(self.account1),
+                         (Decimal('0.00'), [(1, Decimal('5.00')), (2, 0), (3, Decimal('10.00')), (4, 0)]))
+
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.transfer(self.account1.id, self.account2.id, Decimal('15.01'))
+        ledger.transfer(self.account1.id, self.account2.id, Decimal('15.00'))
+        self.assertEqual(self.account1.total_balance, Decimal('0.00'))
+        self.account2.refresh_from_db()
+        self.assertEqual(self.account2.balance, Decimal('65.00'))
+
+    def test_batch_postings_see_shards(self):
+        BalanceShard.objects.filter(account=self.account1, shard=2).update(balance=Decimal('30.00'))
+        results = ledger.batch_transfer([{'from': self.account1.id, 'to': self.account2.id, 'amount': '120.00'}])
+        self.assertEqual(results[0]['status'], 'ok')
+        # The batch debits the account row, which may go negative while the shards cover it
+        self.assertEqual(self._balances(self.account1)[0], Decimal('-20.00'))
+
+        ledger.withdraw(self.account1.id, Decimal('10.00'))
+        self.assertEqual(self._balances(self.account1), (Decimal('0.00'), [(1, 0), (2, 0), (3, 0), (4, 0)]))
+
+    def test_reshard_keeps_the_total(self):
+        ledger.deposit(self.account1.id, Decimal('7.00'))
+        self.assertEqual(shards.reshard(self.account1.id, 2), Decimal('107.00'))
+        self.assertEqual(self._balances(self.account1), (Decimal('107.00'), [(1, 0), (2, 0)]))
+
+        call_command('shard_account', self.account1.id, shards=0, stdout=io.StringIO())
+        self.assertEqual(self._balances(self.account1), (Decimal('107.00'), []))
+        self.assertEqual(self.account1.shard_count, 0)
+
+    def test_summary_and_snapshots_include_shard_credits(self):
+        for amount in ('1.00', '2.00', '3.00', '4.00', '5.00'):
+            ledger.deposit(self.account1.id, Decimal(amount))
+        response = self.client.get(reverse('custom_account-summary', kwargs={'pk': self.account1.id}))
+        row = response.data['results'][0]
+        self.assertEqual((row['count'], row['amount']), (5, '15.00'))
+
+        call_command('snapshot_balances', stdout=io.StringIO())
+        self.assertEqual(BalanceSnapshot.objects.filter(account=self.account1).latest('id').balance,
+                         Decimal('115.00'))
+        response = self.client.get(reverse('custom_account-balance', kwargs={'pk': self.account1.id}))
+        self.assertEqual(response.data['balance'], '115.00')
+
+
+@override_settings(LEDGER_JOURNAL=True)
+# Not TestCase: the journal writer commits from its own thread and connection
+class JournalTestCase(django_test.TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account1 = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.account2 = Account.objects.create(user=self.user, balance=Decimal('0.00'))
+
+    def test_concurrent_postings_are_group_committed(self):
+        journal.journal._max_delay = 0.05
+        self.addCleanup(setattr, journal.journal, '_max_delay', None)
+
+        def post(i):
+            if i % 2:
+                return ledger.deposit(self.account1.id, Decimal('1.00'))
+            return ledger.transfer(self.account1.id, self.account2.id, Decimal('2.00'))
+
+        with mock.patch.object(ledger, 'post_many', wraps=ledger.post_many) as post_many:
+            with ThreadPoolExecutor(max_workers=20) as pool:
+                txns = list(pool.map(post, range(40)))
+
+        self.assertEqual(len({txn.pk for txn in txns}), 40)
+        # Postings waiting together are committed together
+        self.assertLess(post_many.call_count, 40)
+        self.account1.refresh_from_db()
+        self.account2.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('80.00'))
+        self.assertEqual(self.account2.balance, Decimal('40.00'))
+
+    def test_rejected_posting_does_not_fail_its_group(self):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            overdraw = pool.submit(ledger.withdraw, self.account1.id, Decimal('1000.00'))
+            deposit = pool.submit(ledger.deposit, self.account1.id, Decimal('5.00'))
+            with self.assertRaises(ledger.InsufficientFunds):
+                overdraw.result()
+            self.assertIsInstance(deposit.result(), Transaction)
+        with self.assertRaises(Account.DoesNotExist):
+            ledger.deposit(9999, Decimal('1.00'))
+        self.account1.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('105.00'))
+
+
+@override_settings(LEDGER_JOURNAL=True)
+class JournalFileDatabaseTestCase(django_test.TransactionTestCase):
+    """The journal against a SQLite file, whose write lock (unlike the in-memory test database's) is per file."""
+
+    def setUp(self):
+        # A short busy timeout, so a writer stuck behind a held lock fails fast
+        short_timeout = override_settings(SQLITE_PRAGMAS={**settings.SQLITE_PRAGMAS, 'busy_timeout': 1000})
+        short_timeout.enable()
+        self.addCleanup(short_timeout.disable)
+        default = connections.settings['default']
+        self._use_database({**default, 'NAME': os.path.join(tempfile.mkdtemp(), 'journal.sqlite3'),
+                            'OPTIONS': {**default['OPTIONS'], 'timeout': 1}})
+        self.addCleanup(self._use_database, default)
+        call_command('migrate', verbosity=0)
+        # A writer of its own, whose thread connects to the file
+        patcher = mock.patch.object(journal, 'journal', journal.Journal())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(authentication.user_status_cache.invalidate)
+
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.account = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def _use_database(self, settings_dict):
+        connections['default'].close()
+        connections.settings['default'] = settings_dict
+        del connections['default']
+
+    def test_idempotent_posting_through_journal(self):
+        url = reverse('custom_account-deposit', kwargs={'pk': self.account.id})
+        first = self.client.post(url, {'amount': '5.00'}, format='json', HTTP_IDEMPOTENCY_KEY='journal-1')
+        second = self.client.post(url, {'amount': '5.00'}, format='json', HTTP_IDEMPOTENCY_KEY='journal-1')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal('105.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+class DatabaseTuningTestCase(TestCase):
+    databases = {'default', 'readonly'}
+
+    def test_pragmas_are_applied(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+            cursor.execute('PRAGMA query_only')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        with connections['readonly'].cursor() as cursor:
+            cursor.execute('PRAGMA query_only')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_router(self):
+        router = db.ReadOnlyRouter()
+        self.assertIsNone(router.db_for_read(Transaction))
+        with db.reading_from('readonly'):
+            # TestCase runs every test in a transaction, and reads inside one stay on it.
+            self.assertIsNone(router.db_for_read(Transaction))
+            with mock.patch.object(connections['default'], 'in_atomic_block', False):
+                self.assertEqual(router.db_for_read(Transaction), 'readonly')
+        self.assertEqual(router.db_for_write(Transaction), 'default')
+        self.assertFalse(router.allow_migrate('readonly', 'accounts'))
+        self.assertTrue(router.allow_migrate('default', 'accounts'))
+
+
+class ReadOnlyRoutingTestCase(django_test.TransactionTestCase):
+    databases = {'default', 'readonly'}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser1', password='password123')
+        self.account = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+        ledger.deposit(self.account.id, Decimal('1.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_transaction_reads_use_the_read_only_connection(self):
+        with self.assertNumQueries(0, using='default'), self.assertNumQueries(2, using='readonly'):
+            response = self.client.get(reverse('transaction-list'))
+        self.assertEqual(len(response.data['results']), 1)
+        # Writes are unaffected
+        with self.assertNumQueries(0, using='readonly'):
+            response = self.client.post(reverse('custom_account-deposit', kwargs={'pk': self.account.id}),
+                                        {'amount': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ReplicaRoutingTestCase(django_test.TransactionTestCase):
+    """Primary is the test database, the replica a second SQLite file that never catches up."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser1', password='password123')
+        self.account = Account.objects.create(user=self.user, balance=Decimal('100.00'))
+
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite3')
+        connections.settings['replica'] = {**connections['default'].settings_dict, 'NAME': replica_path}
+        self.addCleanup(self._drop_replica)
+        call_command('migrate', database='replica', verbosity=0)
+        # The replica starts as a copy of the primary; later writes never reach it.
+        self.user.save(using='replica')
+        self.account.save(using='replica')
+
+        replica_settings = override_settings(READ_ONLY_DATABASE='replica')
+        replica_settings.enable()
+        self.addCleanup(replica_settings.disable)
+        self.addCleanup(authentication.user_status_cache.invalidate)
+        self.token = f'Bearer {RefreshToken.for_user(self.user).access_token}'
+
+    def _drop_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def _client(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=self.token)
+        return client
+
+    def _transaction_count(self, client):
+        return len(client.get(reverse('transaction-list')).data['results'])
+
+    def test_reads_go_to_the_replica(self):
+        Account.objects.filter(pk=self.account.pk).update(balance=Decimal('1.00'))
+        response = self._client().get(reverse('account-list'))
+        self.assertEqual(response.data[0]['balance'], '100.00')
+        # Response-cache misses are read from the primary, so the cache never holds the replica's stale body
+        response = self._client().get(reverse('account-detail', kwargs={'pk': self.account.id}))
+        self.assertEqual(response.data['balance'], '1.00')
+
+    def test_writer_reads_its_own_writes(self):
+        client = self._client()
+        response = client.post(reverse('custom_account-deposit', kwargs={'pk': self.account.id}), {'amount': 5},
+                               format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(middleware.PRIMARY_PIN_COOKIE, response.cookies)
+
+        # Pinned by the cookie
+        self.assertEqual(self._transaction_count(client), 1)
+        self.assertEqual(client.get(reverse('account-detail', kwargs={'pk': self.account.id})).data['balance'],
+                         '105.00')
+        # Pinned by the token's user id, for clients that drop cookies
+        self.assertEqual(self._transaction_count(self._client()), 1)
+
+        # Once the pin expires reads go back to the (stale) replica
+        cache.delete(middleware.PRIMARY_PIN_CACHE_KEY.format(self.user.id))
+        self.assertEqual(self._transaction_count(self._client()), 0)
+        with override_settings(PRIMARY_PIN_SECONDS=-1):
+            self.assertEqual(self._transaction_count(client), 0)
+
+    def test_failed_write_does_not_pin(self):
+        client = self._client()
+        response = client.post(reverse('custom_account-withdraw', kwargs={'pk': self.account.id}), {'amount': 500},
+                               format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn(middleware.PRIMARY_PIN_COOKIE, response.cookies)
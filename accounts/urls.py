@@ -1,12 +1,20 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AccountViewSet, TransactionViewSet, CustomAccountViewSet
+from . import async_views
+from .views import AccountViewSet, TransactionViewSet, CustomAccountViewSet, TransferViewSet, UserViewSet
 
 router = DefaultRouter()
 router.register(r'accounts', AccountViewSet)
 router.register(r'transactions', TransactionViewSet)
 router.register(r'accounts', CustomAccountViewSet, basename='custom_account')
+router.register(r'transfers', TransferViewSet, basename='transfer')
+router.register(r'users', UserViewSet, basename='user')
 
 urlpatterns = [
+    path('accounts/<int:pk>/events/', async_views.account_events, name='account-events'),
     path('', include(router.urls)),
+    path('async/accounts/<int:pk>/deposit/', async_views.deposit, name='async-deposit'),
+    path('async/accounts/<int:pk>/withdraw/', async_views.withdraw, name='async-withdraw'),
+    path('async/accounts/<int:pk>/transfer/', async_views.transfer, name='async-transfer'),
+    path('async/transactions/', async_views.transaction_list, name='async-transaction-list'),
 ]
@@ -0,0 +1,63 @@
+from decimal import Decimal
+
+from django.db.models import Sum
+
+from .fx import UnknownCurrency, rate_cache
+from .ledger import to_cents
+from .models import Account, BalanceShard
+
+
+def balances_by_currency(user_id=None):
+    """
+    `{user id: {currency: total balance}}` of one user's accounts, or of every user's.
+
+    Two grouped queries do the adding up, one over the account rows and one over
+    their balance shards (see `accounts.shards`), so no account row reaches Python.
+    """
+    accounts = Account.objects.all()
+    shards = BalanceShard.objects.all()
+    if user_id is not None:
+        accounts = accounts.filter(user_id=user_id)
+        shards = shards.filter(account__user_id=user_id)
+
+    totals = {}
+    grouped = accounts.values('user_id', 'currency').annotate(total=Sum('balance'))
+    for user_id, currency, total in grouped.values_list('user_id', 'currency', 'total'):
+        totals.setdefault(user_id, {})[currency] = total
+    grouped = shards.values('account__user_id', 'account__currency').annotate(total=Sum('balance'))
+    for user_id, currency, total in grouped.values_list('account__user_id', 'account__currency', 'total'):
+        user_totals = totals.setdefault(user_id, {})
+        user_totals[currency] = user_totals.get(currency, Decimal(0)) + total
+    return totals
+
+
+def valuate(totals, currency):
+    """
+    Value each user's per-currency totals (see `balances_by_currency`) in `currency`.
+
+    Returns `{user id: {'total', 'balances'}}`, amounts as cent strings. One
+    rate snapshot covers the whole run. Each currency total is converted once,
+    with the multiply-then-divide of `RateCache.convert`, and only the figures
+    shown are rounded. Raises `UnknownCurrency` for a currency without a rate.
+    """
+    rates = rate_cache.rates()
+    if currency not in rates:
+        raise UnknownCurrency(currency)
+
+    valuations = {}
+    for user_id, user_totals in totals.items():
+        total = Decimal(0)
+        balances = []
+        for balance_currency, balance in sorted(user_totals.items()):
+            if balance_currency == currency:
+                value = balance
+            else:
+                try:
+                    value = balance * rates[currency] / rates[balance_currency]
+                except KeyError as e:
+                    raise UnknownCurrency(e.args[0])
+            total += value
+            balances.append({'currency': balance_currency, 'balance': str(to_cents(balance)),
+                             'value': str(to_cents(value))})
+        valuations[user_id] = {'total': str(to_cents(total)), 'balances': balances}
+    return valuations
@@ -0,0 +1,158 @@
+import json
+import os
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Sum, When
+
+from . import archive, convert, db, shards
+from .models import Account, BalanceSnapshot
+
+CENT = Decimal('0.01')
+
+
+def _on(field, lookups):
+    """Filter kwargs applying each `{lookup: value}` to `field` (foreign keys have no `range` lookup)."""
+    return {f'{field}__{lookup}': value for lookup, value in lookups.items()}
+
+
+def net_changes(lookups):
+    """
+    Net effect of every posting on each account whose id matches `lookups`, in
+    the account's currency; accounts without postings are left out.
+
+    Each side of the history is one grouped query over all the accounts, per
+    table when some of it is archived.
+    """
+    changes = {}
+    for model in archive.history_models():
+        _add_net_changes(changes, model, lookups)
+    return changes
+
+
+def _add_net_changes(changes, model, lookups):
+    outgoing = model.objects.filter(**_on('account_id', lookups)).values('account_id').annotate(
+        total=Sum(Case(
+            When(transaction_type='deposit', then=F('amount')),
+            default=-F('amount'),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ))
+    ).values_list('account_id', 'total')
+    incoming = model.objects.filter(**_on('to_account_id', lookups), transaction_type='transfer')
+    credited = incoming.values('to_account_id').annotate(total=Sum('to_amount')).values_list('to_account_id', 'total')
+    for account_id, total in list(outgoing) + list(credited):
+        if total is not None:
+            changes[account_id] = changes.get(account_id, Decimal(0)) + total
+
+    # Transfers written before `to_amount` was recorded are converted at today's rate.
+    legacy = incoming.filter(to_amount__isnull=True).values_list('to_account_id', 'to_account__currency',
+                                                                 'real_currency', 'real_amount')
+    for account_id, currency, real_currency, real_amount in legacy:
+        changes[account_id] = changes.get(account_id, Decimal(0)) + convert(real_currency, currency, real_amount)
+
+
+def _history(lookups):
+    """
+    Opening balance plus the net of every posting, per account, for the accounts whose id matches `lookups`.
+
+    Accounts without an opening snapshot (e.g. bulk loads not yet finished)
+    cannot be checked and are left out.
+    """
+    expected = {}
+    openings = (BalanceSnapshot.objects.filter(**_on('account_id', lookups), last_transaction_id__isnull=True)
+                .order_by('as_of').values_list('account_id', 'balance'))
+    for account_id, balance in openings:
+        expected.setdefault(account_id, balance)
+    for account_id, change in net_changes(lookups).items():
+        if account_id in expected:
+            expected[account_id] += change
+    return expected
+
+
+def _balances(lookups, lock=False):
+    """Stored total balance (row plus shards) of the accounts whose id matches `lookups`."""
+    accounts = Account.objects.filter(**_on('pk', lookups)).order_by('pk')
+    if lock:
+        accounts = accounts.select_for_update()
+    rows = list(accounts.values_list('id', 'balance', 'shard_count'))
+    balances = {account_id: balance for account_id, balance, _ in rows}
+    sharded = [account_id for account_id, _, shard_count in rows if shard_count]
+    for account_id, total in shards.shard_totals(sharded, lock=lock).items():
+        balances[account_id] += total
+    return balances
+
+
+def _mismatches(balances, expected):
+    return {
+        account_id: (balance, expected[account_id])
+        for account_id, balance in balances.items()
+        if account_id in expected and balance.quantize(CENT) != expected[account_id].quantize(CENT)
+    }
+
+
+def verify_chunk(bounds):
+    """
+    Verify the accounts with ids in the inclusive `bounds` range; returns a JSON-ready result.
+
+    The scan reads the read-only database without locks, so postings racing it
+    can look like drift. Suspects are checked again on the primary with their
+    rows (and shards) locked, and only those still off are reported.
+    """
+    low, high = bounds
+    with db.reading_from(db.read_only_database()):
+        balances = _balances({'gte': low, 'lte': high})
+        expected = _history({'gte': low, 'lte': high})
+
+    mismatches = _mismatches(balances, expected)
+    if mismatches:
+        with transaction.atomic():
+            ids = {'in': sorted(mismatches)}
+            mismatches = _mismatches(_balances(ids, lock=True), _history(ids))
+
+    checked = sum(1 for account_id in balances if account_id in expected)
+    return {
+        'start': low,
+        'end': high,
+        'checked': checked,
+        'unverified': len(balances) - checked,
+        'mismatches': [
+            {'account': account_id, 'balance': str(balance), 'expected': str(expected_balance.quantize(CENT)),
+             'difference': str((balance - expected_balance).quantize(CENT))}
+            for account_id, (balance, expected_balance) in sorted(mismatches.items())
+        ],
+    }
+
+
+def chunks(low, high, chunk_size):
+    return [(start, min(start + chunk_size - 1, high)) for start in range(low, high + 1, chunk_size)]
+
+
+class Checkpoint:
+    """
+    Results of the chunks verified so far, kept in a JSON file so an interrupted
+    run resumes where it stopped. Each write replaces the file atomically.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.results = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state['chunk_size'] != chunk_size:
+                raise ValueError(f'checkpoint was written with --chunk-size {state["chunk_size"]}')
+            self.results = {result['start']: result for result in state['results']}
+
+    def done(self, bounds):
+        # A final chunk that has grown since (new accounts) is verified again.
+        return self.results.get(bounds[0], {}).get('end') == bounds[1]
+
+    def record(self, result):
+        self.results[result['start']] = result
+        if not self.path:
+            return
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'chunk_size': self.chunk_size, 'results': list(self.results.values())}, f)
+        os.replace(temporary, self.path)
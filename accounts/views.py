@@ -1,18 +1,101 @@
-from decimal import Decimal
+import heapq
 
+from django.db.models import Sum
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets
 
-from . import convert
-from .models import Account, Transaction, User
-from .serializers import AccountSerializer, TransactionSerializer, UserSerializer
+from . import archive, db, ledger, profiling, rollups, shards, snapshots, valuation
+from .admission import admitted
+from .response_cache import cached_by_account
+from .idempotency import IDEMPOTENCY_HEADER, idempotent
+from .fx import UnknownCurrency
+from .export import STREAMERS, CSVRenderer, NDJSONRenderer, export_rows
+from .models import CURRENCY_CHOICES, Account, ArchivedTransaction, LedgerEntry, Transaction, TransactionRollup, User
+from .pagination import KeysetCursorPagination
+from .serializers import AccountSerializer, LedgerEntrySerializer, TransactionSerializer, UserSerializer
 
 # Custom views for deposit, withdraw, transfer
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from rest_framework import status, generics, permissions
+from rest_framework import status, generics, permissions, serializers
+
+
+CURRENCY_CODES = [code for code, _ in CURRENCY_CHOICES]
+
+FIELDS_PARAMETER = openapi.Parameter(
+    'fields', openapi.IN_QUERY, description="Comma-separated list of fields to return (default: all)",
+    type=openapi.TYPE_STRING
+)
+
+TRANSACTION_FILTER_PARAMETERS = [
+    openapi.Parameter(
+        'account_id', openapi.IN_QUERY, description="ID of the account to filter transactions",
+        type=openapi.TYPE_INTEGER
+    ),
+    openapi.Parameter(
+        'to_account_id', openapi.IN_QUERY, description="ID of the to_account to filter transactions",
+        type=openapi.TYPE_INTEGER
+    ),
+    openapi.Parameter(
+        'transaction_type', openapi.IN_QUERY,
+        description="Type of the transaction to filter (deposit, withdraw, transfer)", type=openapi.TYPE_STRING
+    ),
+    openapi.Parameter(
+        'transaction_currency', openapi.IN_QUERY,
+        description="Currency of the transaction to filter (e.g. THB, USD)", type=openapi.TYPE_STRING
+    ),
+]
+
+ADMISSION_RESPONSES = {429: 'Rate limit exceeded (see Retry-After)', 503: 'Server busy (see Retry-After)'}
+
+IDEMPOTENCY_KEY_PARAMETER = openapi.Parameter(
+    IDEMPOTENCY_HEADER, openapi.IN_HEADER, type=openapi.TYPE_STRING,
+    description="Unique key for safely retrying the request; repeats return the stored response"
+)
+
+
+def filter_transactions(queryset, query_params):
+    account_id = query_params.get('account_id')
+    to_account_id = query_params.get('to_account_id')
+    transaction_type = query_params.get('transaction_type')
+    transaction_currency = query_params.get('transaction_currency')
+
+    if account_id:
+        queryset = queryset.filter(account_id=account_id)
+    if to_account_id:
+        queryset = queryset.filter(to_account_id=to_account_id)
+    if transaction_type:
+        queryset = queryset.filter(transaction_type=transaction_type)
+    if transaction_currency:
+        queryset = queryset.filter(real_currency=transaction_currency)
+
+    return queryset
+
+
+def retrieved_account(view, request, kwargs):
+    pk = str(kwargs.get('pk', ''))
+    return [int(pk)] if pk.isdigit() else None
+
+
+def filtered_accounts(view, request, kwargs):
+    # Only history narrowed to particular accounts is versioned by their generations.
+    ids = [request.query_params.get(name) for name in ('account_id', 'to_account_id')]
+    ids = [account_id for account_id in ids if account_id]
+    if not ids or not all(account_id.isdigit() for account_id in ids):
+        return None
+    return [int(account_id) for account_id in ids]
+
+
+def metrics(request):
+    """Request metrics of this process in Prometheus text format; 404 unless `PROFILING` is on."""
+    if not profiling.enabled():
+        raise Http404
+    return HttpResponse(profiling.metrics.render(), content_type=profiling.PROMETHEUS_CONTENT_TYPE)
 
 
 class UserCreateView(generics.CreateAPIView):
@@ -34,60 +117,126 @@ class AccountViewSet(viewsets.ModelViewSet):
     serializer_class = AccountSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @swagger_auto_schema(manual_parameters=[FIELDS_PARAMETER])
+    def list(self, request, *args, **kwargs):
+        with db.reading_from(db.read_only_database()):
+            return super().list(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        # Write back only what the client sent: a full save would also write the ledger's counters as they were read,
+        # rolling back any posting that committed in between.
+        account = serializer.instance
+        for field, value in serializer.validated_data.items():
+            setattr(account, field, value)
+        account.save(update_fields=list(serializer.validated_data))
+
+    @swagger_auto_schema(manual_parameters=[FIELDS_PARAMETER])
+    @cached_by_account(retrieved_account)
+    def retrieve(self, request, *args, **kwargs):
+        with db.reading_from(db.read_only_database()):
+            return super().retrieve(request, *args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            # Regular users only list their own accounts
+            if not self.request.user.is_staff:
+                queryset = queryset.filter(user_id=self.request.user.id)
+            queryset = queryset.order_by('id')
+        if self.action in ('list', 'retrieve'):
+            attributes = AccountSerializer.source_attributes(self.request)
+            if 'total_balance' in attributes:
+                queryset = shards.with_total_balance(queryset)
+                attributes = [name for name in attributes if name != 'total_balance'] + ['balance', 'shard_count']
+            queryset = queryset.only(*attributes)
+        return queryset
+
 
 class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetCursorPagination
+
+    def dispatch(self, request, *args, **kwargs):
+        # Every action here is a history read, served from the read-only connection.
+        with db.reading_from(db.read_only_database()):
+            return super().dispatch(request, *args, **kwargs)
 
     @swagger_auto_schema(
-        manual_parameters=[
+        manual_parameters=TRANSACTION_FILTER_PARAMETERS + [
             openapi.Parameter(
-                'account_id', openapi.IN_QUERY, description="ID of the account to filter transactions",
-                type=openapi.TYPE_INTEGER
+                'cursor', openapi.IN_QUERY, description="Pagination cursor taken from the next/previous link",
+                type=openapi.TYPE_STRING
             ),
             openapi.Parameter(
-                'to_account_id', openapi.IN_QUERY, description="ID of the to_account to filter transactions",
+                'page_size', openapi.IN_QUERY, description="Number of transactions per page (max 1000)",
                 type=openapi.TYPE_INTEGER
             ),
-            openapi.Parameter(
-                'transaction_type', openapi.IN_QUERY,
-                description="Type of the transaction to filter (deposit, withdraw, transfer)", type=openapi.TYPE_STRING
-            ),
-            openapi.Parameter(
-                'transaction_currency', openapi.IN_QUERY,
-                description="Currency of the transaction to filter (THB, USD)", type=openapi.TYPE_STRING
-            ),
+            FIELDS_PARAMETER,
         ]
     )
+    @cached_by_account(filtered_accounts)
     def list(self, request, *args, **kwargs):
+        # Plain value dicts are enough for the lean serializer; the cursor also needs created_at and id.
+        columns = set(TransactionSerializer.source_attributes(request)) | {'created_at', 'id'}
+        querysets = [self.filter_queryset(self.get_queryset()).values(*columns)]
+        if archive.reaches(self.paginator.lower_bound(request), archive.archived_through()):
+            querysets.append(filter_transactions(ArchivedTransaction.objects.all(), request.query_params)
+                             .values(*columns))
+        page = self.paginator.paginate_querysets(querysets, request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_description="Stream the filtered transaction history as NDJSON (default) or CSV.",
+        manual_parameters=TRANSACTION_FILTER_PARAMETERS + [
+            openapi.Parameter(
+                'format', openapi.IN_QUERY, description="Export format", type=openapi.TYPE_STRING,
+                enum=['ndjson', 'csv'], default='ndjson'
+            ),
+        ],
+        responses={200: 'Transaction rows, one per line'}
+    )
+    @action(detail=False, methods=['get'], renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        export_format = request.accepted_renderer.format
         queryset = self.filter_queryset(self.get_queryset())
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        # Rows stream after dispatch returns, so fix the connection now.
+        rows = export_rows(queryset.using(queryset.db))
+        if archive.archived_through() is not None:
+            archived = filter_transactions(ArchivedTransaction.objects.all(), request.query_params)
+            # Both tables stream in (created_at, id) order; merge them into one.
+            rows = heapq.merge(export_rows(archived.using(archived.db)), rows, key=lambda row: (row[-1], row[0]))
+        response = StreamingHttpResponse(STREAMERS[export_format](rows), content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="transactions.{export_format}"'
+        return response
+
+    @swagger_auto_schema(manual_parameters=[FIELDS_PARAMETER])
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            if archive.archived_through() is None:
+                raise
+        # Not in the hot table: the transaction may have been archived.
+        fields = TransactionSerializer.source_attributes(request)
+        instance = generics.get_object_or_404(ArchivedTransaction.objects.only(*fields), pk=kwargs['pk'])
+        return Response(self.get_serializer(instance).data)
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        account_id = self.request.query_params.get('account_id')
-        to_account_id = self.request.query_params.get('to_account_id')
-        transaction_type = self.request.query_params.get('transaction_type')
-        transaction_currency = self.request.query_params.get('transaction_currency')
-
-        if account_id:
-            queryset = queryset.filter(account_id=account_id)
-        if to_account_id:
-            queryset = queryset.filter(to_account_id=to_account_id)
-        if transaction_type:
-            queryset = queryset.filter(transaction_type=transaction_type)
-        if transaction_currency:
-            queryset = queryset.filter(real_currency=transaction_currency)
+        if self.action == 'retrieve':
+            return queryset.only(*TransactionSerializer.source_attributes(self.request))
 
-        return queryset
+        return filter_transactions(queryset, self.request.query_params)
 
 
 class CustomAccountViewSet(viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     @swagger_auto_schema(
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
         operation_description="Deposit an amount into a specific bank account.",
         request_body=openapi.Schema(
             title='Body',
@@ -95,40 +244,30 @@ class CustomAccountViewSet(viewsets.ViewSet):
             properties={
                 'amount': openapi.Schema(type=openapi.TYPE_NUMBER, description='Amount to deposit'),
                 'currency': openapi.Schema(type=openapi.TYPE_STRING, description='Currency of the deposit',
-                                           enum=['THB', 'USD'], default='THB')
+                                           enum=CURRENCY_CODES, default='THB')
             },
             required=['amount']
         ),
-        responses={200: 'Deposit successful'}
+        responses={200: 'Deposit successful', 400: 'Invalid amount / unsupported currency', 404: 'Account not found',
+                   **ADMISSION_RESPONSES}
     )
     @action(detail=True, methods=['post'])
+    @admitted
+    @idempotent
     def deposit(self, request, pk=None):
-        # Update account
-        account = Account.objects.get(pk=pk)
-        amount = Decimal(request.data.get('amount'))
         currency = request.data.get('currency', 'THB')
 
-        if account.currency != currency:
-            converted_amount = convert(currency, account.currency, amount)
-        else:
-            converted_amount = amount
-
-        account.balance += converted_amount
-        account.save()
-
-        # Save transaction as incoming currency
-        Transaction.objects.create(
-            account=account,
-            amount=converted_amount,
-            currency=account.currency,
-            real_amount=amount,
-            real_currency=currency,
-            transaction_type='deposit'
-        )
+        try:
+            ledger.deposit(pk, request.data.get('amount'), currency)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.LedgerError as e:
+            return Response({'status': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'status': 'deposit successful'})
 
     @swagger_auto_schema(
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
         operation_description="Withdraw an amount from a specific bank account.",
         request_body=openapi.Schema(
             title='Body',
@@ -136,41 +275,30 @@ class CustomAccountViewSet(viewsets.ViewSet):
             properties={
                 'amount': openapi.Schema(type=openapi.TYPE_NUMBER, description='Amount to withdraw'),
                 'currency': openapi.Schema(type=openapi.TYPE_STRING, description='Currency of the deposit',
-                                           enum=['THB', 'USD'], default='THB')
+                                           enum=CURRENCY_CODES, default='THB')
             },
             required=['amount']
         ),
-        responses={200: 'Withdraw successful', 400: 'Insufficient funds'}
+        responses={200: 'Withdraw successful', 400: 'Invalid amount / insufficient funds', 404: 'Account not found',
+                   **ADMISSION_RESPONSES}
     )
     @action(detail=True, methods=['post'])
+    @admitted
+    @idempotent
     def withdraw(self, request, pk=None):
-        account = Account.objects.get(pk=pk)
-        amount = Decimal(request.data.get('amount'))
         currency = request.data.get('currency', 'THB')
 
-        if account.currency != currency:
-            converted_amount = convert(currency, account.currency, amount)
-        else:
-            converted_amount = amount
-
-        if account.balance >= converted_amount:
-            account.balance -= converted_amount
-            account.save()
+        try:
+            ledger.withdraw(pk, request.data.get('amount'), currency)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.LedgerError as e:
+            return Response({'status': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Save transaction
-            Transaction.objects.create(
-                account=account,
-                amount=converted_amount,
-                currency=account.currency,
-                real_amount=amount,
-                real_currency=currency,
-                transaction_type='withdraw'
-            )
-
-            return Response({'status': 'withdraw successful'})
-        return Response({'status': 'insufficient funds'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'status': 'withdraw successful'})
 
     @swagger_auto_schema(
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
         operation_description="Transfer an amount from one bank account to another.",
         request_body=openapi.Schema(
             title='Body',
@@ -180,49 +308,289 @@ class CustomAccountViewSet(viewsets.ViewSet):
                                                 description='ID of the account to transfer to'),
                 'amount': openapi.Schema(type=openapi.TYPE_NUMBER, description='Amount to transfer'),
                 'currency': openapi.Schema(type=openapi.TYPE_STRING, description='Currency of the deposit',
-                                           enum=['THB', 'USD'], default='THB')
+                                           enum=CURRENCY_CODES, default='THB')
             },
             required=['to_account_id', 'amount']
         ),
-        responses={200: 'Transfer successful', 400: 'Insufficient funds / Cannot transfer to the same account'}
+        responses={200: 'Transfer successful',
+                   400: 'Invalid amount or account / Insufficient funds / Cannot transfer to the same account',
+                   404: 'Account not found', **ADMISSION_RESPONSES}
     )
     @action(detail=True, methods=['post'])
+    @admitted
+    @idempotent
     def transfer(self, request, pk=None):
-        from_account = Account.objects.get(pk=pk)
         to_account_id = request.data.get('to_account_id')
-        amount = Decimal(request.data.get('amount'))
         currency = request.data.get('currency', 'THB')
-        to_account = Account.objects.get(id=to_account_id)
 
-        if from_account.id == to_account.id:
-            return Response({'status': 'cannot transfer to the same account'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ledger.transfer(pk, to_account_id, request.data.get('amount'), currency)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.LedgerError as e:
+            return Response({'status': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
-        if from_account.currency != currency:
-            amount_in_from_currency = convert(currency, from_account.currency, amount)
-        else:
-            amount_in_from_currency = amount
+        return Response({'status': 'transfer successful'})
 
-        if to_account.currency != currency:
-            amount_in_to_currency = convert(currency, to_account.currency, amount)
+    @swagger_auto_schema(
+        operation_description="Balance of a bank account at a point in time.",
+        manual_parameters=[
+            openapi.Parameter(
+                'at', openapi.IN_QUERY, description="ISO 8601 timestamp (defaults to now)",
+                type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME
+            ),
+        ],
+        responses={200: 'Balance at the requested time', 400: 'Invalid timestamp', 404: 'Account not found'}
+    )
+    @action(detail=True, methods=['get'])
+    def balance(self, request, pk=None):
+        at = request.query_params.get('at')
+        if at:
+            try:
+                at = parse_datetime(at)
+            except ValueError:
+                at = None
+            if at is None:
+                return Response({'status': 'invalid timestamp'}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
         else:
-            amount_in_to_currency = amount
-
-        if from_account.balance >= amount_in_from_currency:
-            from_account.balance -= amount_in_from_currency
-            to_account.balance += amount_in_to_currency
-            from_account.save()
-            to_account.save()
-
-            # Save transaction
-            Transaction.objects.create(
-                account=from_account,
-                to_account=to_account,
-                amount=amount_in_from_currency,
-                currency=from_account.currency,
-                real_amount=amount,
-                real_currency=currency,
-                transaction_type='transfer'
-            )
-
-            return Response({'status': 'transfer successful'})
-        return Response({'status': 'insufficient funds'}, status=status.HTTP_400_BAD_REQUEST)
+            at = timezone.now()
+
+        try:
+            account = Account.objects.only('id', 'currency').get(pk=pk)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'account': account.id,
+            'at': at,
+            'balance': str(ledger.to_cents(snapshots.balance_at(account, at))),
+            'currency': account.currency,
+        })
+
+    @swagger_auto_schema(
+        operation_description="Daily or monthly totals of a bank account's postings, "
+                              "split by transaction type, currency and direction.",
+        manual_parameters=[
+            openapi.Parameter(
+                'granularity', openapi.IN_QUERY, description="Rollup period", type=openapi.TYPE_STRING,
+                enum=['day', 'month'], default='day'
+            ),
+            openapi.Parameter(
+                'from', openapi.IN_QUERY, description="First period to include (YYYY-MM-DD)",
+                type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE
+            ),
+            openapi.Parameter(
+                'to', openapi.IN_QUERY, description="Last period to include (YYYY-MM-DD)",
+                type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE
+            ),
+        ],
+        responses={200: 'Rollup rows', 400: 'Invalid granularity or date', 404: 'Account not found'}
+    )
+    @action(detail=True, methods=['get'])
+    def summary(self, request, pk=None):
+        granularity = request.query_params.get('granularity', 'day')
+        if granularity not in rollups.GRANULARITIES:
+            return Response({'status': 'granularity must be day or month'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            account = Account.objects.only('id', 'currency').get(pk=pk)
+        except Account.DoesNotExist:
+            return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        queryset = TransactionRollup.objects.filter(account_id=account.id, granularity=granularity)
+        for param, lookup in (('from', 'period_start__gte'), ('to', 'period_start__lte')):
+            value = request.query_params.get(param)
+            if value:
+                try:
+                    value = parse_date(value)
+                except ValueError:
+                    value = None
+                if value is None:
+                    return Response({'status': f'invalid {param} date'}, status=status.HTTP_400_BAD_REQUEST)
+                queryset = queryset.filter(**{lookup: value})
+
+        results = [
+            {
+                'period': row['period_start'],
+                'transaction_type': row['transaction_type'],
+                'currency': row['real_currency'],
+                'direction': row['direction'],
+                'count': row['total_count'],
+                'amount': str(ledger.to_cents(row['total_amount'])),
+                'real_amount': str(ledger.to_cents(row['total_real_amount'])),
+            }
+            # Sharded accounts keep one row per balance shard as well; add them up.
+            for row in queryset.values('period_start', 'transaction_type', 'real_currency', 'direction').annotate(
+                total_count=Sum('count'), total_amount=Sum('amount'), total_real_amount=Sum('real_amount')
+            ).order_by('period_start', 'transaction_type', 'real_currency', 'direction')
+        ]
+        return Response({
+            'account': account.id,
+            'currency': account.currency,
+            'granularity': granularity,
+            'results': results,
+        })
+
+    @swagger_auto_schema(
+        operation_description="Ledger entries of a bank account in posting order, each with the balance after it "
+                              "(null for sharded accounts).",
+        manual_parameters=[
+            openapi.Parameter(
+                'from', openapi.IN_QUERY, description="Only entries at or after this ISO 8601 timestamp",
+                type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME
+            ),
+            openapi.Parameter(
+                'to', openapi.IN_QUERY, description="Only entries at or before this ISO 8601 timestamp",
+                type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME
+            ),
+            openapi.Parameter(
+                'cursor', openapi.IN_QUERY, description="Pagination cursor taken from the next/previous link",
+                type=openapi.TYPE_STRING
+            ),
+            openapi.Parameter(
+                'page_size', openapi.IN_QUERY, description="Number of entries per page (max 1000)",
+                type=openapi.TYPE_INTEGER
+            ),
+        ],
+        responses={200: 'Ledger entries', 400: 'Invalid timestamp', 404: 'Account not found'}
+    )
+    @action(detail=True, methods=['get'])
+    def statement(self, request, pk=None):
+        with db.reading_from(db.read_only_database()):
+            if not Account.objects.filter(pk=pk).exists():
+                return Response({'status': 'account not found'}, status=status.HTTP_404_NOT_FOUND)
+
+            # One range scan of the (account, created_at, id) index per page.
+            queryset = LedgerEntry.objects.filter(account_id=pk)
+            for param, lookup in (('from', 'created_at__gte'), ('to', 'created_at__lte')):
+                value = request.query_params.get(param)
+                if value:
+                    try:
+                        value = parse_datetime(value)
+                    except ValueError:
+                        value = None
+                    if value is None:
+                        return Response({'status': 'invalid timestamp'}, status=status.HTTP_400_BAD_REQUEST)
+                    if timezone.is_naive(value):
+                        value = timezone.make_aware(value)
+                    queryset = queryset.filter(**{lookup: value})
+
+            paginator = KeysetCursorPagination()
+            page = paginator.paginate_queryset(queryset.values(*LedgerEntrySerializer.source_attributes()), request,
+                                               view=self)
+            return paginator.get_paginated_response(LedgerEntrySerializer(page, many=True).data)
+
+
+VALUATION_CURRENCY_PARAMETER = openapi.Parameter(
+    'currency', openapi.IN_QUERY, description="Currency to value the balances in", type=openapi.TYPE_STRING,
+    enum=CURRENCY_CODES, default='THB'
+)
+
+
+class UserViewSet(viewsets.ViewSet):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description="Total value of all your accounts in one currency, with each currency's share.",
+        manual_parameters=[VALUATION_CURRENCY_PARAMETER],
+        responses={200: 'Valuation', 400: 'Unsupported currency'}
+    )
+    @action(detail=False, methods=['get'], url_path='me/valuation', url_name='me-valuation')
+    def me_valuation(self, request):
+        currency = request.query_params.get('currency', 'THB')
+        if currency not in CURRENCY_CODES:
+            return Response({'status': 'unsupported currency'}, status=status.HTTP_400_BAD_REQUEST)
+        with db.reading_from(db.read_only_database()):
+            totals = valuation.balances_by_currency(user_id=request.user.id)
+        try:
+            valuations = valuation.valuate(totals, currency)
+        except UnknownCurrency:
+            return Response({'status': 'unsupported currency'}, status=status.HTTP_400_BAD_REQUEST)
+        result = valuations.get(request.user.id, {'total': '0.00', 'balances': []})
+        return Response({'user': request.user.id, 'currency': currency, **result})
+
+    @swagger_auto_schema(
+        operation_description="Total value of every user's accounts in one currency (staff only).",
+        manual_parameters=[VALUATION_CURRENCY_PARAMETER],
+        responses={200: 'Valuation of every user with accounts', 400: 'Unsupported currency'}
+    )
+    @action(detail=False, methods=['get'], url_path='valuation', url_name='valuation',
+            permission_classes=[permissions.IsAdminUser])
+    def all_valuations(self, request):
+        currency = request.query_params.get('currency', 'THB')
+        if currency not in CURRENCY_CODES:
+            return Response({'status': 'unsupported currency'}, status=status.HTTP_400_BAD_REQUEST)
+        with db.reading_from(db.read_only_database()):
+            totals = valuation.balances_by_currency()
+        try:
+            valuations = valuation.valuate(totals, currency)
+        except UnknownCurrency:
+            return Response({'status': 'unsupported currency'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'currency': currency,
+            'users': [{'user': user_id, **valuations[user_id]} for user_id in sorted(valuations)],
+        })
+
+
+class TransferViewSet(viewsets.ViewSet):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        operation_description="Apply many transfers in a single database transaction.",
+        request_body=openapi.Schema(
+            title='Body',
+            type=openapi.TYPE_OBJECT,
+            properties={
+                'transfers': openapi.Schema(
+                    type=openapi.TYPE_ARRAY,
+                    description=f'Transfers to apply in order (max {ledger.BATCH_TRANSFER_MAX_ITEMS})',
+                    items=openapi.Schema(
+                        type=openapi.TYPE_OBJECT,
+                        properties={
+                            'from': openapi.Schema(type=openapi.TYPE_INTEGER, description='ID of the account to debit'),
+                            'to': openapi.Schema(type=openapi.TYPE_INTEGER, description='ID of the account to credit'),
+                            'amount': openapi.Schema(type=openapi.TYPE_NUMBER, description='Amount to transfer'),
+                            'currency': openapi.Schema(type=openapi.TYPE_STRING, description='Currency of the transfer',
+                                                       enum=CURRENCY_CODES, default='THB')
+                        },
+                        required=['from', 'to', 'amount']
+                    )
+                ),
+                'all_or_nothing': openapi.Schema(type=openapi.TYPE_BOOLEAN, default=False,
+                                                 description='Roll back the whole batch if any transfer fails')
+            },
+            required=['transfers']
+        ),
+        responses={200: 'Per-transfer results', 400: 'Invalid batch / all-or-nothing batch rolled back',
+                   **ADMISSION_RESPONSES}
+    )
+    @action(detail=False, methods=['post'])
+    @admitted
+    @idempotent
+    def batch(self, request):
+        items = request.data.get('transfers')
+        try:
+            all_or_nothing = serializers.BooleanField().to_internal_value(request.data.get('all_or_nothing', False))
+        except serializers.ValidationError:
+            return Response({'status': 'all_or_nothing must be a boolean'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not isinstance(items, list) or not items:
+            return Response({'status': 'transfers must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > ledger.BATCH_TRANSFER_MAX_ITEMS:
+            return Response({'status': f'at most {ledger.BATCH_TRANSFER_MAX_ITEMS} transfers per batch'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = ledger.batch_transfer(items, all_or_nothing=all_or_nothing)
+        succeeded = sum(1 for result in results if result['status'] == 'ok')
+        failed = sum(1 for result in results if result['status'] == 'failed')
+
+        response_status = status.HTTP_400_BAD_REQUEST if all_or_nothing and failed else status.HTTP_200_OK
+        return Response({
+            'status': 'batch applied' if response_status == status.HTTP_200_OK else 'batch rolled back',
+            'succeeded': succeeded,
+            'failed': failed,
+            'results': results,
+        }, status=response_status)
@@ -46,7 +46,7 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'accounts.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -61,6 +61,82 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME_LATE_USER': timedelta(days=30),
 }
 
+# Idempotency-Key support for money-movement endpoints
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# Requests still marked in progress after this long are treated as abandoned
+IDEMPOTENCY_LOCK_TIMEOUT = timedelta(seconds=30)
+# How long a duplicate request waits for the original to finish before giving up
+IDEMPOTENCY_WAIT_TIMEOUT = timedelta(seconds=10)
+
+# FX rates: providers are consulted in order, later ones only fill in missing currencies
+FX_BASE_CURRENCY = 'USD'
+FX_RATE_PROVIDERS = [
+    'accounts.fx.DatabaseRateProvider',
+    'accounts.fx.FileRateProvider',
+    'accounts.fx.StaticRateProvider',
+]
+# Optional JSON rate file for FileRateProvider: {"base": "USD", "rates": {"THB": "30", ...}}
+FX_RATE_FILE = None
+# Seconds between checks for FX rate changes
+FX_RATE_CACHE_TTL = 60
+
+# Cached user active/staff flags used by CachedJWTAuthentication (entries, seconds)
+JWT_USER_CACHE_SIZE = 10000
+JWT_USER_CACHE_TTL = 30
+
+# Group-commit single postings through a background journal writer, flushed every
+# LEDGER_JOURNAL_MAX_DELAY seconds or LEDGER_JOURNAL_MAX_BATCH postings
+LEDGER_JOURNAL = False
+LEDGER_JOURNAL_MAX_BATCH = 500
+LEDGER_JOURNAL_MAX_DELAY = 0.005
+
+# Admission control for money-movement endpoints (accounts.admission). Token buckets per user
+# and per account refill at RATE_LIMIT_*_RATE requests per second up to RATE_LIMIT_*_BURST;
+# a rate of None turns that limit off and a rate of 0 admits only the burst. Buckets live in
+# process unless RATE_LIMIT_CACHE names a shared cache alias. Over MAX_CONCURRENT_WRITES running
+# in one process, a request waits up to WRITE_QUEUE_TIMEOUT seconds for a slot, then gets a 503
+# (None: no limit)
+RATE_LIMIT_USER_RATE = None
+RATE_LIMIT_USER_BURST = None
+RATE_LIMIT_ACCOUNT_RATE = None
+RATE_LIMIT_ACCOUNT_BURST = None
+RATE_LIMIT_CACHE = None
+MAX_CONCURRENT_WRITES = None
+WRITE_QUEUE_TIMEOUT = 0.05
+
+# Account change feed (/api/accounts/{id}/events/): seconds between keepalive comments on an
+# idle event stream, each also rechecking for postings made by other processes, and the
+# longest a long poll waits
+EVENTS_KEEPALIVE = 15
+EVENTS_LONG_POLL_TIMEOUT = 25
+
+# Postings per account between materialized balance snapshots
+BALANCE_SNAPSHOT_INTERVAL = 500
+
+# Age (a timedelta) past which `manage.py archive_transactions` moves transactions to the
+# archive table; None turns archiving off and history reads skip the archive. Keep it set
+# once anything has been archived, or those transactions drop out of history reads
+TRANSACTION_ARCHIVE_AFTER = None
+
+# Local memory is per process: with several workers point this at a shared backend
+# (e.g. django.core.cache.backends.filebased.FileBasedCache) so every worker sees
+# the account generations that version cached responses
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+# Seconds a cached account or account-history response is kept
+RESPONSE_CACHE_TTL = 300
+
+# Request timing (Server-Timing headers, /metrics) by accounts.middleware.ProfilingMiddleware
+PROFILING = False
+# Share of requests run under cProfile; the dumps of the PROFILING_KEEP_SLOWEST slowest
+# are kept in PROFILING_DUMP_DIR (no profiling without one)
+PROFILING_SAMPLE_RATE = 0
+PROFILING_DUMP_DIR = None
+PROFILING_KEEP_SLOWEST = 20
+
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH': False,
     'SECURITY_DEFINITIONS': {
@@ -78,6 +154,8 @@ SECURITY_REQUIREMENTS = {
 }
 
 MIDDLEWARE = [
+    # First, so it times the whole request; inactive unless PROFILING is on
+    'accounts.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +163,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'accounts.middleware.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'banking_api.urls'
@@ -113,9 +192,38 @@ WSGI_APPLICATION = 'banking_api.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # django.db.backends.sqlite3 with write transactions started as BEGIN IMMEDIATE
+        'ENGINE': 'banking_api.sqlite',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {'timeout': 20},
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    # Same file opened query-only, standing in for a read replica (see accounts.db.ReadOnlyRouter)
+    'readonly': {
+        'ENGINE': 'banking_api.sqlite',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'timeout': 20},
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['accounts.db.ReadOnlyRouter']
+# Alias that history and account reads are routed to; point it at a replica in production
+READ_ONLY_DATABASE = 'readonly'
+# Seconds a client's reads stay on the primary after it writes (should exceed replica lag)
+PRIMARY_PIN_SECONDS = 5
+
+# Applied to every new SQLite connection by accounts.db.configure_sqlite
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
+    'cache_size': -65536,  # KiB
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
 }
 
 
@@ -0,0 +1,17 @@
+from django.db.backends.sqlite3 import base
+
+from accounts import db
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend whose transactions take the write lock when they begin.
+
+    A deferred `BEGIN` that reads and then writes cannot wait for another writer
+    to finish: SQLite fails it with "database is locked" straight away, whatever
+    the busy timeout. `BEGIN IMMEDIATE` queues on the busy timeout instead.
+    Connections marked read-only keep plain `BEGIN`.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN' if db.is_read_only(self.alias) else 'BEGIN IMMEDIATE')
@@ -22,7 +22,7 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
-from accounts.views import UserCreateView, UserTokenObtainPairView, UserTokenRefreshView
+from accounts.views import UserCreateView, UserTokenObtainPairView, UserTokenRefreshView, metrics
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -42,4 +42,5 @@ urlpatterns = [
     path('register/', UserCreateView.as_view(), name='user-register'),
     path('token/', UserTokenObtainPairView.as_view(), name='token-obtain-pair'),
     path('token/refresh/', UserTokenRefreshView.as_view(), name='token-refresh'),
+    path('metrics', metrics, name='metrics'),
 ]